@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks a full reload of Pyptables on synthetic configurations of growing size
+
+Every external command (iptables, ip6tables, their -save and -restore variants, ipset) is replaced by a stand-in
+script that only records its invocation, and dns lookups are answered by a stub resolver, so that only the cost of
+Pyptables itself is measured. For each phase of the reload, the wall time, the number of subprocesses started, the
+number of dns lookups and the peak memory allocated are reported.
+
+    $ python3 benchmarks/reload.py --services 10,100,1000 --backend restore
+"""
+
+from argparse import ArgumentParser, Namespace
+from collections import OrderedDict
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pyptables
+from pyptables import dns
+from pyptables import executors
+from pyptables.parser import TypedConfigParser
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+COMMANDS = [
+    "iptables", "ip6tables", "iptables-restore", "ip6tables-restore", "iptables-save", "ip6tables-save", "ipset", "nft"
+]
+
+FAKE_COMMAND = """#!/bin/sh
+echo "$(basename "$0") $*" >> "{log}"
+case "$(basename "$0") $1" in
+    *-restore*|"ipset restore"|"nft -f") cat > /dev/null ;;
+    iptables-save*|ip6tables-save*) printf '*filter\\n:INPUT ACCEPT [0:0]\\nCOMMIT\\n' ;;
+esac
+exit 0
+"""
+
+
+def parse_args() -> Namespace:
+    """
+    Argument parser for the benchmark
+
+    :return: Namespace containing the arguments
+    """
+    _parser = ArgumentParser(description="Benchmarks a reload of Pyptables on synthetic configurations")
+    _parser.add_argument("--services", type=str, default="10,100,1000",
+                         help="comma-separated numbers of service sections to benchmark")
+    _parser.add_argument("--sources", type=int, default=4, help="number of sources of each service")
+    _parser.add_argument("--hostnames", type=float, default=0.25,
+                         help="fraction of the sources given as hostnames instead of addresses")
+    _parser.add_argument("--ignores", type=int, default=20, help="number of ignore_INPUT entries in [logging]")
+    _parser.add_argument("--knock", type=int, default=8, help="length of the ssh knocking port sequence")
+    _parser.add_argument("--backend", choices=sorted(executors.BACKENDS), default="shell")
+    _parser.add_argument("--dns-latency", type=float, default=0,
+                         help="seconds each stub dns lookup takes, to simulate a real resolver")
+    _parser.add_argument("--no-memory", action="store_true",
+                         help="do not trace memory allocations, which slows down every phase")
+    _parser.add_argument("--json", action="store_true", help="output the results as json")
+    return _parser.parse_args()
+
+
+def generate_config(services: int, sources: int, hostnames: float, ignores: int, knock: int) -> str:
+    """
+    Generates a synthetic configuration
+
+    :param services: number of service sections
+    :param sources: number of sources of each service
+    :param hostnames: fraction of the sources given as hostnames
+    :param ignores: number of entries not to log in the INPUT chain
+    :param knock: length of the port knocking sequence
+    :return: the configuration, in ini format
+    """
+    lines = [
+        "[DEFAULT]", "chain = INPUT", "action = ACCEPT", "ipv4 = True", "ipv6 = True", "",
+        "[global]", "closed_chains = INPUT, FORWARD", "allow_established_traffic = True",
+        "allow_traffic_on_interface = lo", "drop_invalid_traffic = True", "ssh_knocking = {}".format(knock > 0), "",
+        "[logging]", "rate = 2/sec", "level = 4", "prefix = Iptables blocked :", "log = INPUT,FORWARD",
+        "ignore_INPUT =",
+    ]
+
+    for index in range(ignores):
+        lines.append("    ignore-{0}, eth0, udp, 10.200.{1}.{2}, ignore-{0}.bench, , {3};".format(
+            index, index // 250, index % 250 + 1, 1024 + index
+        ))
+    lines.append("")
+
+    if knock:
+        lines.extend([
+            "[ssh_knocking]", "ports = " + ",".join(str(10000 + port) for port in range(knock)), "ssh_port = 22",
+            "interface = eth0", "timeout = 30", "",
+        ])
+
+    named = int(sources * hostnames)
+    for service in range(services):
+        addresses = ["host-{}-{}.bench".format(service, index) for index in range(named)]
+        for index in range(sources - named):
+            if index % 2:
+                addresses.append("2001:db8:{:x}::{:x}".format(service, index))
+            else:
+                addresses.append("10.{}.{}.{}".format(service // 250 % 250, service % 250, index % 250 + 1))
+        lines.extend([
+            "[service-{}]".format(service), "protocol = {}".format("tcp" if service % 3 else "udp"),
+            "dport = {}".format(1024 + service), "source = " + ", ".join(addresses), "",
+        ])
+
+    return "\n".join(lines)
+
+
+class StubResolver:
+    """ Answers dns lookups without any network access, counting them """
+    def __init__(self, latency: float=0):
+        self.latency = latency
+        self.forward = 0
+        self.reverse = 0
+
+    def forward_lookup(self, name: str) -> str:
+        """
+        Gives a deterministic address in 198.18.0.0/15 for the name
+
+        :param name: the hostname to resolve
+        :return: the ip address
+        """
+        self.forward += 1
+        time.sleep(self.latency)
+        value = sum(name.encode()) * 7919 + len(name)
+        return "198.{}.{}.{}".format(18 + value // 65536 % 2, value // 256 % 256, value % 254 + 1)
+
+    def reverse_lookup(self, address: str):
+        """
+        Gives a name to half of the addresses
+
+        :param address: the address to resolve
+        :return: the hostname, or None
+        """
+        self.reverse += 1
+        time.sleep(self.latency)
+        if "/" in address or sum(address.encode()) % 2:
+            return None
+        return "rev-{}.bench".format(address.replace(":", "-"))
+
+    @property
+    def lookups(self) -> int:
+        """ The number of lookups done until now """
+        return self.forward + self.reverse
+
+
+class Measure:
+    """
+    Measures a phase of the reload
+
+    :param name: the name of the phase
+    :param log: the file in which the stand-in commands record their invocations
+    :param stub: the stub resolver counting dns lookups
+    :param memory: whether to trace the peak memory
+    """
+    def __init__(self, name: str, log: str, stub: StubResolver, memory: bool):
+        self.name = name
+        self.log = log
+        self.stub = stub
+        self.memory = memory
+        self.result = OrderedDict()
+
+    def _processes(self) -> int:
+        """ Counts the commands started until now """
+        with open(self.log) as _file:
+            return sum(1 for _ in _file)
+
+    def __enter__(self) -> "Measure":
+        self.processes = self._processes()
+        self.lookups = self.stub.lookups
+        if self.memory:
+            tracemalloc.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.result["time"] = time.perf_counter() - self.start
+        self.result["subprocesses"] = self._processes() - self.processes
+        self.result["dns_lookups"] = self.stub.lookups - self.lookups
+        if self.memory:
+            self.result["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def benchmark(path: str, log: str, stub: StubResolver, backend: str, memory: bool) -> OrderedDict:
+    """
+    Runs a full reload of the configuration, phase by phase
+
+    :param path: the configuration file
+    :param log: the file in which the stand-in commands record their invocations
+    :param stub: the stub resolver counting dns lookups
+    :param backend: the backend used to apply the rules
+    :param memory: whether to trace the peak memory of each phase
+    :return: dictionary of phase -> measures
+    """
+    executors.set_backend(backend)
+    dns.resolver.addresses.clear()
+    dns.resolver.hostnames.clear()
+
+    results = OrderedDict()
+    with Measure("parse", log, stub, memory) as measure:
+        config = TypedConfigParser()
+        config.read(path)
+    results[measure.name] = measure.result
+
+    with Measure("resolve", log, stub, memory) as measure:
+        executors.resolve_names(config)
+    results[measure.name] = measure.result
+
+    with Measure("collect", log, stub, memory) as measure:
+        rules = executors.collect_rules(config)
+    results[measure.name] = measure.result
+
+    with Measure("build", log, stub, memory) as measure:
+        errors = pyptables._for_each_family(pyptables.build_family, config, rules)
+    results[measure.name] = measure.result
+
+    with Measure("apply", log, stub, memory) as measure:
+        errors = errors or pyptables.apply_iptables()
+    results[measure.name] = measure.result
+
+    if errors:
+        raise RuntimeError("The reload failed with {}".format(errors))
+
+    results["total"] = OrderedDict(
+        (key, (max if key == "peak_memory" else sum)(result[key] for result in results.values()))
+        for key in results["parse"]
+    )
+    return results
+
+
+def main() -> int:
+    """
+    Runs the benchmark for every requested size
+
+    :return: 0 on success
+    """
+    arguments = parse_args()
+    directory = tempfile.mkdtemp(prefix="pyptables-bench-")
+    log = os.path.join(directory, "commands.log")
+    open(log, "w").close()
+
+    bindir = os.path.join(directory, "bin")
+    os.mkdir(bindir)
+    for command in COMMANDS:
+        path = os.path.join(bindir, command)
+        with open(path, "w") as _file:
+            _file.write(FAKE_COMMAND.format(log=log))
+        os.chmod(path, 0o755)
+    os.environ["PATH"] = bindir + os.pathsep + os.environ["PATH"]
+
+    stub = StubResolver(arguments.dns_latency)
+    dns._forward_lookup = stub.forward_lookup
+    dns._reverse_lookup = stub.reverse_lookup
+
+    report = OrderedDict()
+    stdout = sys.stdout
+    try:
+        for services in [int(size) for size in arguments.services.split(",")]:
+            path = os.path.join(directory, "bench-{}.conf".format(services))
+            with open(path, "w") as _file:
+                _file.write(generate_config(
+                    services, arguments.sources, arguments.hostnames, arguments.ignores, arguments.knock
+                ))
+
+            sys.stdout = open(os.devnull, "w")
+            try:
+                report[services] = benchmark(path, log, stub, arguments.backend, not arguments.no_memory)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+    finally:
+        shutil.rmtree(directory)
+
+    if arguments.json:
+        print(json.dumps(report, indent=2))
+        return 0
+
+    print("{:>8} {:<8} {:>10} {:>12} {:>11} {:>12}".format(
+        "services", "phase", "time (s)", "subprocesses", "dns lookups", "peak memory"
+    ))
+    for services, results in report.items():
+        for phase, result in results.items():
+            print("{:>8} {:<8} {:>10.4f} {:>12} {:>11} {:>12}".format(
+                services, phase, result["time"], result["subprocesses"], result["dns_lookups"],
+                "{:.1f} MB".format(result["peak_memory"] / 2 ** 20) if "peak_memory" in result else "-"
+            ))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
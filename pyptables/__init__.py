@@ -6,15 +6,27 @@ Default runner for Pyptables
 """
 
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from functools import partial
+import io
 import os
 import sys
 import subprocess
+import threading
 
 from pyptables import conf_generator
+from pyptables.cache import RulesetCache
+from pyptables.compiler import compile_all
+from pyptables.daemon import Daemon, Watcher
 from pyptables import executors
+from pyptables.dns import resolver
 from pyptables.iptables import Iptables
 from pyptables.iptables import Ip6tables
-from pyptables.parser import TypedConfigParser
+from pyptables.ipset import Ipset
+from pyptables.nftables import NftablesTransaction
+from pyptables.parser import fragments, TypedConfigParser
+from pyptables.stats import stats
 
 __author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
 
@@ -30,9 +42,80 @@ def parse_args(arguments=None) -> Namespace:
     _parser.add_argument("--new-config", action="store_true")
     _parser.add_argument("--conf", type=str)
     _parser.add_argument("--dry-run", action="store_true")
+    _parser.add_argument("--backend", choices=sorted(executors.BACKENDS),
+                         help="shell runs iptables once per rule, restore loads everything with iptables-restore, "
+                              "diff only adds and removes the rules that changed in the kernel, nftables loads the "
+                              "rules of both ip versions in a single inet table with nft. shell by default")
+    _parser.add_argument("--atomic", action="store_true",
+                         help="build the whole ruleset before loading it, and rollback to the previous one on error. "
+                              "Implies --backend restore unless diff is used")
+    _parser.add_argument("--dns-timeout", type=float, default=5.0,
+                         help="seconds after which a dns lookup is considered failed")
+    _parser.add_argument("--dns-cache", type=str, default="/var/cache/pyptables/dns.json",
+                         help="file in which to keep dns answers between runs")
+    _parser.add_argument("--dns-ttl", type=float, default=3600,
+                         help="seconds during which a cached dns answer is used without looking it up again")
+    _parser.add_argument("--offline", action="store_true",
+                         help="do not do any dns lookup, only use the cached answers and the [hosts] section")
+    _parser.add_argument("--refresh-dns", action="store_true",
+                         help="only look up again the expired dns answers and update the cache, without touching "
+                              "the rules")
+    _parser.add_argument("--ruleset-cache", type=str, default="/var/cache/pyptables/rulesets",
+                         help="directory in which to keep the compiled rulesets, reused while the configuration and "
+                              "the dns answers do not change")
+    _parser.add_argument("--no-ruleset-cache", action="store_true",
+                         help="always compile the rules from the configuration")
+    _parser.add_argument("--fragment-cache", type=str, default="/var/cache/pyptables/fragments",
+                         help="directory in which to keep the parsed files included by the configuration, parsed "
+                              "again only when they change")
+    _parser.add_argument("--daemon", action="store_true",
+                         help="keep running, and apply the changes every time the configuration changes. "
+                              "Implies --backend diff, and cannot be used with an other backend")
+    _parser.add_argument("--reorder", action="store_true",
+                         help="among consecutive ACCEPT rules, put first the ones matching the most packets in the "
+                              "live ruleset. Disables the ruleset cache")
+    _parser.add_argument("--prune", action="store_true",
+                         help="remove the rules found to be shadowed, redundant or duplicated, instead of only warning "
+                              "about them")
+    _parser.add_argument("--dispatch", nargs="?", type=int, const=4, metavar="MIN_RULES",
+                         help="group consecutive ACCEPT rules in chains by interface, protocol and destination port "
+                              "range, so that packets only go through the rules that can match them. A chain is "
+                              "created for groups of at least MIN_RULES rules (4 by default)")
+    _parser.add_argument("--stats", nargs="?", choices=["text", "json"], const="text",
+                         help="report the time spent in each phase, dns cache hits and misses, calls to external "
+                              "commands and the number of rules per chain")
+    _parser.add_argument("--stats-file", type=str, help="file in which to write the --stats report")
+
+    commands = _parser.add_subparsers(dest="command")
+    _compile = commands.add_parser(
+        "compile", help="compile many configurations to iptables-restore files, without touching the local rules"
+    )
+    _compile.add_argument("configurations", nargs="+",
+                          help="configuration files, directories whose *.conf files are compiled, or glob patterns")
+    _compile.add_argument("--output", "-o", type=str, required=True,
+                          help="directory in which to write the NAME.ipv4, NAME.ipv6 and NAME.ipset files of each "
+                               "NAME.conf configuration")
+    _compile.add_argument("--jobs", "-j", type=int,
+                          help="number of configurations compiled in parallel, the number of processors by default")
 
     args = _parser.parse_args(arguments or sys.argv[1:])
 
+    if args.daemon and args.backend not in [None, "diff"]:
+        _parser.error("--daemon applies the changes with --backend diff, not with --backend {}".format(args.backend))
+
+    if args.backend is None:
+        args.backend = "diff" if args.daemon else "shell"
+
+    if args.command == "compile":
+        return args
+
+    if args.atomic and args.backend == "shell":
+        args.backend = "restore"
+
+    if args.reorder and args.backend == "nftables":
+        print("[WARNING] --reorder reads the packet counters with iptables-save, it is ignored with nftables")
+        args.reorder = False
+
     if args.conf is None:
         args.conf = "/etc/pyptables.conf"
 
@@ -48,17 +131,135 @@ def parse_args(arguments=None) -> Namespace:
     return args
 
 
-def generate_iptables(config: TypedConfigParser) -> int:
+class _ThreadOutput:
+    """
+    Standard output keeping apart what each thread writes, in the buffer the thread set, if any
+
+    :param stream: the stream written to by threads without a buffer
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text: str) -> int:
+        """ Writes to the buffer of the current thread, or to the stream """
+        buffer = getattr(self.local, "buffer", None)
+        return (self.stream if buffer is None else buffer).write(text)
+
+    def flush(self) -> None:
+        """ Flushes the stream """
+        self.stream.flush()
+
+
+def _for_each_family(function, *args) -> list:
+    """
+    Runs the function for ipv4 and ipv6 in parallel
+
+    What each of them prints is kept apart and printed once both are done, ipv4 first, so that their outputs never mix.
+
+    :param function: the function to run, called with the ip version followed by args
+    :param args: other arguments to give to the function
+    :return: the error codes returned
+    """
+    output = _ThreadOutput(sys.stdout)
+    buffers = {version: io.StringIO() for version in [4, 6]}
+
+    def run(version: int):
+        """ Runs the function for an ip version, with its own output """
+        output.local.buffer = buffers[version]
+        try:
+            return function(version, *args)
+        finally:
+            output.local.buffer = None
+
+    with redirect_stdout(output):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            futures = [(version, pool.submit(run, version)) for version in [4, 6]]
+    for version in [4, 6]:
+        sys.stdout.write(buffers[version].getvalue())
+
+    errors = []
+    for version, future in futures:
+        try:
+            result = future.result()
+        except Exception as exc:
+            print("[ERROR] ipv{} : {}".format(version, exc))
+            result = -1
+        if result:
+            errors.append(result)
+    return errors
+
+
+def build_iptables(config: TypedConfigParser, reorder: bool=False, dispatch: int=None, prune: bool=False) -> int:
+    """
+    Computes the rules of the configuration, without applying them
+
+    :param config: the configuration used to define the rules
+    :param reorder: whether to reorder the rules according to the packet counters of the live ruleset
+    :param dispatch: if set, the minimum number of rules of a group to move to a generated chain
+    :param prune: whether to remove the rules that never match a packet
+    :return: 0 on success, -X on error
+    """
+    with stats.phase("resolve"):
+        executors.resolve_names(config)
+
+    try:
+        with stats.phase("collect"):
+            rules = executors.collect_rules(config)
+    except subprocess.CalledProcessError:
+        return -10
+
+    errors = _for_each_family(build_family, config, rules)
+    if errors:
+        return errors[0]
+
+    with stats.phase("analyze"):
+        executors.analyze(prune)
+
+    if reorder:
+        try:
+            with stats.phase("reorder"):
+                executors.reorder()
+        except subprocess.CalledProcessError as exc:
+            print("[WARNING] Could not read the packet counters with {}, keeping the configuration order".format(
+                exc.cmd
+            ))
+
+    if dispatch:
+        with stats.phase("dispatch"):
+            executors.dispatch(dispatch)
+    return 0
+
+
+def build_family(version: int, config: TypedConfigParser, rules: list) -> int:
+    """
+    Builds the rules for a single ip version
+
+    :param version: the ip version for which to build the rules
+    :param config: the configuration used to define the rules
+    :param rules: the rules of the services, as given by executors.collect_rules
+    :raise subprocess.CalledProcessError on unexpected error
+    :return: 0 on success, -X on error
+    """
+    with stats.phase("build ipv{}".format(version)):
+        return _build_family(version, config, rules)
+
+
+def _build_family(version: int, config: TypedConfigParser, rules: list) -> int:
     """
-    Main runner to generate Iptables rules
+    Builds the rules for a single ip version
 
+    :param version: the ip version for which to build the rules
     :param config: the configuration used to define the rules
+    :param rules: the rules of the services, as given by executors.collect_rules
     :raise subprocess.CalledProcessError on unexpected error
     :return: 0 on success, -X on error
     """
+    versions = (version,)
+
     if config.has_section("global"):
         try:
-            executors.setup_global_begin(config["global"])
+            executors.setup_global_begin(config["global"], versions)
         except subprocess.CalledProcessError as exc:
             if exc.returncode == 127:
                 print("iptables was not found in your path. This may be caused if you are not running it as root")
@@ -66,32 +267,105 @@ def generate_iptables(config: TypedConfigParser) -> int:
             else:
                 raise
 
-    for section in config.sections():
-        if section in ["global", "ssh_knocking", "logging"]:
-            continue
-
-        try:
-            print(section)
-            executors.handle_service(config[section])
-        except subprocess.CalledProcessError:
-            return -10
+    try:
+        executors.add_rules(rules, versions)
+    except subprocess.CalledProcessError:
+        return -10
 
     if config.has_section("global"):
         try:
-            executors.setup_global_end(config["global"])
+            executors.setup_global_end(config["global"], versions)
         except subprocess.CalledProcessError:
             return -15
 
+    return 0
+
+
+def apply_iptables(atomic: bool=False) -> int:
+    """
+    Loads the built rules in the kernel, for ipv4 and ipv6 in parallel
+
+    :param atomic: whether to rollback to the previous rules if loading the new ones fails
+    :return: 0 on success, -X on error
+    """
+    try:
+        with stats.phase("ipset"):
+            executors.ipset_handler.commit()
+    except subprocess.CalledProcessError as exc:
+        if exc.returncode == 127:
+            print("{} was not found in your path. This may be caused if you are not running it as root".format(
+                exc.cmd
+            ))
+            return -1
+        return -10
+
+    if executors.joint():
+        error = apply_family(None, atomic)
+        errors = [error] if error else []
+    else:
+        errors = _for_each_family(apply_family, atomic)
+
+    if errors:
+        if atomic:
+            print("[ERROR] Rolling back to the previous rulesets")
+            executors.rollback()
+        return errors[0]
+
+    executors.ipset_handler.cleanup()
+    return 0
+
+
+def apply_family(version: int, atomic: bool=False) -> int:
+    """
+    Loads the built rules of a single ip version in the kernel
+
+    :param version: the ip version for which to apply the rules, None to apply both together
+    :param atomic: whether to snapshot the previous rules before loading the new ones
+    :return: 0 on success, -X on error
+    """
+    try:
+        with stats.phase("apply ipv{}".format(version) if version else "apply inet"):
+            executors.commit(atomic, (version,) if version else (4, 6))
+    except subprocess.CalledProcessError as exc:
+        if exc.returncode == 127:
+            print("{} was not found in your path. This may be caused if you are not running it as root".format(
+                exc.cmd
+            ))
+            return -1
+        print("[ERROR] {} failed".format(exc.cmd))
+        return -20
+
+    return 0
+
+
+def refresh_tracked(live: bool=False) -> int:
+    """
+    Updates the sets of tracked hostnames whose addresses changed
+
+    :param live: whether to first read the members of the sets in the kernel, when this run did not load them itself
+    :return: 0 on success, -X on error
+    """
+    try:
+        if live:
+            executors.ipset_handler.loaded.update(executors.ipset_handler.members())
+        for name in executors.refresh_tracked():
+            print("[INFO] Updated the addresses of {}".format(name))
+    except subprocess.CalledProcessError as exc:
+        print("[ERROR] {} failed".format(exc.cmd))
+        return -10
+    return 0
+
 
 def run():
     """
     Parses the configuration, and run the utility
 
+    When the configuration and the dns answers did not change since the last successful run, the compiled rules are
+    loaded from the ruleset cache instead of parsing the configuration again.
+
     :return: 0 on success, -X on error
     """
     arguments = parse_args()
-    config = TypedConfigParser()
-    config.read(arguments.conf)
 
     if arguments.new_config:
         conf_generator.generate_sample_conf()
@@ -100,9 +374,106 @@ def run():
     if arguments.dry_run:
         Iptables.execute = lambda s, x: print("Iptables", x)
         Ip6tables.execute = lambda s, x: print("Ip6tables", x)
+        Iptables.restore = lambda s, x, noflush=False: print(
+            s.restore_command + " --noflush" * noflush + "\n" + (x if isinstance(x, str) else "".join(x))
+        )
+        Iptables.save = lambda s, counters=False: ""
+        Iptables.snapshot = lambda s: print(s.save_command)
+        Ipset.list = lambda s: []
+        Ipset.members = lambda s: {}
+        Ipset.restore = lambda s, x: print(s.command + " restore\n" + x)
+        NftablesTransaction.dump = lambda s, terse=False: ""
+        NftablesTransaction.load = lambda s, x: print("nft -f -\n" + x)
+
+    stats.enabled = arguments.stats is not None
+    executors.set_backend(arguments.backend)
+    resolver.timeout = arguments.dns_timeout
+    resolver.ttl = arguments.dns_ttl
+    resolver.offline = arguments.offline
+    resolver.load(arguments.dns_cache)
+    TypedConfigParser.fragment_cache = arguments.fragment_cache
+
+    if arguments.command == "compile":
+        try:
+            build = partial(build_iptables, dispatch=arguments.dispatch, prune=arguments.prune)
+            return compile_all(arguments.configurations, arguments.output, build, arguments.jobs)
+        finally:
+            resolver.save(arguments.dns_cache)
+            report_stats(arguments)
+
+    if arguments.refresh_dns:
+        config = TypedConfigParser()
+        config.read(arguments.conf)
+        executors.resolve_names(config)
+        resolver.refresh()
+        resolver.save(arguments.dns_cache)
+        for section in config.sections():
+            if section not in executors.RESERVED_SECTIONS and config[section].getboolean("track_hostnames", False):
+                list(executors.service_rules(config[section]))
+        executors.ipset_handler.sets.clear()
+        return refresh_tracked(live=True)
+
+    if arguments.daemon:
+        try:
+            daemon = Daemon(arguments.conf, build_family, arguments.atomic, arguments.dispatch, arguments.prune)
+            included = {os.path.dirname(fragment) for fragment in fragments(arguments.conf)}
+            daemon.run(Watcher([arguments.conf] + sorted(included)))
+        except KeyboardInterrupt:
+            return
+        except Exception as exc:
+            print("ERROR :", exc)
+            return -1
+        finally:
+            resolver.save(arguments.dns_cache)
+
+    cache = None
+    if not arguments.no_ruleset_cache and not arguments.reorder and arguments.backend != "nftables":
+        cache = RulesetCache(arguments.ruleset_cache)
+    options = ["dispatch={}".format(arguments.dispatch)] if arguments.dispatch else []
+    key = RulesetCache.key(
+        arguments.conf, options + (["prune"] if arguments.prune else []), fragments(arguments.conf) if cache else ()
+    )
+    compiled = cache.load(key, resolver) if cache else None
 
     try:
-        return generate_iptables(config)
+        if compiled:
+            print("[INFO] Configuration unchanged, using the compiled ruleset {}".format(key[:12]))
+            with stats.phase("load"):
+                executors.load_compiled(compiled)
+            return apply_iptables(arguments.atomic) or refresh_tracked()
+
+        with stats.phase("parse"):
+            config = TypedConfigParser()
+            config.read(arguments.conf)
+        error = build_iptables(config, arguments.reorder, arguments.dispatch, arguments.prune)
+        if error:
+            return error
+
+        compiled = executors.compiled()
+        error = apply_iptables(arguments.atomic)
+        if not error and cache and not arguments.dry_run:
+            cache.store(
+                key, arguments.conf, compiled["rulesets"], compiled["ipsets"], compiled["tracked"], resolver.answers()
+            )
+        return error
     except Exception as exc:
         print("ERROR :", exc)
         return -1
+    finally:
+        resolver.save(arguments.dns_cache)
+        report_stats(arguments)
+
+
+def report_stats(arguments: Namespace) -> None:
+    """
+    Prints the --stats report, or writes it to the --stats-file
+
+    :param arguments: the command line arguments
+    """
+    if stats.enabled:
+        report = stats.json() if arguments.stats == "json" else stats.report()
+        if arguments.stats_file:
+            with open(arguments.stats_file, "w") as _file:
+                _file.write(report + "\n")
+        else:
+            print(report)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+On-disk cache of compiled rulesets, to skip parsing and resolution when the configuration did not change
+"""
+
+import glob
+import hashlib
+import json
+import os
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class RulesetCache:
+    """
+    Keeps the rulesets compiled from a configuration, in iptables-restore format with one file per ip version
+
+    An entry is found by the hash of the configuration it was compiled from, and is only used while the dns answers it
+    was built with are still the ones the resolver would give.
+    """
+    # part of every key, to be increased whenever the content of the entries changes, so that older ones are not used
+    FORMAT = 2
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    @staticmethod
+    def key(path: str, options: list=(), included: list=()) -> str:
+        """
+        Computes the key of the rulesets compiled from a configuration
+
+        :param path: the configuration file
+        :param options: the command line options changing the compiled rules
+        :param included: the files the configuration includes
+        :raise OSError if the configuration cannot be read
+        :return: the key of the entry
+        """
+        digest = hashlib.sha256(str(RulesetCache.FORMAT).encode() + b"\0")
+        with open(path, "rb") as _file:
+            digest.update(_file.read())
+        for name in included:
+            with open(name, "rb") as _file:
+                digest.update(b"\0" + name.encode() + b"\0" + _file.read())
+        for option in options:
+            digest.update(b"\0" + str(option).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str, suffix: str) -> str:
+        """
+        Gets the path of a file of an entry
+
+        :param key: the key of the entry
+        :param suffix: the part of the entry stored in the file
+        :return: the path of the file
+        """
+        return os.path.join(self.directory, "{}.{}".format(key, suffix))
+
+    def load(self, key: str, resolver) -> dict:
+        """
+        Gets the compiled rulesets for the key, if they are still valid
+
+        :param key: the key of the entry
+        :param resolver: the resolver whose answers the entry has to match
+        :return: a dictionary with the "rulesets" (ip version -> iptables-restore dump), the "ipsets" to define and
+                 the "tracked" sets, or None if there is no valid entry
+        """
+        try:
+            with open(self._path(key, "json")) as _file:
+                entry = json.load(_file)
+            rulesets = {}
+            for version in entry["versions"]:
+                with open(self._path(key, "ipv{}".format(version))) as _file:
+                    rulesets[version] = _file.read()
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as exc:
+            print("[WARNING] Could not load the compiled ruleset {} : {}".format(key, exc))
+            return None
+
+        if not resolver.matches(entry["answers"]):
+            return None
+
+        return {"rulesets": rulesets, "ipsets": entry["ipsets"], "tracked": entry["tracked"]}
+
+    def store(self, key: str, conf: str, rulesets: dict, ipsets: dict, tracked: dict, answers: dict) -> None:
+        """
+        Saves compiled rulesets. Previous entries for the same configuration are removed
+
+        :param key: the key of the entry
+        :param conf: the configuration file the rulesets were compiled from
+        :param rulesets: dictionary of ip version -> Ruleset
+        :param ipsets: the ipsets the rulesets use, as defined in Ipset.sets
+        :param tracked: the sets of tracked hostnames, as in executors.tracked
+        :param answers: the dns answers used to compile the rulesets
+        """
+        entry = {"conf": conf, "versions": sorted(rulesets), "ipsets": ipsets, "tracked": tracked, "answers": answers}
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for path in glob.glob(os.path.join(self.directory, "*.json")):
+                if os.path.basename(path) != key + ".json" and self._owner(path) == conf:
+                    for stale in glob.glob(path[:-len("json")] + "*"):
+                        os.remove(stale)
+
+            for version, ruleset in rulesets.items():
+                self._write(self._path(key, "ipv{}".format(version)), ruleset.lines())
+            self._write(self._path(key, "json"), [json.dumps(entry)])
+        except OSError as exc:
+            print("[WARNING] Could not save the compiled ruleset {} : {}".format(key, exc))
+
+    @staticmethod
+    def _owner(path: str):
+        """
+        Gets the configuration from which an entry was compiled
+
+        :param path: the path to the description of the entry
+        :return: the configuration file, or None if the entry is unreadable
+        """
+        try:
+            with open(path) as _file:
+                return json.load(_file).get("conf")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    @staticmethod
+    def _write(path: str, lines) -> None:
+        """
+        Atomically replaces the content of a file
+
+        :param path: the file to write
+        :param lines: the lines to write, with their line feed
+        :raise OSError if the file cannot be written
+        """
+        with open(path + ".tmp", "w") as _file:
+            _file.writelines(lines)
+        os.replace(path + ".tmp", path)
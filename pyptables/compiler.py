@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compilation of many configurations at once, to render the rulesets of other hosts without touching the local kernel
+"""
+
+from contextlib import redirect_stdout, suppress
+from multiprocessing import Pool
+import glob
+import io
+import os
+
+from pyptables import executors
+from pyptables.cache import RulesetCache
+from pyptables.dns import resolver
+from pyptables.parser import TypedConfigParser
+from pyptables.stats import stats
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+# answers of the resolver known to the parent process, to only send back the new ones
+_known = {}
+
+
+def configurations(patterns: list) -> list:
+    """
+    Lists the configuration files to compile
+
+    :param patterns: files, directories, whose *.conf files are used, or glob patterns
+    :return: the sorted configuration files, without duplicates
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.conf")
+        paths.update(path for path in glob.glob(pattern) if os.path.isfile(path))
+    return sorted(os.path.abspath(path) for path in paths)
+
+
+def _output(directory: str, path: str) -> str:
+    """
+    Gets the prefix of the files compiled from a configuration
+
+    :param directory: the directory in which to write the compiled files
+    :param path: the configuration
+    :return: the path of the compiled files, without their extension
+    """
+    name = os.path.basename(path)
+    return os.path.join(directory, name[:-len(".conf")] if name.endswith(".conf") else name)
+
+
+def _hostnames(path: str) -> tuple:
+    """
+    Lists the hostnames a configuration uses
+
+    :param path: the configuration
+    :return: (hostnames to resolve to an address, hostnames to resolve to all their addresses)
+    """
+    config = TypedConfigParser()
+    config.read(path)
+    return executors.hostnames(config)
+
+
+def _initialize(caches: dict, timeout: float, ttl: float, offline: bool, measure: bool) -> None:
+    """
+    Sets up a worker process with the answers of the resolver of the parent process
+
+    :param caches: dictionary of kind ("addresses", "hostnames" or "records") -> cache
+    :param timeout: seconds after which a dns lookup is considered failed
+    :param ttl: seconds during which an answer is used without looking it up again
+    :param offline: whether to only use the known answers
+    :param measure: whether to collect the --stats measures, sent back with each result
+    """
+    stats.enabled = measure
+    resolver.timeout, resolver.ttl, resolver.offline = timeout, ttl, offline
+    for kind, cache in caches.items():
+        setattr(resolver, kind, dict(cache))
+        _known[kind] = cache
+
+
+def _compile(path: str, directory: str, build) -> tuple:
+    """
+    Compiles a configuration to iptables-restore files, one per ip version, and an ipset restore file if it uses sets
+
+    :param path: the configuration
+    :param directory: the directory in which to write the compiled files
+    :param build: the function building the rules of a configuration, returning 0 on success
+    :return: (error code, messages, new dns answers as kind -> {key: answer}, --stats measures of the compilation)
+    """
+    stats.reset()
+    executors.set_backend("restore")
+    executors.tracked.clear()
+    resolver.unpin()
+    resolver.used = {"addresses": set(), "hostnames": set()}
+
+    output = io.StringIO()
+    with redirect_stdout(output):
+        try:
+            config = TypedConfigParser()
+            config.read(path)
+            error = build(config)
+            if not error:
+                prefix = _output(directory, path)
+                compiled = executors.compiled()
+                for version, ruleset in compiled["rulesets"].items():
+                    stats.count_rules(version, ruleset)
+                files = {"ipv{}".format(version): ruleset.lines() for version, ruleset in compiled["rulesets"].items()}
+                if compiled["ipsets"]:
+                    files["ipset"] = [executors.ipset_handler.dump([])]
+
+                for extension in ["ipv4", "ipv6", "ipset"]:
+                    if extension in files:
+                        # noinspection PyProtectedMember
+                        RulesetCache._write("{}.{}".format(prefix, extension), files[extension])
+                    else:
+                        with suppress(FileNotFoundError):
+                            os.remove("{}.{}".format(prefix, extension))
+        except Exception as exc:
+            print("[ERROR] {}".format(exc))
+            error = -1
+
+    answers = {}
+    for kind, keys in resolver.used.items():
+        cache = getattr(resolver, kind)
+        answers[kind] = {
+            key: cache[key] for key in keys
+            if key in cache and cache[key][1] is not None and cache[key] != _known[kind].get(key)
+        }
+    return error, output.getvalue(), answers, stats.as_dict()
+
+
+def _run(arguments: tuple) -> tuple:
+    """ Unpacks the arguments of _compile, for Pool.imap_unordered """
+    return arguments[0], _compile(*arguments)
+
+
+def compile_all(patterns: list, directory: str, build, jobs: int=None) -> int:
+    """
+    Compiles many configurations in parallel, without touching the local kernel
+
+    The hostnames of all configurations are resolved once, before compiling anything, and the answers are given to
+    every worker process. The answers the workers had to look up are merged back in the resolver, and their --stats
+    measures are added up : phases are the time spent on all configurations, rules are counted for all of them.
+
+    :param patterns: files, directories or glob patterns of the configurations
+    :param directory: the directory in which to write the compiled files
+    :param build: the function building the rules of a configuration, returning 0 on success. It must be picklable
+    :param jobs: the number of worker processes, the number of processors by default
+    :return: 0 on success, -X if a configuration could not be compiled
+    """
+    paths = configurations(patterns)
+    if not paths:
+        print("[ERROR] No configuration found in {}".format(", ".join(patterns)))
+        return -1
+
+    outputs = {}
+    for path in paths:
+        outputs.setdefault(_output(directory, path), []).append(path)
+    duplicates = {path for prefix, sources in outputs.items() if len(sources) > 1 for path in sources}
+    for path in sorted(duplicates):
+        print("[ERROR] {} : another configuration has the same name, skipping".format(path))
+    paths = [path for path in paths if path not in duplicates]
+
+    os.makedirs(directory, exist_ok=True)
+    chunksize = max(1, len(paths) // ((jobs or os.cpu_count() or 1) * 8))
+
+    with stats.phase("resolve"):
+        with Pool(jobs) as pool:
+            names, records = set(), set()
+            for _names, _records in pool.imap_unordered(_hostnames, paths, chunksize):
+                names.update(_names)
+                records.update(_records)
+        resolver.prefetch(names=names, records=records)
+
+    total, failed = len(paths) + len(duplicates), len(duplicates)
+    with stats.phase("compile"):
+        caches = {kind: getattr(resolver, kind) for kind in ["addresses", "hostnames", "records"]}
+        initializer = (caches, resolver.timeout, resolver.ttl, resolver.offline, stats.enabled)
+        tasks = [(path, directory, build) for path in paths]
+
+        with Pool(jobs, _initialize, initializer) as pool:
+            for path, (error, messages, answers, measures) in pool.imap_unordered(_run, tasks, chunksize):
+                for line in messages.splitlines():
+                    if line.startswith(("[ERROR]", "[WARNING]", "ERROR")):
+                        print("{} : {}".format(path, line))
+                for kind, entries in answers.items():
+                    getattr(resolver, kind).update(entries)
+                stats.merge(measures)
+                if error:
+                    failed += 1
+
+    print("[INFO] Compiled {} of {} configurations to {}".format(total - failed, total, directory))
+    return -1 if failed else 0
@@ -45,6 +45,8 @@ ports = 777,888,999
 ssh_port = 22
 interface = eth0
 timeout = 30
+# recent or ipset. ipset stays fast when many addresses knock, for example during a scan
+method = recent
 
 # and ssh, just in case
 [ssh]
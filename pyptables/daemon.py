@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Long-running mode : watches the configuration and applies only what changed
+"""
+
+from contextlib import suppress
+import ctypes
+import ctypes.util
+import os
+import select
+import signal
+import struct
+import subprocess
+import sys
+import time
+
+from pyptables import executors
+from pyptables.dns import resolver
+from pyptables.parser import TypedConfigParser
+from pyptables.ruleset import Ruleset
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+EVENT = struct.Struct("iIII")
+
+
+class Watcher:
+    """
+    Waits for files to change
+
+    Uses inotify on the directories of the files when available, so that files replaced by editors are noticed too.
+    Otherwise, falls back to checking the modification time of the files every interval seconds.
+
+    :param paths: the files and directories to watch. For a directory, any file in it is watched
+    :param interval: seconds between two checks when inotify is not available
+    """
+    def __init__(self, paths: list, interval: float=1.0):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.interval = interval
+        self.fd = self._inotify()
+        self.state = self._state()
+
+    def _directories(self) -> set:
+        """ Gets the directories to watch """
+        return {path if os.path.isdir(path) else os.path.dirname(path) for path in self.paths}
+
+    def _watched(self, path: str) -> bool:
+        """
+        Checks whether a change to the file is of interest
+
+        :param path: the file that changed
+        :return: True if it is one of the watched files, or in one of the watched directories
+        """
+        return path in self.paths or os.path.dirname(path) in self.paths
+
+    def _inotify(self):
+        """
+        Sets up inotify watches
+
+        :return: the inotify file descriptor, or None if inotify is not available
+        """
+        with suppress(AttributeError, OSError, TypeError):
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd < 0:
+                return None
+
+            for directory in self._directories():
+                mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+                    print("[WARNING] Could not watch {} : {}".format(directory, os.strerror(ctypes.get_errno())))
+            return fd
+
+        print("[WARNING] inotify is not available, checking the configuration every {} seconds".format(self.interval))
+        return None
+
+    def _state(self) -> dict:
+        """ Gets the modification time and size of every watched file """
+        files = []
+        for path in self.paths:
+            if os.path.isdir(path):
+                files.extend(os.path.join(path, name) for name in sorted(os.listdir(path)))
+            else:
+                files.append(path)
+
+        state = {}
+        for path in files:
+            with suppress(OSError):
+                stat = os.stat(path)
+                state[path] = (stat.st_mtime, stat.st_size)
+        return state
+
+    def _events(self, timeout: float) -> bool:
+        """
+        Reads the pending inotify events
+
+        :param timeout: seconds to wait for an event
+        :return: True if one of the watched files changed
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+
+        changed = False
+        with suppress(BlockingIOError):
+            while True:
+                data = os.read(self.fd, 65536)
+                offset = 0
+                while offset < len(data):
+                    _, _, _, length = EVENT.unpack_from(data, offset)
+                    name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0").decode()
+                    offset += EVENT.size + length
+                    changed |= any(self._watched(os.path.join(directory, name)) for directory in self._directories())
+        return changed
+
+    def _changed(self, timeout: float) -> bool:
+        """
+        Waits for a change of the watched files
+
+        :param timeout: seconds to wait
+        :return: True if one of the watched files changed
+        """
+        if self.fd is not None:
+            return self._events(timeout)
+
+        time.sleep(timeout)
+        state = self._state()
+        changed, self.state = state != self.state, state
+        return changed
+
+    def wait(self, timeout: float=None, settle: float=0.2) -> bool:
+        """
+        Waits for a watched file to change. Changes happening in quick succession are reported once
+
+        :param timeout: maximum number of seconds to wait, None to wait forever
+        :param settle: seconds without changes to wait for before reporting them
+        :return: True if a file changed, False on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while deadline is None or time.monotonic() < deadline:
+            step = self.interval if deadline is None else min(self.interval, max(0, deadline - time.monotonic()))
+            if self._changed(step):
+                while self._changed(settle):
+                    pass
+                return True
+
+        return False
+
+
+class Daemon:
+    """
+    Keeps the configuration, the rules of each service and the live ruleset in memory between reloads
+
+    On a reload, only the rules of the services whose section changed are computed again, and only the rules that
+    differ from the live ones are applied. A change to one of the reserved sections rebuilds everything.
+
+    :param path: the configuration file
+    :param build: the function building the rules of an ip version, called with the version, the configuration and the
+                  rules of the services
+    :param atomic: whether to rollback to the previous rules if loading the new ones fails
+    :param dispatch: if set, the minimum number of rules of a group to move to a generated chain
+    :param prune: whether to remove the rules that never match a packet
+    """
+    def __init__(self, path: str, build, atomic: bool=False, dispatch: int=None, prune: bool=False):
+        self.path = path
+        self.build = build
+        self.atomic = atomic
+        self.dispatch = dispatch
+        self.prune = prune
+        self.reserved = None
+        self.services = {}
+        self.answers = {}
+        self.resync = False
+
+    def _discard(self) -> None:
+        """ Forgets the rules not applied and the rules of the services, to rebuild everything on the next reload """
+        self.services = {}
+        executors.tracked.clear()
+        executors.ipset_handler.sets.clear()
+        for handler, _ in executors._handlers((4, 6)):
+            handler.ruleset = Ruleset()
+            handler.current = None
+
+    def _resync(self, *_) -> None:
+        """ Asks for the live rulesets to be read again and everything to be rebuilt on the next reload """
+        self.resync = True
+
+    @staticmethod
+    def _snapshot(config: TypedConfigParser, section: str) -> tuple:
+        """
+        Gets the values of a section, to know whether it changed
+
+        :param config: the configuration
+        :param section: the section
+        :return: the values of the section, defaults included
+        """
+        return tuple(sorted(config.items(section)))
+
+    def reload(self) -> int:
+        """
+        Reads the configuration again and applies what changed
+
+        :return: 0 on success, -X on error
+        """
+        config = TypedConfigParser()
+        config.read(self.path)
+
+        reserved = {
+            section: self._snapshot(config, section)
+            for section in executors.RESERVED_SECTIONS if config.has_section(section)
+        }
+        if self.resync or reserved != self.reserved or not resolver.matches(self.answers):
+            self._discard()
+        self.resync = False
+
+        sections = [section for section in config.sections() if section not in executors.RESERVED_SECTIONS]
+        changed = [
+            section for section in sections
+            if self._snapshot(config, section) != self.services.get(section, (None,))[0]
+        ]
+        removed = [section for section in self.services if section not in sections]
+
+        if not changed and not removed and reserved == self.reserved:
+            return 0
+
+        executors.resolve_names(config)
+        for section in removed:
+            del self.services[section]
+        for name, (service, _, _, _) in list(executors.tracked.items()):
+            if service in changed or service in removed:
+                del executors.tracked[name]
+        for section in changed:
+            print(section)
+            self.services[section] = (self._snapshot(config, section), list(executors.service_rules(config[section])))
+
+        rules = executors.merge_ports([rule for section in sections for rule in self.services[section][1]])
+        for version in [4, 6]:
+            error = self.build(version, config, rules)
+            if error:
+                self._discard()
+                return error
+
+        executors.analyze(self.prune)
+        if self.dispatch:
+            executors.dispatch(self.dispatch)
+
+        services = [rule for section in sections for _, rule in self.services[section][1]]
+        executors.ipset_handler.defined = {
+            name for rule in services + [rule for _, rule in executors.ignore_rules(config)]
+            for name in [rule.source_set, rule.destination_set] if name is not None
+        }
+
+        try:
+            executors.ipset_handler.commit()
+            executors.commit(self.atomic)
+        except subprocess.CalledProcessError as exc:
+            print("[ERROR] {} failed".format(exc.cmd))
+            if self.atomic:
+                print("[ERROR] Rolling back to the previous rulesets")
+                executors.rollback()
+            self._discard()
+            return -20
+
+        executors.ipset_handler.cleanup()
+        self.reserved = reserved
+        self.answers = resolver.answers()
+        return 0
+
+    def run(self, watcher: Watcher, dns_interval: float=60) -> None:
+        """
+        Applies the configuration, then applies it again every time it changes, until interrupted
+
+        :param watcher: the watcher of the configuration files
+        :param dns_interval: seconds between two checks of the dns answers used by the rules and the tracked sets
+        """
+        signal.signal(signal.SIGHUP, self._resync)
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        while True:
+            start = time.perf_counter()
+            try:
+                error = self.reload()
+            except Exception as exc:
+                print("ERROR :", exc)
+                # the reload may have stopped halfway through updating the rules of the services
+                self._discard()
+                error = -1
+
+            if error:
+                print("[ERROR] Reload failed, keeping the previous rules")
+            print("[INFO] Reloaded in {:.3f} seconds".format(time.perf_counter() - start))
+
+            while not watcher.wait(dns_interval) and not self.resync:
+                try:
+                    for name in executors.refresh_tracked():
+                        print("[INFO] Updated the addresses of {}".format(name))
+                except subprocess.CalledProcessError as exc:
+                    print("[ERROR] {} failed".format(exc.cmd))
+                except Exception as exc:
+                    print("ERROR :", exc)
+                resolver.prefetch(self.answers.get("addresses", ()), self.answers.get("hostnames", ()))
+                if not resolver.matches(self.answers):
+                    break
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Name resolution for Pyptables : concurrent lookups with a cache shared by the whole run
+"""
+
+from contextlib import suppress
+from queue import Queue, Empty
+from threading import Thread
+import json
+import os
+import socket
+import time
+
+from pyptables.stats import stats
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+def _forward_lookup(name: str):
+    """
+    Resolves a hostname to an ip address
+
+    :param name: the hostname to resolve
+    :return: the ip address as a string, or None if the name cannot be resolved
+    """
+    try:
+        return socket.gethostbyname(name)
+    except (OSError, UnicodeError):
+        return None
+
+
+def _records_lookup(name: str):
+    """
+    Resolves a hostname to all its ipv4 and ipv6 addresses
+
+    :param name: the hostname to resolve
+    :return: the sorted list of ip addresses, or None if the name cannot be resolved
+    """
+    try:
+        return sorted({info[4][0] for info in socket.getaddrinfo(name, None, proto=socket.IPPROTO_TCP)})
+    except (OSError, UnicodeError):
+        return None
+
+
+def _reverse_lookup(address: str):
+    """
+    Resolves an ip address to its hostname
+
+    :param address: the address to resolve
+    :return: the hostname, or None if the address has no name
+    """
+    if "/" in address:
+        return None
+
+    try:
+        return socket.gethostbyaddr(address)[0]
+    except (OSError, UnicodeError):
+        return None
+
+
+class Resolver:
+    """
+    Caching resolver, able to resolve many names concurrently with a timeout on each lookup
+
+    Every answer is kept with an expiration date and can be saved to disk, so that later runs can reuse it. Pinned
+    answers never expire. In offline mode, only the cached and pinned answers are used, even if they are expired.
+    """
+    KINDS = {"addresses": "forward", "records": "records", "hostnames": "reverse"}
+
+    def __init__(self, timeout: float=5.0, workers: int=32, ttl: float=3600, negative_ttl: float=60,
+                 offline: bool=False):
+        self.timeout = timeout
+        self.workers = workers
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.offline = offline
+        self.addresses = {}
+        self.hostnames = {}
+        self.records = {}
+        self.used = {"addresses": set(), "hostnames": set()}
+
+    def _lookup_all(self, function, keys: set) -> dict:
+        """
+        Runs the lookup function on all keys in parallel daemon threads
+
+        A lookup taking more than timeout seconds is considered failed. Its thread is left behind, and another one is
+        started to process the remaining keys.
+
+        :param function: the lookup function to call on each key
+        :param keys: the keys to look up
+        :return: a dictionary of key -> result of the lookup
+        """
+        todo = Queue()
+        done = Queue()
+        started = {}
+        results = {}
+
+        for key in keys:
+            todo.put(key)
+
+        def worker() -> None:
+            """ Processes keys until there are none left """
+            while True:
+                try:
+                    _key = todo.get_nowait()
+                except Empty:
+                    return
+                started[_key] = time.monotonic()
+                done.put((_key, function(_key)))
+
+        def spawn_worker() -> None:
+            """ Starts a new worker in the background """
+            Thread(target=worker, daemon=True).start()
+
+        for _ in range(min(self.workers, len(keys))):
+            spawn_worker()
+
+        remaining = set(keys)
+        while remaining:
+            with suppress(Empty):
+                key, result = done.get(timeout=self.timeout / 10)
+                if key in remaining:
+                    results[key] = result
+                    remaining.discard(key)
+
+            now = time.monotonic()
+            for key in [key for key in remaining if key in started and now - started[key] > self.timeout]:
+                print("[WARNING] Lookup of {} timed out after {} seconds".format(key, self.timeout))
+                results[key] = None
+                remaining.discard(key)
+                spawn_worker()
+
+        return results
+
+    @staticmethod
+    def _expired(entry: tuple) -> bool:
+        """
+        Checks whether a cache entry has to be looked up again
+
+        :param entry: the (answer, expiration timestamp) entry
+        :return: True if the entry is expired
+        """
+        return entry[1] is not None and entry[1] <= time.time()
+
+    def _store(self, cache: dict, key: str, answer) -> None:
+        """
+        Stores a new answer in the cache. A failed lookup does not replace a previously successful one
+
+        :param cache: the cache in which to store the answer
+        :param key: the name or address that was looked up
+        :param answer: the answer to store, None if the lookup failed
+        """
+        if answer is None and cache.get(key, (None,))[0] is not None:
+            print("[WARNING] Could not refresh {}, using the cached answer {}".format(key, cache[key][0]))
+            return
+
+        cache[key] = (answer, time.time() + (self.ttl if answer is not None else self.negative_ttl))
+
+    def _get(self, kind: str, function, key: str):
+        """
+        Gets an answer from the cache, looking it up if it is missing or expired
+
+        :param kind: the cache to use, "addresses" or "hostnames"
+        :param function: the lookup function
+        :param key: the name or address to look up
+        :return: the answer, or None if there is none
+        """
+        cache = getattr(self, kind)
+        if kind in self.used:
+            self.used[kind].add(key)
+        entry = cache.get(key)
+        if entry is not None and (self.offline or not self._expired(entry)):
+            stats.lookups(self.KINDS[kind], 1, 0)
+            return entry[0]
+        if self.offline:
+            stats.lookups(self.KINDS[kind], 0, 1)
+            # negative answer, already expired so that it is looked up on the next run that is not offline
+            cache[key] = (None, time.time())
+            return None
+
+        start = time.perf_counter()
+        self._store(cache, key, function(key))
+        stats.lookups(self.KINDS[kind], 0, 1, time.perf_counter() - start)
+        return cache[key][0]
+
+    def _refresh(self, kind: str, function, keys) -> None:
+        """
+        Looks up concurrently all the keys that are missing from the cache or expired
+
+        :param kind: the cache to update, "addresses" or "hostnames"
+        :param function: the lookup function
+        :param keys: the keys that will be needed
+        """
+        if self.offline:
+            return
+
+        cache = getattr(self, kind)
+        keys = set(keys)
+        stale = {key for key in keys if key not in cache or self._expired(cache[key])}
+        start = time.perf_counter()
+        for key, answer in self._lookup_all(function, stale).items():
+            self._store(cache, key, answer)
+        stats.lookups(self.KINDS[kind], len(keys) - len(stale), len(stale), time.perf_counter() - start)
+
+    def pin(self, name: str, address: str) -> None:
+        """
+        Sets a permanent answer for the hostname, and for the reverse lookup of its address
+
+        :param name: the hostname
+        :param address: the ip address to use for this hostname
+        """
+        self.addresses[name.lower()] = (address, None)
+        self.hostnames[address] = (name, None)
+
+    def unpin(self) -> None:
+        """ Forgets the permanent answers, to resolve names for another configuration """
+        for cache in [self.addresses, self.hostnames]:
+            for key in [key for key, entry in cache.items() if entry[1] is None]:
+                del cache[key]
+
+    def prefetch(self, names=(), addresses=(), records=()) -> None:
+        """
+        Resolves concurrently all the names and addresses that are not yet in the cache or are expired
+
+        :param names: hostnames to resolve to an ip address
+        :param addresses: ip addresses to resolve to a hostname
+        :param records: hostnames to resolve to all their ip addresses
+        """
+        self._refresh("addresses", _forward_lookup, [name.lower() for name in names])
+        self._refresh("hostnames", _reverse_lookup, addresses)
+        self._refresh("records", _records_lookup, [name.lower() for name in records if not self._pinned(name)])
+
+    def refresh(self) -> None:
+        """ Looks up again every expired entry of the cache """
+        self.prefetch(names=list(self.addresses), addresses=list(self.hostnames), records=list(self.records))
+
+    def _pinned(self, name: str) -> bool:
+        """
+        Checks whether the address of a hostname was pinned
+
+        :param name: the hostname
+        :return: True if the hostname has a permanent answer
+        """
+        return self.addresses.get(name.lower(), (None, 0))[1] is None
+
+    def resolve(self, name: str):
+        """
+        Gets the ip address of a hostname, looking it up if it was not prefetched
+
+        :param name: the hostname to resolve
+        :return: the ip address as a string, or None if the name cannot be resolved
+        """
+        return self._get("addresses", _forward_lookup, name.lower())
+
+    def resolve_all(self, name: str) -> list:
+        """
+        Gets all the ipv4 and ipv6 addresses of a hostname, looking them up if they were not prefetched
+
+        :param name: the hostname to resolve
+        :return: the sorted list of ip addresses, empty if the name cannot be resolved
+        """
+        if self._pinned(name):
+            return [self.addresses[name.lower()][0]]
+        return self._get("records", _records_lookup, name.lower()) or []
+
+    def reverse(self, address: str):
+        """
+        Gets the hostname of an ip address, looking it up if it was not prefetched
+
+        :param address: the address to resolve
+        :return: the hostname, or None if the address has no name
+        """
+        if "/" in address:
+            return None
+        return self._get("hostnames", _reverse_lookup, address)
+
+    def answers(self) -> dict:
+        """
+        Gets the answers given since the start of the run. Pinned answers, and the records of tracked hostnames which
+        do not end up in rules, are left out
+
+        :return: a dictionary of kind ("addresses" or "hostnames") -> {name or address: answer}
+        """
+        return {
+            kind: {key: getattr(self, kind)[key][0] for key in sorted(keys) if getattr(self, kind)[key][1] is not None}
+            for kind, keys in self.used.items()
+        }
+
+    def matches(self, answers: dict) -> bool:
+        """
+        Checks, without looking anything up, whether the cache would still give the same answers
+
+        :param answers: the answers to check, as given by answers()
+        :return: False if one of them is missing, different or expired
+        """
+        for kind, entries in answers.items():
+            cache = getattr(self, kind)
+            for key, answer in entries.items():
+                entry = cache.get(key)
+                if entry is None or entry[0] != answer or (not self.offline and self._expired(entry)):
+                    return False
+        return True
+
+    def load(self, path: str) -> None:
+        """
+        Loads the answers saved by a previous run. Pinned answers are kept
+
+        :param path: the file in which the answers were saved
+        """
+        try:
+            with open(path) as _file:
+                data = json.load(_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            print("[WARNING] Could not load the dns cache {} : {}".format(path, exc))
+            return
+
+        for cache, name in [(self.addresses, "addresses"), (self.hostnames, "hostnames"), (self.records, "records")]:
+            for key, entry in data.get(name, {}).items():
+                if cache.get(key, (None, 0))[1] is not None:
+                    cache[key] = tuple(entry)
+
+    def save(self, path: str) -> None:
+        """
+        Saves all answers that are not pinned, for a later run
+
+        :param path: the file in which to save the answers
+        """
+        data = {
+            "addresses": {key: entry for key, entry in self.addresses.items() if entry[1] is not None},
+            "hostnames": {key: entry for key, entry in self.hostnames.items() if entry[1] is not None},
+            "records": {key: entry for key, entry in self.records.items() if entry[1] is not None},
+        }
+
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path + ".tmp", "w") as _file:
+                json.dump(data, _file)
+            os.replace(path + ".tmp", path)
+        except OSError as exc:
+            print("[WARNING] Could not save the dns cache {} : {}".format(path, exc))
+
+
+resolver = Resolver()
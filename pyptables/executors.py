@@ -5,19 +5,81 @@
 Defines several helpers to add rules to Iptables
 """
 
-from configparser import SectionProxy
+from collections import OrderedDict
+from configparser import ConfigParser, SectionProxy
 from contextlib import suppress
-from ipaddress import ip_address, ip_network
+from copy import copy
+from ipaddress import collapse_addresses, ip_address, ip_network, IPv4Address, IPv6Address
+from threading import Lock
 import re
-import socket
 
-from pyptables.iptables import Iptables, Ip6tables, IptablesRule
+from pyptables.dns import resolver
+from pyptables.ipset import Ipset
+from pyptables.iptables import Iptables, Ip6tables, IptablesRestore, Ip6tablesRestore, IptablesDiff, Ip6tablesDiff, \
+    IptablesRule
+from pyptables.nftables import Nftables, Nft6tables, NftablesTransaction, NftSets
+from pyptables.ruleset import Ruleset, hit_counters
+from pyptables.stats import stats
 
 __author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
 
 
+RESERVED_SECTIONS = ["global", "ssh_knocking", "logging", "hosts"]
+
+TERMINAL_ACTIONS = ["ACCEPT", "DROP", "REJECT"]
+
+MULTIPORT_LIMIT = 15
+
+BACKENDS = {
+    "shell": (Iptables, Ip6tables),
+    "restore": (IptablesRestore, Ip6tablesRestore),
+    "diff": (IptablesDiff, Ip6tablesDiff),
+    "nftables": (Nftables, Nft6tables),
+}
+
 ipv4_handler = Iptables()
 ipv6_handler = Ip6tables()
+ipset_handler = Ipset()
+
+tracked = OrderedDict()
+
+_ignores = (None, [])
+_ignores_lock = Lock()
+
+
+def set_backend(name: str) -> None:
+    """
+    Selects the way rules are sent to the kernel
+
+    :param name: one of BACKENDS : "shell" runs one iptables call per rule, "restore" applies everything at once,
+                 "diff" only applies the rules that changed since the last run and "nftables" loads the rules of both
+                 ip versions in a single inet table
+    """
+    global ipv4_handler, ipv6_handler, ipset_handler
+    ipv4_class, ipv6_class = BACKENDS[name]
+    if name == "nftables":
+        # both ip versions and their sets share the inet table, loaded in a single transaction
+        transaction = NftablesTransaction()
+        ipv4_handler, ipv6_handler = ipv4_class(transaction), ipv6_class(transaction)
+        ipset_handler = NftSets(transaction)
+    else:
+        ipv4_handler, ipv6_handler = ipv4_class(), ipv6_class()
+        ipset_handler = Ipset()
+
+
+def joint() -> bool:
+    """ Whether the rules of both ip versions are loaded together, in a single transaction """
+    return isinstance(ipv4_handler, Nftables)
+
+
+def _handlers(versions: tuple) -> list:
+    """
+    Gets the handlers for the given ip versions
+
+    :param versions: the wanted ip versions
+    :return: list of (handler, ip version)
+    """
+    return [(handler, version) for handler, version in [(ipv4_handler, 4), (ipv6_handler, 6)] if version in versions]
 
 
 def get_ip_address(name: str):
@@ -30,17 +92,183 @@ def get_ip_address(name: str):
         return ip_address(name)
     with suppress(ValueError):
         return ip_network(name)
-    with suppress(socket.gaierror, ValueError):
-        return ip_address(socket.gethostbyname(name))
+    with suppress(ValueError):
+        return ip_address(resolver.resolve(name))
 
     return None
 
 
-def setup_global_begin(config: SectionProxy) -> None:
+def is_hostname(value: str) -> bool:
+    """
+    Checks whether a value of the configuration has to be resolved
+
+    :param value: the value to check
+    :return: True if the value is not an ip address or network
+    """
+    for parse in [ip_address, ip_network]:
+        with suppress(ValueError):
+            parse(value)
+            return False
+    return True
+
+
+def _ignore_entries(parser: ConfigParser):
+    """
+    Iterates over the entries of the ignore_* options of the logging section
+
+    :param parser: the configuration
+    :return: generator of (chain, [service, interface, protocol, source, destination, sport, dport])
+    """
+    if not parser.has_section("logging"):
+        return
+
+    for option, value in parser.items("logging"):
+        if not option.startswith("ignore_"):
+            continue
+
+        chain = option.replace("ignore_", "").upper()
+        for entry in [item for item in re.split(r";\s*", value) if item != ""]:
+            yield chain, [item if item != "" else None for item in re.split(r",\s*", entry.strip())]
+
+
+def ignore_rules(parser: ConfigParser) -> list:
+    """
+    Computes the rules matching the entries of the ignore_* options of the logging section, which are not logged
+
+    The entries are parsed and their addresses resolved once per configuration, for both ip versions. Entries only
+    differing by their destination ports are merged in multiport rules, and lists of at least ipset_threshold sources
+    otherwise identical are matched with an ipset.
+
+    :param parser: the configuration
+    :return: list of (ip version, rule)
+    """
+    global _ignores
+
+    with _ignores_lock:
+        if _ignores[0] is not parser:
+            _ignores = (parser, _ignore_rules(parser))
+        return _ignores[1]
+
+
+def _ignore_rules(parser: ConfigParser) -> list:
+    """
+    Computes the rules matching the entries of the ignore_* options of the logging section
+
+    A packet of an ignored entry gets the verdict the policy of its chain would give : dropped in a closed chain,
+    accepted otherwise.
+
+    :param parser: the configuration
+    :return: list of (ip version, rule)
+    """
+    if not parser.has_section("logging"):
+        return []
+
+    # noinspection PyUnresolvedReferences
+    closed = [chain.upper() for chain in parser["global"].getlist("closed_chains", [])] \
+        if parser.has_section("global") else []
+    threshold = parser["logging"].getint("ipset_threshold", 0)
+
+    groups = OrderedDict()
+    for chain, data in _ignore_entries(parser):
+        service, interface, protocol, source, destination, sport, dport = (data + [None] * 7)[:7]
+        addresses = [item if item is None else get_ip_address(item) for item in [source, destination]]
+        if any(item is not None and address is None for item, address in zip([source, destination], addresses)):
+            print("[ERROR] Could not determine ip address for {} : skipping".format(
+                source if addresses[0] is None else destination
+            ))
+            continue
+
+        versions = {address.version for address in addresses if address is not None}
+        if len(versions) > 1:
+            print("[ERROR] Could not add rule with ip versions no matching: {} and {}".format(*addresses))
+            continue
+
+        for version in sorted(versions or {4, 6}):
+            key = (version, chain, interface, protocol, str(addresses[1]), sport, dport)
+            groups.setdefault(key, []).append((service, addresses[0], addresses[1]))
+
+    rules = []
+    for (version, chain, interface, protocol, _, sport, dport), entries in groups.items():
+        sources = [source for _, source, _ in entries if source is not None]
+        action = "DROP" if chain in closed else "ACCEPT"
+
+        if threshold and len(sources) >= threshold:
+            name = ipset_handler.define(
+                "ignore_{} {}".format(chain, (interface, protocol, str(entries[0][2]), sport, dport)), "src",
+                version, collapse(sources)
+            )
+            rules.append((version, IptablesRule(
+                ", ".join(OrderedDict.fromkeys(str(service) for service, _, _ in entries)), chain, action,
+                protocol=protocol, interface=interface, destination=entries[0][2], sport=sport, dport=dport,
+                source_set=name
+            )))
+            entries = [entry for entry in entries if entry[1] is None]
+
+        rules.extend((version, IptablesRule(
+            service, chain, action, protocol=protocol, interface=interface, source=source, destination=destination,
+            sport=sport, dport=dport
+        )) for service, source, destination in entries)
+
+    return merge_ports(rules)
+
+
+def hostnames(parser: ConfigParser) -> tuple:
+    """
+    Lists the hostnames used in the configuration, leaving out the ones of the hosts section
+
+    :param parser: the configuration
+    :return: (hostnames to resolve to an address, hostnames to resolve to all their addresses)
+    """
+    pinned = set(parser.options("hosts")) - set(parser.defaults()) if parser.has_section("hosts") else set()
+    services = [parser[section] for section in parser.sections() if section not in RESERVED_SECTIONS]
+
+    names = set()
+    records = set()
+    for service in services:
+        entries = service.getlist("source", []) + service.getlist("destination", [])
+        (records if service.getboolean("track_hostnames", False) else names).update(entries)
+    for _, data in _ignore_entries(parser):
+        names.update(address for address in data[3:5] if address is not None)
+
+    return (
+        sorted(name for name in names if is_hostname(name) and name.lower() not in pinned),
+        sorted(name for name in records if is_hostname(name) and name.lower() not in pinned)
+    )
+
+
+def resolve_names(parser: ConfigParser) -> None:
+    """
+    Resolves at once all the hostnames used in the configuration, and the addresses that will need a name in comments
+
+    :param parser: the configuration
+    """
+    if parser.has_section("hosts"):
+        for name in set(parser.options("hosts")) - set(parser.defaults()):
+            resolver.pin(name, parser.get("hosts", name))
+
+    names, records = hostnames(parser)
+    resolver.prefetch(names=names, records=records)
+
+    services = [parser[section] for section in parser.sections() if section not in RESERVED_SECTIONS]
+    addresses = set()
+    for service in services:
+        if service.get("remote", None) is not None:
+            continue
+        option = {"INPUT": "source", "OUTPUT": "destination"}.get(service.get("chain", "").upper())
+        if option is not None:
+            addresses.update(get_ip_address(item) for item in service.getlist(option, []))
+
+    resolver.prefetch(addresses=[
+        str(address) for address in addresses if isinstance(address, (IPv4Address, IPv6Address))
+    ])
+
+
+def setup_global_begin(config: SectionProxy, versions: tuple=(4, 6)) -> None:
     """
     Sets up the tables globally for ipv4 and ipv6
 
     :param config: the configuration used
+    :param versions: the ip versions to set up
     """
     # noinspection PyUnresolvedReferences
     def setup(handler: Iptables, _config: SectionProxy) -> None:
@@ -63,110 +291,457 @@ def setup_global_begin(config: SectionProxy) -> None:
         if _config.getboolean("drop_invalid_traffic", False):
             handler.drop_invalid_traffic()
 
-    if config.getboolean("ipv4", False):
-        setup(ipv4_handler, config)
-
-    if config.getboolean("ipv6", False):
-        setup(ipv6_handler, config)
+    for handler, version in _handlers(versions):
+        if config.getboolean("ipv{}".format(version), False):
+            setup(handler, config)
 
 
-def setup_global_end(config: SectionProxy) -> None:
+def setup_global_end(config: SectionProxy, versions: tuple=(4, 6)) -> None:
     """
-    Sets up the last things : logging, drops and ssh knocking
+    Sets up the last things : ssh knocking, drops and logging
 
     :param config: the config to use
+    :param versions: the ip versions to set up
     """
     def setup(handler: Iptables, _config: SectionProxy, version) -> None:
         """
-        Ties up the settings : logging, drops and ssh knocking
+        Ties up the settings : ssh knocking, drops and logging
 
         :param handler: the Iptables instance on which to operate
         :param _config: the configuration used
         :param version: the version of ip protocol used (4 or 6)
         """
+        if _config.getboolean("ssh_knocking"):
+            section = _config.parser["ssh_knocking"]
+            sets = None
+            if section.get("method", "recent") == "ipset":
+                timeout = section.getint("timeout", 30)
+                sets = [
+                    ipset_handler.define(
+                        "ssh_knocking {} {}".format(step, timeout), "src", version, [], "hash:ip", timeout
+                    ) for step in range(len(section.getlist("ports")))
+                ]
+            handler.enable_ssh_knocking(section, sets)
+
+        # ignored packets get a verdict : after the knocking rules, they can neither swallow a knock nor bypass knocking
+        for rule_version, rule in ignore_rules(_config.parser):
+            if rule_version == version:
+                handler.no_log(
+                    rule.chain, rule.name, rule.interface, rule.protocol, rule.source, rule.destination, rule.sport,
+                    rule.dport, rule.action, rule.source_set
+                )
+
         if _config.parser.has_section("logging"):
-            for entry in _config.parser.items("logging"):
-                if not entry[0].startswith("ignore_"):
-                    continue
+            section = _config.parser["logging"]
+            for chain in section.getlist("log"):
+                handler.log(chain, section.get("prefix"), section.get("rate", None), section.getint("level", 4))
 
-                chain = entry[0].replace("ignore_", "").upper()
-                values = [item for item in re.split(r";\s*", entry[1]) if item != ""]
+    for handler, version in _handlers(versions):
+        if config.getboolean("ipv{}".format(version), False):
+            setup(handler, config, version=version)
 
-                for value in values:
-                    data = [item if item != "" else None for item in re.split(r",\s*", value.strip())]
-                    address1, address2 = data[4:6]
-                    if address1 is not None:
-                        address1 = get_ip_address(address1)
-                    if address2 is not None:
-                        address2 = get_ip_address(address2)
 
-                    if (address1 is not None and address1.version != version) or (
-                            address2 is not None and address2.version != version):
-                        continue
+def _get_addresses(config: SectionProxy, option: str) -> list:
+    """
+    Resolves the addresses given in a list option
 
-                    handler.no_log(chain, *data)
+    :param config: the configuration of the service
+    :param option: the option containing the addresses
+    :return: the ip addresses and networks, or [None] if the option is not set
+    """
+    addresses = []
+    # noinspection PyUnresolvedReferences
+    for item in config.getlist(option, [None]):
+        address = item if item is None else get_ip_address(item)
+        if item is not None and address is None:
+            print("[ERROR] Could not determine ip address for {} : skipping".format(item))
+            continue
+        addresses.append(address)
+    return addresses
 
-        if _config.getboolean("ssh_knocking"):
-            handler.enable_ssh_knocking(_config.parser["ssh_knocking"])
 
-        if _config.parser.has_section("logging"):
-            section = _config.parser["logging"]
-            for chain in section.getlist("log"):
-                handler.log(chain, section.get("prefix"), section.get("rate", None), section.getint("level", 4))
+def collapse(addresses: list) -> list:
+    """
+    Deduplicates addresses of the same ip version, and merges them into the smallest list of networks covering them
 
-    if config.getboolean("ipv4", False):
-        setup(ipv4_handler, config, version=4)
+    :param addresses: the ip addresses and networks to merge
+    :return: the merged networks, with single hosts given as addresses
+    """
+    return [
+        network.network_address if network.num_addresses == 1 else network
+        for network in collapse_addresses(ip_network(address) for address in addresses)
+    ]
 
-    if config.getboolean("ipv6", False):
-        setup(ipv6_handler, config, version=6)
 
+def _get_ports(config: SectionProxy, option: str):
+    """
+    Reads a list of ports and port ranges, such as "80,443,8000-8100"
 
-# noinspection PyUnresolvedReferences
-def handle_service(config: SectionProxy) -> None:
+    :param config: the configuration of the service
+    :param option: the option containing the ports
+    :return: the ports in iptables format ("80,443,8000:8100"), or None if the option is not set
     """
-    Sets a rule or a service
+    # noinspection PyUnresolvedReferences
+    ports = config.getlist(option, None)
+    if not ports:
+        return None
+    return ",".join(port.replace("-", ":") for port in ports)
+
+
+def service_rules(config: SectionProxy):
+    """
+    Computes the rules for a service, lazily
+
+    Addresses are deduplicated and merged for each ip version. Lists of at least ipset_threshold addresses of the same
+    ip version are then matched with an ipset instead of one rule per address. With track_hostnames, lists containing
+    hostnames are always matched with an ipset, kept up to date by refresh_tracked.
 
     :param config: the configuration for the rule
+    :return: generator of (ip version, rule)
     """
-    for src in config.getlist("source", [None]):
-        for dst in config.getlist("destination", [None]):
-            source = None
-            destination = None
+    tracking = {
+        direction: option for direction, option in [("src", "source"), ("dst", "destination")]
+        if config.getboolean("track_hostnames", False) and any(map(is_hostname, config.getlist(option, [])))
+    }
+    sources = [None] if "src" in tracking else _get_addresses(config, "source")
+    destinations = [None] if "dst" in tracking else _get_addresses(config, "destination")
+    threshold = config.getint("ipset_threshold", 0)
+
+    for src in sources:
+        for dst in destinations:
+            if src is not None and dst is not None and src.version != dst.version:
+                print("[ERROR] Could not add rule with ip versions no matching: {} and {}".format(src, dst))
+
+    for version in [4, 6]:
+        if not config.getboolean("ipv{}".format(version), False):
+            continue
+
+        addresses = {
+            direction: [address for address in candidates if address is None or address.version == version]
+            for direction, candidates in [("src", sources), ("dst", destinations)]
+        }
+
+        rules = len(addresses["src"]) * len(addresses["dst"])
+        for direction in addresses:
+            if None not in addresses[direction]:
+                addresses[direction] = collapse(addresses[direction])
+        if rules > len(addresses["src"]) * len(addresses["dst"]):
+            print("[INFO] {}: merging ipv{} addresses saved {} rules".format(
+                config.name, version, rules - len(addresses["src"]) * len(addresses["dst"])
+            ))
+
+        sets = {}
+        for direction in ["src", "dst"]:
+            if threshold and len(addresses[direction]) >= threshold and None not in addresses[direction]:
+                sets[direction] = ipset_handler.define(config.name, direction, version, addresses[direction])
+                addresses[direction] = [None]
+            elif direction in tracking:
+                sets[direction] = track(config.name, direction, version, config.getlist(tracking[direction]))
+
+        for source in addresses["src"]:
+            for destination in addresses["dst"]:
+                yield version, IptablesRule(
+                    name=config.name,
+                    interface=config.get("interface"),
+                    chain=config.get("chain"),
+                    protocol=config.get("protocol"),
+                    action=config.get("action"),
+                    source=source,
+                    destination=destination,
+                    sport=_get_ports(config, "sport"),
+                    dport=_get_ports(config, "dport"),
+                    remote=config.get("remote", None),
+                    source_set=sets.get("src"),
+                    destination_set=sets.get("dst"),
+                    notrack=config.getboolean("notrack", False)
+                )
+
+
+def track(service: str, direction: str, version: int, entries: list) -> str:
+    """
+    Defines a set containing all the addresses of the given hostnames, to be kept up to date by refresh_tracked
 
-            if src is not None:
-                source = get_ip_address(src)
-                if source is None:
-                    print("[ERROR] Could not determine ip address for {} : skipping".format(src))
-                    continue
+    :param service: the name of the service using the set
+    :param direction: "src" or "dst", depending on the side of the packet the set is matched against
+    :param version: the ip version of the set
+    :param entries: the hostnames, ip addresses and networks to put in the set
+    :return: the name of the set
+    """
+    name = ipset_handler.name(service, direction, version, "hash:net")
+    tracked[name] = (service, direction, version, entries)
+    ipset_handler.define(service, direction, version, tracked_members(name), "hash:net")
+    return name
+
+
+def tracked_members(name: str) -> list:
+    """
+    Computes the current members of a tracked set
+
+    :param name: the name of the set
+    :return: the ip addresses and networks of the version of the set
+    """
+    _, _, version, entries = tracked[name]
+    members = []
+    for entry in entries:
+        if is_hostname(entry):
+            members.extend(ip_address(address) for address in resolver.resolve_all(entry))
+        else:
+            members.append(get_ip_address(entry))
+    return collapse([member for member in members if member.version == version])
+
+
+def refresh_tracked() -> list:
+    """
+    Looks up again the expired hostnames of the tracked sets, and swaps the content of the sets that changed. The rules
+    using the sets are not touched
+
+    :raise subprocess.CalledProcessError if ipset fails
+    :return: the names of the sets that changed
+    """
+    names = {entry for _, _, _, entries in tracked.values() for entry in entries if is_hostname(entry)}
+    resolver.prefetch(records=names)
+
+    def networks(members: list) -> set:
+        """
+        Gets the networks of the members of a set, which the kernel lists in any order and without /32 or /128
+
+        :param members: the ip addresses and networks of the set
+        :return: the networks
+        """
+        return {ip_network(str(member), strict=False) for member in members}
+
+    changed = []
+    for name, (service, direction, version, _) in tracked.items():
+        members = tracked_members(name)
+        if name not in ipset_handler.loaded or networks(members) != networks(ipset_handler.loaded[name]):
+            ipset_handler.define(service, direction, version, members, "hash:net")
+            changed.append(name)
+
+    ipset_handler.commit()
+    return changed
+
+
+def _split_ports(ports) -> list:
+    """
+    Splits a list of ports in chunks small enough for a multiport match
+
+    :param ports: the ports, in iptables format, or None
+    :return: the list of chunks, in iptables format
+    """
+    if ports is None:
+        return [None]
+
+    chunks = [[]]
+    for port in ports.split(","):
+        if _port_slots(chunks[-1] + [port]) > MULTIPORT_LIMIT:
+            chunks.append([])
+        chunks[-1].append(port)
+    return [",".join(chunk) for chunk in chunks]
 
-            if dst is not None:
-                destination = get_ip_address(dst)
-                if destination is None:
-                    print("[ERROR] Could not determine ip address for {} : skipping".format(dst))
+
+def _port_slots(ports: list) -> int:
+    """
+    Counts the room the ports take in a multiport match, where a range counts as two ports
+
+    :param ports: the list of ports
+    :return: the number of slots used
+    """
+    return sum(2 if ":" in port else 1 for port in ports)
+
+
+def merge_ports(rules: list) -> list:
+    """
+    Merges rules that only differ by their destination ports into multiport rules, and splits port lists too long for
+    a single multiport match
+
+    A rule is only merged into an earlier one if all the rules of the chain in between have the same terminal action :
+    moving it up then cannot change the verdict for any packet. Until a rule with an other action comes, any rule can
+    still be merged into the first one of the chain, which is why the merged rules are only returned at the end.
+
+    :param rules: iterable of (ip version, rule), in order
+    :return: the merged list of (ip version, rule)
+    """
+    merged = []
+    candidates = {}
+
+    for version, rule in rules:
+        action, chain_candidates = candidates.get((version, rule.chain), (None, {}))
+        if rule.action not in TERMINAL_ACTIONS or rule.action != action:
+            chain_candidates = {}
+        candidates[(version, rule.chain)] = (rule.action, chain_candidates)
+
+        for sport in _split_ports(rule.sport):
+            key = (rule.interface, rule.protocol, str(rule.source), str(rule.destination), rule.source_set,
+                   rule.destination_set, rule.remote, rule.notrack, sport)
+
+            for dport in rule.dport.split(",") if rule.dport is not None else [None]:
+                target = chain_candidates.get(key) if dport is not None else None
+
+                if target is None or _port_slots(target.dport.split(",") + [dport]) > MULTIPORT_LIMIT:
+                    target = copy(rule)
+                    target.sport = sport
+                    target.dport = dport
+                    merged.append((version, target))
+                    if dport is not None:
+                        chain_candidates[key] = target
                     continue
 
-            rule = IptablesRule(
-                name=config.name,
-                interface=config.get("interface"),
-                chain=config.get("chain"),
-                protocol=config.get("protocol"),
-                action=config.get("action"),
-                source=source,
-                destination=destination,
-                sport=config.get("sport"),
-                dport=config.get("dport"),
-                remote=config.get("remote", None)
-            )
+                if dport not in target.dport.split(","):
+                    target.dport += "," + dport
+                if rule.name not in target.name.split(", "):
+                    target.name += ", " + rule.name
 
-            if config.getboolean("ipv4", False) and (rule.source is None or rule.source.version == 4) and \
-                    (rule.destination is None or rule.source.version == 4):
-                ipv4_handler.add_rule(rule)
-            if config.getboolean("ipv6") and (rule.source is None or rule.source.version == 6) and \
-                    (rule.destination is None or rule.source.version == 6):
-                ipv6_handler.add_rule(rule)
-
-            if (rule.source is not None and rule.destination is not None) and \
-                    rule.destination.version != rule.source.version:
-                print("[ERROR] Could not add rule with ip versions no matching: {} and {}".format(
-                    str(rule.source, rule.destination)
+    return merged
+
+
+def add_rules(rules: list, versions: tuple=(4, 6)) -> None:
+    """
+    Adds rules to the handlers
+
+    :param rules: list of (ip version, rule)
+    :param versions: the ip versions for which to add the rules
+    """
+    for handler, version in _handlers(versions):
+        for rule in [rule for rule_version, rule in rules if rule_version == version]:
+            handler.add_rule(rule)
+
+
+def collect_rules(parser: ConfigParser) -> list:
+    """
+    Computes the rules for all services of the configuration. Rules of different services are merged when possible
+
+    The rules of the services are generated one at a time while they are merged : only the merged rules are kept.
+
+    :param parser: the configuration
+    :return: list of (ip version, rule)
+    """
+    def rules():
+        """ Generates the rules of every service, in order """
+        for section in parser.sections():
+            if section in RESERVED_SECTIONS:
+                continue
+
+            print(section)
+            yield from service_rules(parser[section])
+
+    return merge_ports(rules())
+
+
+def reorder(versions: tuple=(4, 6)) -> None:
+    """
+    Moves the rules matching the most packets in the live rulesets first, where this cannot change any verdict
+
+    :param versions: the ip versions for which to reorder the rules
+    :raise subprocess.CalledProcessError if the live rulesets cannot be read
+    """
+    for handler, version in _handlers(versions):
+        if not handler.pending:
+            continue
+
+        packets, before, after = handler.ruleset.reorder(hit_counters(handler.save(counters=True)))
+        if packets:
+            print("[INFO] ipv{}: average rule depth of matched packets {:.2f} -> {:.2f}".format(
+                version, before / packets, after / packets
+            ))
+        else:
+            print("[INFO] ipv{}: no packet matched the live rules, keeping the configuration order".format(version))
+
+
+def _label(rule) -> str:
+    """
+    Names a rule in a message
+
+    :param rule: the rule
+    :return: the comment of the rule, or its specification if it has none
+    """
+    return '"{}"'.format(rule.comment) if rule.comment else "'{}'".format(rule.spec())
+
+
+def analyze(prune: bool=False, versions: tuple=(4, 6)) -> None:
+    """
+    Warns about the rules that never match a packet, because an other rule matches all of them first, and about the
+    rules that could be merged
+
+    :param prune: whether to remove the rules that never match a packet
+    :param versions: the ip versions for which to analyze the rules
+    """
+    for handler, version in _handlers(versions):
+        findings = handler.ruleset.analyze(prune)
+        for table, kind, chain, rules, cause in findings:
+            if kind == "mergeable":
+                print("[WARNING] ipv{}: {} rules of {}/{} only differ by an address and could be merged into {} : {}"
+                      .format(version, len(rules), table, chain, cause, ", ".join(_label(rule) for rule in rules)))
+            else:
+                print("[WARNING] ipv{}: {} rule in {}/{} : {} is covered by {}".format(
+                    version, kind, table, chain, _label(rules[0]), _label(cause)
                 ))
+
+        pruned = sum(1 for finding in findings if finding[1] != "mergeable")
+        if prune and pruned:
+            print("[INFO] ipv{}: removed {} rules never matching a packet".format(version, pruned))
+
+
+def dispatch(min_rules: int, versions: tuple=(4, 6)) -> None:
+    """
+    Groups the rules in generated chains by interface, protocol and destination port range
+
+    :param min_rules: the minimum number of rules needed to create a chain for a group
+    :param versions: the ip versions for which to group the rules
+    """
+    for handler, _ in _handlers(versions):
+        handler.ruleset.dispatch(min_rules)
+
+
+def compiled() -> dict:
+    """
+    Gets the rules built but not yet committed, to be able to load them again later
+
+    :return: a dictionary with the "rulesets" (ip version -> Ruleset), the "ipsets" they use and the sets to keep up
+             to date ("tracked")
+    """
+    return {
+        "rulesets": {version: handler.ruleset for handler, version in _handlers((4, 6)) if handler.pending},
+        "ipsets": OrderedDict(ipset_handler.sets),
+        "tracked": OrderedDict(tracked),
+    }
+
+
+def load_compiled(rules: dict) -> None:
+    """
+    Loads rules previously given by compiled(), to commit them without building them again
+
+    :param rules: the rules, as given by compiled(), or by RulesetCache.load with iptables-restore dumps as rulesets
+    """
+    for handler, version in _handlers((4, 6)):
+        if version in rules["rulesets"]:
+            ruleset = rules["rulesets"][version]
+            handler.ruleset = Ruleset.parse(ruleset) if isinstance(ruleset, str) else ruleset
+    ipset_handler.sets = OrderedDict(rules["ipsets"])
+    tracked.update(rules["tracked"])
+
+
+def commit(atomic: bool=False, versions: tuple=(4, 6)) -> None:
+    """
+    Applies all the rules the handlers have not yet sent to the kernel
+
+    :param atomic: if True, snapshots the current rulesets first, to be able to rollback to them
+    :param versions: the ip versions for which to commit the rules
+    :raise subprocess.CalledProcessError if a commit fails
+    """
+    handlers = [(handler, version) for handler, version in _handlers(versions) if handler.pending]
+
+    if atomic:
+        for handler, _ in handlers:
+            handler.snapshot()
+
+    ipset_handler.commit()
+
+    for handler, version in handlers:
+        stats.count_rules(version, handler.ruleset)
+        handler.commit()
+
+
+def rollback() -> None:
+    """ Restores the rulesets saved before the last atomic commit """
+    for handler, _ in _handlers((4, 6)):
+        handler.rollback()
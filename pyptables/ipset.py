@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Ipset proxy, to match big lists of addresses in a single rule
+"""
+
+from collections import OrderedDict
+from ipaddress import IPv4Address, IPv6Address
+from threading import Lock
+import hashlib
+import subprocess
+
+from pyptables.stats import stats
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class Ipset:
+    """
+    An ipset proxy, which buffers the sets to define and loads them all at once with ipset restore
+
+    Sets already in the kernel are replaced atomically by swapping them with a new one, so that rules using them always
+    match against a complete set. Sets with a timeout are filled by rules instead, and are kept as they are.
+    """
+    PREFIX = "pyptables-"
+    DYNAMIC_SIZE = 1048576
+
+    def __init__(self):
+        self.lock = Lock()
+        self.sets = OrderedDict()
+        self.defined = set()
+        self.loaded = {}
+
+    @property
+    def command(self) -> str:
+        """ The name of the command line to call """
+        return "ipset"
+
+    @property
+    def pending(self) -> bool:
+        """ Whether some sets are waiting for a commit """
+        return bool(self.sets)
+
+    def name(self, service: str, direction: str, version: int, set_type: str) -> str:
+        """
+        Gets the name of a set. The same set of a service always gets the same name
+
+        :param service: the name of the service using the set
+        :param direction: "src" or "dst", depending on the side of the packet the set is matched against
+        :param version: the version of ip protocol of the members (4 or 6)
+        :param set_type: the type of the set, "hash:ip" or "hash:net"
+        :return: the name of the set
+        """
+        return "{}{}-{}{}{}".format(
+            self.PREFIX, hashlib.sha1(service.encode()).hexdigest()[:8], direction[0], set_type[5], version
+        )
+
+    def define(self, service: str, direction: str, version: int, members: list, set_type: str=None,
+               timeout: int=None) -> str:
+        """
+        Defines a set of addresses to use in rules
+
+        :param service: the name of the service using the set
+        :param direction: "src" or "dst", depending on the side of the packet the set is matched against
+        :param version: the version of ip protocol of the members (4 or 6)
+        :param members: the ip addresses and networks in the set
+        :param set_type: the type of the set. By default, hash:ip if all members are addresses, hash:net otherwise
+        :param timeout: if set, the set is filled by rules, and its entries are removed after this many seconds
+        :return: the name of the set
+        """
+        if set_type is None:
+            addresses = all(isinstance(member, (IPv4Address, IPv6Address)) for member in members)
+            set_type = "hash:ip" if addresses else "hash:net"
+        name = self.name(service, direction, version, set_type)
+        # both ip versions are built in parallel, and define their sets in the same handler
+        with self.lock:
+            self.sets[name] = (
+                set_type, "inet" if version == 4 else "inet6", [str(member) for member in members], timeout
+            )
+        return name
+
+    def list(self) -> list:
+        """
+        Lists the sets currently in the kernel
+
+        :raise subprocess.CalledProcessError if ipset fails
+        :return: the names of the sets
+        """
+        try:
+            with stats.call(self.command + " list"):
+                return subprocess.check_output([self.command, "list", "-n"]).decode().split()
+        except FileNotFoundError:
+            raise subprocess.CalledProcessError(127, self.command)
+
+    def members(self) -> dict:
+        """
+        Reads the members of the sets currently in the kernel
+
+        :raise subprocess.CalledProcessError if ipset fails
+        :return: dictionary of set name -> members
+        """
+        try:
+            with stats.call(self.command + " save"):
+                output = subprocess.check_output([self.command, "save"]).decode()
+        except FileNotFoundError:
+            raise subprocess.CalledProcessError(127, self.command)
+
+        sets = {}
+        for line in output.splitlines():
+            fields = line.split()
+            if fields and fields[0] == "create":
+                sets[fields[1]] = []
+            elif fields and fields[0] == "add":
+                sets.setdefault(fields[1], []).append(fields[2])
+        return sets
+
+    def dump(self, existing: list) -> str:
+        """
+        Formats the sets in ipset restore format
+
+        :param existing: the names of the sets already in the kernel
+        :return: the commands to give to ipset restore
+        """
+        lines = []
+        for name, (set_type, family, members, timeout) in self.sets.items():
+            if timeout is not None:
+                if name not in existing:
+                    lines.append("create {} {} family {} timeout {} maxelem {}".format(
+                        name, set_type, family, timeout, self.DYNAMIC_SIZE
+                    ))
+                continue
+
+            target = name + "-new" if name in existing else name
+            if target in existing:
+                lines.append("destroy " + target)
+            lines.append("create {} {} family {} maxelem {}".format(target, set_type, family, max(65536, len(members))))
+            lines.extend("add {} {}".format(target, member) for member in members)
+            if target != name:
+                lines.append("swap {} {}".format(target, name))
+                lines.append("destroy " + target)
+        return "\n".join(lines) + "\n"
+
+    def restore(self, commands: str) -> None:
+        """
+        Runs the commands with ipset restore
+
+        :param commands: the commands to run
+        :raise subprocess.CalledProcessError if ipset fails
+        """
+        try:
+            process = subprocess.Popen([self.command, "restore"], stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            raise subprocess.CalledProcessError(127, self.command)
+
+        with stats.call(self.command + " restore"):
+            process.communicate(commands.encode())
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, self.command)
+
+    def commit(self) -> None:
+        """
+        Loads all the defined sets in the kernel
+
+        :raise subprocess.CalledProcessError if ipset fails
+        """
+        if not self.pending:
+            return
+
+        self.restore(self.dump(self.list()))
+        self.defined.update(self.sets)
+        self.loaded.update((name, members) for name, (_, _, members, _) in self.sets.items())
+        self.sets = OrderedDict()
+
+    def cleanup(self) -> None:
+        """
+        Destroys the sets left by previous runs that are not used anymore, even when this run defines none. Sets still
+        referenced by rules are kept
+        """
+        try:
+            existing = self.list()
+        except subprocess.CalledProcessError:
+            # like destroying them, removing the old sets is best effort : without ipset, there are none anyway
+            return
+
+        for name in existing:
+            if name.startswith(self.PREFIX) and name not in self.defined:
+                subprocess.call([self.command, "destroy", name], stderr=subprocess.DEVNULL)
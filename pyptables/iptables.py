@@ -7,9 +7,12 @@ Iptables proxies to access basic iptables commands
 
 from configparser import SectionProxy
 from contextlib import suppress
-import socket
 import subprocess
 
+from pyptables.dns import resolver
+from pyptables.ruleset import Rule, Ruleset
+from pyptables.stats import stats
+
 
 __author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
 
@@ -18,9 +21,14 @@ class IptablesRule:
     """
     Container defining an Iptables rule
     """
+    __slots__ = (
+        "name", "chain", "action", "protocol", "interface", "source", "destination", "sport", "dport", "remote",
+        "source_set", "destination_set", "notrack",
+    )
+
     def __init__(self, name, chain, action, protocol=None, interface=None, source=None, destination=None, sport=None,
-                 dport=None, remote=None):
-        if protocol == interface == source == destination == sport == dport is None:
+                 dport=None, remote=None, source_set=None, destination_set=None, notrack=False):
+        if protocol == interface == source == destination == sport == dport == source_set == destination_set is None:
             raise ValueError(
                 "Section {}: At least one of protocol, interface, source, destination,"
                 "sport, dport must be non null".format(name)
@@ -35,50 +43,161 @@ class IptablesRule:
         self.sport = sport
         self.dport = dport
         self.remote = remote
+        self.source_set = source_set
+        self.destination_set = destination_set
+        self.notrack = notrack
 
 
 class Iptables:
     """
     An Iptable proxy for ipv4
+
+    Rules are first recorded in a ruleset, and only applied on commit, with one iptables call per command
     """
+    TABLES = ["filter", "nat", "mangle", "raw"]
+
+    saved = None
+
+    def __init__(self):
+        self.ruleset = Ruleset()
+
     @property
     def command(self) -> str:
         """ The name of the command line to call """
         return "iptables"
 
+    @property
+    def save_command(self) -> str:
+        """ The name of the command line used to dump the current ruleset """
+        return "iptables-save"
+
+    @property
+    def restore_command(self) -> str:
+        """ The name of the command line used to load a ruleset """
+        return "iptables-restore"
+
+    @property
+    def pending(self) -> bool:
+        """ Whether some rules are waiting for a commit """
+        return bool(self.ruleset.tables)
+
     def execute(self, command: str) -> None:
         """
         Executes a command
 
         :param command: the command to execute
         """
-        subprocess.check_call("{} {}".format(self.command, command), shell=True)
+        with stats.call(self.command):
+            subprocess.check_call("{} {}".format(self.command, command), shell=True)
 
-    def reset(self) -> None:
-        """ Resets all tables to default values """
-        for command in [
-            "-F", "-X",
-            "-t nat -F", "-t nat -X",
-            "-t mangle -F", "-t mangle -X",
-            "-P INPUT ACCEPT",
-            "-P OUTPUT ACCEPT",
-            "-P FORWARD ACCEPT"
-        ]:
+    def restore(self, ruleset, noflush: bool=False) -> None:
+        """
+        Loads a ruleset in iptables-restore format in the kernel
+
+        The ruleset can be given as lines, written to iptables-restore as they are generated, so that the whole ruleset
+        is never formatted in memory at once.
+
+        :param ruleset: the ruleset to load, as a string or an iterable of lines
+        :param noflush: if True, the rules are applied on top of the existing tables instead of replacing them
+        :raise subprocess.CalledProcessError if iptables-restore fails
+        """
+        try:
+            process = subprocess.Popen([self.restore_command] + (["--noflush"] if noflush else []),
+                                       stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            raise subprocess.CalledProcessError(127, self.restore_command)
+
+        with stats.call(self.restore_command):
+            # iptables-restore stops reading on the first error, which its return code reports
+            with suppress(BrokenPipeError):
+                for line in [ruleset] if isinstance(ruleset, str) else ruleset:
+                    process.stdin.write(line.encode())
+                process.stdin.close()
+            process.wait()
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, self.restore_command)
+
+    def save(self, counters: bool=False) -> str:
+        """
+        Dumps the ruleset currently in the kernel
+
+        :param counters: whether to include the packet and byte counters of each rule
+        :raise subprocess.CalledProcessError if iptables-save fails
+        :return: the ruleset in iptables-save format
+        """
+        try:
+            with stats.call(self.save_command):
+                return subprocess.check_output([self.save_command] + (["-c"] if counters else [])).decode()
+        except FileNotFoundError:
+            raise subprocess.CalledProcessError(127, self.save_command)
+
+    def snapshot(self) -> None:
+        """
+        Saves the ruleset currently in the kernel, to be able to rollback to it
+
+        :raise subprocess.CalledProcessError if iptables-save fails
+        """
+        self.saved = self.save()
+
+    def rollback(self) -> None:
+        """ Restores the ruleset saved by the last snapshot, if any """
+        if self.saved is not None:
+            self.restore(self.saved)
+
+    def commit(self) -> None:
+        """
+        Applies the recorded ruleset, one command at a time
+
+        :raise subprocess.CalledProcessError if a command fails
+        """
+        for command in self.ruleset.commands():
             self.execute(command)
+        self.ruleset = Ruleset()
+
+    def append(self, rule: Rule) -> None:
+        """
+        Records a rule, at the end of its chain
 
-    def set_default(self, chain: str, action: str) -> None:
+        :param rule: the rule to add
+        """
+        self.ruleset.table(rule.table).add_rule(rule)
+
+    def reset(self) -> None:
+        """
+        Resets all tables to default values
+
+        The chains of the raw table see every packet before connection tracking, so their policies are always set back
+        to ACCEPT : only rules skipping connection tracking are ever added there.
+        """
+        for table in self.TABLES:
+            self.ruleset.table(table)
+        for chain in ["INPUT", "OUTPUT", "FORWARD"]:
+            self.set_default(chain, "ACCEPT")
+        for chain in ["PREROUTING", "OUTPUT"]:
+            self.set_default(chain, "ACCEPT", "raw")
+
+    def set_default(self, chain: str, action: str, table: str="filter") -> None:
         """
         Sets default action for given chain
 
         :param chain: the chain to use
         :param action: the default action
+        :param table: the table of the chain
+        """
+        self.ruleset.table(table).policies[chain] = action
+
+    def new_chain(self, chain: str) -> None:
         """
-        self.execute("-P {} {}".format(chain, action))
+        Creates a new user-defined chain
+
+        :param chain: the name of the chain
+        """
+        self.ruleset.table("filter").add_chain(chain)
 
     def allow_existing_traffic(self) -> None:
         """ Allow all already established or related traffic """
-        self.execute('-A INPUT -m conntrack --ctstate RELATED,ESTABLISHED'
-                     ' -m comment --comment "Allow already authenticated traffic" -j ACCEPT')
+        self.append(Rule("INPUT", "ACCEPT", matches="-m conntrack --ctstate RELATED,ESTABLISHED",
+                         comment="Allow already authenticated traffic"))
 
     def allow_traffic_on_interface(self, interface: str) -> None:
         """
@@ -86,13 +205,11 @@ class Iptables:
 
         :param interface: the interface to use
         """
-        self.execute('-A INPUT -i {} -m comment --comment "Allow traffic on {}" -j ACCEPT'.format(
-            interface, interface
-        ))
+        self.append(Rule("INPUT", "ACCEPT", interface=interface, comment="Allow traffic on {}".format(interface)))
 
     def drop_invalid_traffic(self) -> None:
         """ Drops all invalid traffic """
-        self.execute('-A INPUT -m conntrack --ctstate INVALID -m comment --comment "Drop invalid traffic" -j DROP')
+        self.append(Rule("INPUT", "DROP", matches="-m conntrack --ctstate INVALID", comment="Drop invalid traffic"))
 
     def add_rule(self, rule: IptablesRule) -> None:
         """
@@ -100,58 +217,106 @@ class Iptables:
 
         :param rule: the specification of the rule to add
         """
-        command = "-A " + rule.chain
-        if rule.protocol:
-            command += " -m {proto} -p {proto}".format(proto=rule.protocol)
-
-        if rule.interface:
-            command += " -i " + rule.interface
-
-        if rule.destination:
-            command += " --dst " + str(rule.destination)
-
-        if rule.source:
-            command += " --src " + str(rule.source)
-
-        if rule.sport:
-            command += " --sport " + rule.sport
-
-        if rule.dport:
-            command += " --dport " + rule.dport
-
-        default_hostname = rule.source
-        with suppress(socket.herror, socket.gaierror):
-            default_hostname = socket.gethostbyaddr(str(default_hostname))[0]
-
+        comment = None
         if rule.chain == "INPUT":
-            command += ' -m comment --comment "{action} {hostname} to connect to {service}{interface}"'.format(
+            comment = "{action} {hostname} to connect to {service}{interface}".format(
                 action="Allow" if rule.action == "ACCEPT" else "Disallow",
-                hostname="Anyone" if not rule.source else rule.remote if rule.remote is not None
-                else default_hostname,
+                hostname="Anyone" if not rule.source and not rule.source_set else rule.remote if rule.remote is not None
+                else rule.source_set or resolver.reverse(str(rule.source)) or rule.source,
                 service=rule.name,
                 interface=" on {}".format(rule.interface) if rule.interface else ""
             )
         elif rule.chain == "OUTPUT":
-            command += ' -m comment --comment "{action} to connect to {service} on {hostname}{interface}"'.format(
+            comment = "{action} to connect to {service} on {hostname}{interface}".format(
                 action="Allow" if rule.action == "ACCEPT" else "Disallow",
-                hostname="Anyone" if not rule.destination else rule.remote if rule.remote is not None
-                else socket.gethostbyaddr(str(rule.destination))[0],
+                hostname="Anyone" if not rule.destination and not rule.destination_set else rule.remote
+                if rule.remote is not None else rule.destination_set or resolver.reverse(str(rule.destination))
+                or rule.destination,
                 service=rule.name,
                 interface=" on {}".format(rule.interface) if rule.interface else ""
             )
-        else:
-            print("[ERROR] Could not generate help message automatically for {}".format(command + " -j " + rule.action))
 
-        command += " -j " + rule.action
+        compiled = Rule(
+            rule.chain, rule.action, protocol=rule.protocol, interface=rule.interface,
+            source=str(rule.source) if rule.source else None,
+            destination=str(rule.destination) if rule.destination else None,
+            sport=rule.sport, dport=rule.dport, source_set=rule.source_set, destination_set=rule.destination_set,
+            comment=comment
+        )
+
+        if comment is None:
+            print("[ERROR] Could not generate help message automatically for {}".format(compiled.spec()))
+
+        self.append(compiled)
+        if rule.notrack:
+            self.no_track(compiled, rule.name)
 
-        self.execute(command)
+    def no_track(self, rule: Rule, service: str) -> None:
+        """
+        Keeps the packets of an accepted rule, and their replies, out of connection tracking
+
+        The packets are marked in the raw table, before connection tracking. As untracked replies are not
+        ESTABLISHED, they are accepted by a rule of their own, matching the addresses and ports of the rule swapped.
+        Incoming packets are only left untracked when they are addressed to the host, so that forwarded or DNATed
+        packets to the same ports keep being tracked.
 
-    def enable_ssh_knocking(self, config: SectionProxy) -> None:
+        :param rule: the rule accepting the traffic
+        :param service: the name of the service
+        """
+        if rule.action != "ACCEPT" or rule.chain not in ["INPUT", "OUTPUT", "FORWARD"]:
+            print("[WARNING] {}: notrack only applies to ACCEPT rules of INPUT, OUTPUT and FORWARD, ignoring it".format(
+                service
+            ))
+            return
+
+        reply = {"INPUT": "OUTPUT", "OUTPUT": "INPUT", "FORWARD": "FORWARD"}[rule.chain]
+        local = "-m addrtype --dst-type LOCAL"
+        fields = dict(
+            protocol=rule.protocol, source=rule.source, destination=rule.destination, sport=rule.sport,
+            dport=rule.dport, source_set=rule.source_set, destination_set=rule.destination_set
+        )
+        swapped = dict(
+            protocol=rule.protocol, source=rule.destination, destination=rule.source, sport=rule.dport,
+            dport=rule.sport, source_set=rule.destination_set, destination_set=rule.source_set
+        )
+
+        self.append(Rule(
+            "OUTPUT" if rule.chain == "OUTPUT" else "PREROUTING", "CT", options="--notrack", table="raw",
+            interface=rule.interface if rule.chain != "OUTPUT" else None,
+            matches=local if rule.chain == "INPUT" else None,
+            comment="Do not track connections to {}".format(service), **fields
+        ))
+        self.append(Rule(
+            "OUTPUT" if reply == "OUTPUT" else "PREROUTING", "CT", options="--notrack", table="raw",
+            matches=local if reply == "INPUT" else None, comment="Do not track replies of {}".format(service), **swapped
+        ))
+        self.append(Rule(reply, "ACCEPT", comment="Allow untracked replies of {}".format(service), **swapped))
+
+    def enable_ssh_knocking(self, config: SectionProxy, sets: list=None) -> None:
         """
         enables iptables-only ssh knocking
 
+        Each step of the sequence is remembered in a recent list (SSH0, SSH1...), or in an ipset with a timeout when
+        sets are given. Recent lists are scanned linearly, while a set is a single hash lookup whatever the number of
+        addresses knocking, which keeps the cost of a packet the same under a scan.
+
         :param config: the configuration to use for the knocking
+        :param sets: the ipsets remembering the addresses at each step of the sequence, None to use recent lists
         """
+        def step(number: int, seconds: str=None) -> dict:
+            """
+            Gets the matches checking that the connecting ip went through the given step
+
+            :param number: the number of the step
+            :param seconds: if set, the step must have been reached in the last seconds. Sets expire by themselves
+            :return: the keyword arguments of the rule to check it
+            """
+            if sets is None:
+                return {"matches": "-m state --state NEW -m recent --rcheck {}--name SSH{}".format(
+                    "--seconds {} ".format(seconds) if seconds else "", number
+                )}
+            return {"matches": "-m state --state NEW", "source_set": sets[number]}
+
         def allow_ssh_temporarily(_config: SectionProxy) -> None:
             """
             Allows ssh temporarily
@@ -160,33 +325,44 @@ class Iptables:
             """
             number_of_required_chains = len(_config.getlist("ports"))
 
-            for i in range(1, number_of_required_chains):
-                self.execute("-N SSH-KNOCKING-{}".format(i))
+            for i in range(0 if sets else 1, number_of_required_chains):
+                self.new_chain("SSH-KNOCKING-{}".format(i))
 
-            command = "-A INPUT -m state --state NEW -m tcp -p tcp"
-
-            if _config.get("interface", None):
-                command += " -i " + _config.get("interface")
-
-            command += " --dport " + _config.get("ssh_port", "22")
-            command += " -m recent --rcheck --seconds " + _config.get("timeout", 30)
-            command += " --name SSH{}".format(len(_config.getlist("ports")) - 1)
-            command += \
-                ' -m comment --comment "Allow port {} for ssh for {} if the connecting ip is in the list SSH{}"'.format(
-                    _config.get("ssh_port", "22"), _config.get("timeout", 30), len(_config.getlist("ports")) - 1
-                )
-
-            self.execute(command)
+            last = len(_config.getlist("ports")) - 1
+            self.append(Rule(
+                "INPUT", "ACCEPT", protocol="tcp", interface=_config.get("interface", None),
+                dport=_config.get("ssh_port", "22"),
+                comment="Allow port {} for ssh for {} if the connecting ip is in the list {}".format(
+                    _config.get("ssh_port", "22"), _config.get("timeout", "30"),
+                    "SSH{}".format(last) if sets is None else sets[last]
+                ), **step(last, _config.get("timeout", "30"))
+            ))
 
         def remove_from_list(entry_number: int) -> None:
             """
-            Removes the ip from the list given by the number
+            Removes the ip from the list given by the number, dropping the packet
 
             :param entry_number: the number for which to remove the list
             """
-            command = "-A INPUT -m state --state NEW -m tcp -p tcp -m recent --name SSH{} --remove".format(entry_number)
-            command += ' -j DROP -m comment --comment "Remove connecting ip from the SSH{} list"'.format(entry_number)
-            self.execute(command)
+            if sets is None:
+                self.append(Rule(
+                    "INPUT", "DROP", protocol="tcp",
+                    matches="-m state --state NEW -m recent --name SSH{} --remove".format(entry_number),
+                    comment="Remove connecting ip from the SSH{} list".format(entry_number)
+                ))
+            else:
+                # the address is not in the set anymore after --del-set : the drop happens in a chain of its own
+                chain = "SSH-REMOVE-{}".format(entry_number)
+                self.new_chain(chain)
+                self.append(Rule(
+                    "INPUT", chain, protocol="tcp",
+                    comment="Remove connecting ip from the {} set".format(sets[entry_number]), **step(entry_number)
+                ))
+                self.append(Rule(
+                    chain, "SET", options="--del-set {} src".format(sets[entry_number]),
+                    comment="Remove connecting ip from the {} set".format(sets[entry_number])
+                ))
+                self.append(Rule(chain, "DROP", comment="Drop the wrong knock"))
 
         def enable_jump(_port: int, entry_number: int) -> None:
             """
@@ -195,14 +371,10 @@ class Iptables:
             :param _port: the port on which to enable the jump
             :param entry_number: the number of the entry to which to jump
             """
-            command = "-A INPUT -m state --state NEW -m tcp -p tcp --dport {} -m recent --rcheck --name SSH{}".format(
-                _port, entry_number - 1
-            )
-            command += ' -j SSH-KNOCKING-{} -m comment --comment "Checks for the sequence and jumps if correct"'.format(
-                entry_number
-            )
-
-            self.execute(command)
+            self.append(Rule(
+                "INPUT", "SSH-KNOCKING-{}".format(entry_number), protocol="tcp", dport=str(_port),
+                comment="Checks for the sequence and jumps if correct", **step(entry_number - 1)
+            ))
 
         def initiate_knocking(_port: int) -> None:
             """
@@ -210,20 +382,36 @@ class Iptables:
 
             :param _port: the port on which to knock
             """
-            command = "-A INPUT -m state --state NEW -m tcp -p tcp --dport {} -m recent --name SSH0 --set".format(_port)
-            command += ' -j DROP -m comment --comment "Sequence initiation for port knocking"'
-            self.execute(command)
+            if sets is None:
+                self.append(Rule(
+                    "INPUT", "DROP", protocol="tcp", dport=str(_port),
+                    matches="-m state --state NEW -m recent --name SSH0 --set",
+                    comment="Sequence initiation for port knocking"
+                ))
+            else:
+                self.append(Rule(
+                    "INPUT", "SSH-KNOCKING-0", protocol="tcp", dport=str(_port), matches="-m state --state NEW",
+                    comment="Sequence initiation for port knocking"
+                ))
 
         def hide_port(number: int) -> None:
             """
-            Hides the port given by the number by dropping it
+            Hides the port given by the number by dropping it, once the connecting ip is added to the list of the step
 
             :param number: the number of the chain on which to drop
             """
-            command = "-A INPUT -m recent --name SSH{} --set -j DROP -m comment".format(number)
-            command += '--comment "Disguise successful knock as a closed port for obfuscation"'
-
-            self.execute(command)
+            chain = "SSH-KNOCKING-{}".format(number)
+            if sets is None:
+                self.append(Rule(
+                    chain, "DROP", matches="-m recent --name SSH{} --set".format(number),
+                    comment="Disguise successful knock as a closed port for obfuscation"
+                ))
+            else:
+                self.append(Rule(
+                    chain, "SET", options="--add-set {} src --exist".format(sets[number]),
+                    comment="Add connecting ip to the {} set".format(sets[number])
+                ))
+                self.append(Rule(chain, "DROP", comment="Disguise successful knock as a closed port for obfuscation"))
 
         # noinspection PyTypeChecker
         allow_ssh_temporarily(config)
@@ -237,10 +425,11 @@ class Iptables:
             else:
                 initiate_knocking(port)
 
-        for entry in range(len(ports) - 1):
+        for entry in range(0 if sets else 1, len(ports)):
             hide_port(entry)
 
-    def no_log(self, chain, service, interface=None, proto=None, source=None, destination=None, sport=None, dport=None):
+    def no_log(self, chain, service, interface=None, proto=None, source=None, destination=None, sport=None, dport=None,
+               action="DROP", source_set=None):
         """
         Creates an entry to not log the given chain
 
@@ -252,31 +441,15 @@ class Iptables:
         :param destination: destination ip addresses7network
         :param sport: source port
         :param dport: destination port
+        :param action: the verdict for the matching packets, which then never reach the logging rule
+        :param source_set: the ipset of the sources, instead of a single source
         """
-        command = "-A " + chain
-
-        if interface is not None:
-            command += " -i " + interface
-
-        if proto is not None:
-            command += " -m {proto} -p {proto}".format(proto=proto)
-
-        if source is not None:
-            command += " --src " + source
-
-        if destination is not None:
-            command += " --dst " + destination
-
-        if sport is not None:
-            command += " --sport " + sport
-
-        if dport is not None:
-            command += " --dport " + dport
-
-        if service is not None:
-            command += ' -m comment --comment "Drop {} before logging"'.format(service)
-
-        self.execute(command)
+        self.append(Rule(
+            chain, action, protocol=proto, interface=interface, source=str(source) if source else None,
+            destination=str(destination) if destination else None, sport=sport, dport=dport, source_set=source_set,
+            comment="{} {} before logging".format("Drop" if action == "DROP" else "Accept", service)
+            if service is not None else None
+        ))
 
     def log(self, chain: str, prefix: str=None, rate: str=None, level: int=None) -> None:
         """
@@ -287,37 +460,98 @@ class Iptables:
         :param rate: rate limiting for logging
         :param level: log level to be used
         """
-        command = "-A " + chain
-        command += ' -m comment --comment "Log remaining traffic" -j LOG'
-
+        options = []
         if prefix is not None:
-            command += ' --log-prefix "{}"'.format(prefix)
+            options.append('--log-prefix "{}"'.format(prefix))
 
         if level is not None:
-            command += " --log-level " + str(level)
-
-        if rate is not None:
-            command += " -m limit --limit " + rate
+            options.append("--log-level " + str(level))
 
-        self.execute(command)
+        self.append(Rule(
+            chain, "LOG", matches="-m limit --limit " + rate if rate is not None else None,
+            comment="Log remaining traffic", options=" ".join(options) or None
+        ))
 
 
 class Ip6tables(Iptables):
     """
     An Iptables proxy for ipv6
     """
+    TABLES = ["filter", "mangle", "raw"]
+
     @property
     def command(self) -> str:
         """ the command to run for ipv6 """
         return "ip6tables"
 
-    def reset(self) -> None:
-        """ the commands to run for ipv6 on reset"""
-        for command in [
-            "-F", "-X",
-            "-t mangle -F", "-t mangle -X",
-            "-P INPUT ACCEPT",
-            "-P OUTPUT ACCEPT",
-            "-P FORWARD ACCEPT"
-        ]:
-            self.execute(command)
+    @property
+    def save_command(self) -> str:
+        """ the command to dump the ipv6 ruleset """
+        return "ip6tables-save"
+
+    @property
+    def restore_command(self) -> str:
+        """ the command to load an ipv6 ruleset """
+        return "ip6tables-restore"
+
+
+class IptablesRestore(Iptables):
+    """
+    An Iptables proxy for ipv4 which applies the whole ruleset at once through iptables-restore
+    """
+    def commit(self) -> None:
+        """
+        Loads the whole ruleset in the kernel with a single call to iptables-restore
+
+        :raise subprocess.CalledProcessError if iptables-restore fails
+        """
+        if not self.pending:
+            return
+
+        self.restore(self.ruleset.lines())
+        self.ruleset = Ruleset()
+
+
+class Ip6tablesRestore(IptablesRestore, Ip6tables):
+    """
+    An Iptables proxy for ipv6 which applies the whole ruleset at once through ip6tables-restore
+    """
+
+
+class IptablesDiff(IptablesRestore):
+    """
+    An Iptables proxy for ipv4 which only applies the differences between the recorded rules and the live ones
+
+    The ruleset applied by the last commit is kept, and used instead of reading the live one for the next commit.
+    """
+    current = None
+
+    def commit(self) -> None:
+        """
+        Compares the ruleset with the one in the kernel, and only deletes and inserts the rules that changed
+
+        :raise subprocess.CalledProcessError if iptables-save or iptables-restore fails
+        """
+        if not self.pending:
+            return
+
+        if self.current is None:
+            self.current = Ruleset.parse(self.save())
+
+        changes = self.ruleset.diff(self.current)
+        self.current = None
+        if changes:
+            self.restore(changes, noflush=True)
+        self.current = self.ruleset
+        self.ruleset = Ruleset()
+
+    def rollback(self) -> None:
+        """ Restores the ruleset saved by the last snapshot, if any. The live ruleset will be read again """
+        self.current = None
+        super().rollback()
+
+
+class Ip6tablesDiff(IptablesDiff, Ip6tables):
+    """
+    An Iptables proxy for ipv6 which only applies the differences between the recorded rules and the live ones
+    """
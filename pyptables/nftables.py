@@ -0,0 +1,775 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Nftables proxies : the rules of both ip versions are loaded in a single inet table, in a single transaction
+"""
+
+from collections import OrderedDict
+from contextlib import suppress
+from difflib import SequenceMatcher
+from ipaddress import collapse_addresses, ip_network
+from itertools import groupby
+import re
+import shlex
+import subprocess
+
+from pyptables.iptables import Iptables, Ip6tables
+from pyptables.ipset import Ipset
+from pyptables.ruleset import BUILTIN_CHAINS, PORT_PROTOCOLS, Ruleset
+from pyptables.stats import stats
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+TABLE = "pyptables"
+
+# type of the base chains of each iptables table, and their priority for each hook
+BASE_CHAINS = {
+    "filter": ("filter", {"INPUT": 0, "FORWARD": 0, "OUTPUT": 0}),
+    "nat": ("nat", {"PREROUTING": -100, "INPUT": 100, "OUTPUT": -100, "POSTROUTING": 100}),
+    "mangle": ("filter", dict.fromkeys(BUILTIN_CHAINS["mangle"], -150)),
+    "raw": ("filter", dict.fromkeys(BUILTIN_CHAINS["raw"], -300)),
+    "security": ("filter", dict.fromkeys(BUILTIN_CHAINS["security"], 50)),
+}
+
+VERDICTS = {"ACCEPT": "accept", "DROP": "drop", "RETURN": "return"}
+
+LOG_LEVELS = ["emerg", "alert", "crit", "err", "warn", "notice", "info", "debug"]
+
+RATE_UNITS = {"s": "second", "m": "minute", "h": "hour", "d": "day"}
+
+# seconds after which the addresses of a recent list are forgotten, when no rule of the ruleset gives any
+RECENT_TIMEOUT = 3600
+
+# nftables refuses longer comments
+MAX_COMMENT_LENGTH = 128
+
+# the fields of a rule that can be matched against a set, in the order of the concatenations
+SELECTORS = ["interface", "protocol", "source", "destination", "sport", "dport"]
+
+
+def chain_name(table: str, chain: str) -> str:
+    """
+    Gets the name in the inet table of a chain of an iptables table
+
+    :param table: the iptables table
+    :param chain: the chain
+    :return: the name of the chain in the inet table
+    """
+    return chain if table == "filter" else "{}-{}".format(table, chain)
+
+
+def _quote(text: str) -> str:
+    """ Formats a string for nft, which does not allow double quotes inside strings """
+    return '"{}"'.format(text.replace('"', "'"))
+
+
+def _comment(comments: list) -> str:
+    """
+    Formats the comment of a rule
+
+    :param comments: the comments of the iptables rules the rule comes from
+    :return: the comment statement, or an empty string if there is no comment
+    """
+    comments = [comment for comment in comments if comment]
+    if not comments:
+        return ""
+    text = comments[0] if len(comments) == 1 else "{} rules : {}".format(len(comments), "; ".join(comments))
+    if len(text) > MAX_COMMENT_LENGTH:
+        text = text[:MAX_COMMENT_LENGTH - 3] + "..."
+    return "comment " + _quote(text)
+
+
+def _values(rule, field: str) -> list:
+    """
+    Gets the values a field of a rule matches, as nft set elements
+
+    :param rule: the rule
+    :param field: one of SELECTORS
+    :return: the values, or None if the rule does not match on this field
+    """
+    value = getattr(rule, field)
+    if value is None:
+        return None
+    if field == "interface":
+        return [_quote(value[:-1] + "*" if value.endswith("+") else value)]
+    if field in ["sport", "dport"]:
+        return [port.replace(":", "-") for port in value.split(",")]
+    return [value]
+
+
+def _selector(field: str, protocol: str, version: int) -> str:
+    """
+    Gets the nft expression for a field of the rules
+
+    :param field: one of SELECTORS
+    :param protocol: the protocol of the rules, if they all have the same
+    :param version: the ip version of the rules
+    :return: the expression
+    """
+    family = "ip" if version == 4 else "ip6"
+    return {
+        "interface": "iifname",
+        "protocol": "meta l4proto",
+        "source": family + " saddr",
+        "destination": family + " daddr",
+        "sport": "{} sport".format(protocol if protocol in PORT_PROTOCOLS else "th"),
+        "dport": "{} dport".format(protocol if protocol in PORT_PROTOCOLS else "th"),
+    }[field]
+
+
+def _element(values: list) -> str:
+    """ Formats a list of values as a single value, or as an anonymous set """
+    return values[0] if len(values) == 1 else "{{ {} }}".format(", ".join(values))
+
+
+def _collapse(field: str, values: list) -> list:
+    """
+    Merges the overlapping values of a set, which nftables refuses in sets of intervals
+
+    :param field: the field the values are matched against
+    :param values: the values, as given by _values
+    :return: the values, without overlaps
+    """
+    if field in ["source", "destination"]:
+        return [str(network) for network in collapse_addresses(ip_network(value, strict=False) for value in values)]
+    if field not in ["sport", "dport"]:
+        return values
+
+    ranges = []
+    for first, last in sorted(tuple(int(port) for port in (value + "-" + value).split("-")[:2]) for value in values):
+        if ranges and first <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], last)
+        else:
+            ranges.append([first, last])
+    return [str(first) if first == last else "{}-{}".format(first, last) for first, last in ranges]
+
+
+def _recent(options: dict, version: int, sets: dict) -> tuple:
+    """
+    Translates a recent match to a dynamic set of addresses
+
+    The timeout of the set is the longest --seconds given for the list : an address is forgotten once it was not seen
+    for this long, instead of being kept and checked against the age of its last hit. Lists never checked with
+    --seconds are given a timeout when the table is formatted, as their sets would otherwise fill up for good.
+
+    :param options: the options of the match
+    :param version: the ip version of the rule
+    :param sets: dictionary of name -> timeout of the dynamic sets, updated with the set of the list
+    :return: (expressions, statements)
+    """
+    name = "{}-ipv{}".format(options.get("--name", ["DEFAULT"])[0], version)
+    timeout = int(options["--seconds"][0]) if "--seconds" in options else None
+    sets[name] = max(sets.get(name) or 0, timeout or 0) or None
+
+    address = "{} {}".format("ip" if version == 4 else "ip6", "daddr" if "--rdest" in options else "saddr")
+    element = "@{} {{ {} }}".format(name, address)
+    if "--set" in options:
+        return [], ["update " + element]
+    if "--update" in options:
+        return ["{} @{}".format(address, name)], ["update " + element]
+    if "--remove" in options:
+        return ["{} @{}".format(address, name)], ["delete " + element]
+    return ["{} @{}".format(address, name)], []
+
+
+def _matches(text: str, version: int, sets: dict) -> tuple:
+    """
+    Translates the iptables matches a rule has no dedicated field for
+
+    :param text: the matches, in iptables format
+    :param version: the ip version of the rule
+    :param sets: dictionary of name -> timeout of the dynamic sets the rule uses, updated by the translation
+    :raise ValueError if a match has no known translation
+    :return: (expressions, statements)
+    """
+    modules = []
+    for token in shlex.split(text):
+        if token == "-m":
+            modules.append([None, OrderedDict()])
+        elif modules and modules[-1][0] is None:
+            modules[-1][0] = token
+        elif token.startswith("-") and modules:
+            modules[-1][1][token] = []
+        elif modules and modules[-1][1]:
+            modules[-1][1][next(reversed(modules[-1][1]))].append(token)
+        else:
+            raise ValueError("Cannot translate '{}' to nftables".format(text))
+
+    expressions, statements = [], []
+    for module, options in modules:
+        if module in ["state", "conntrack"]:
+            states = (options.get("--state") or options.get("--ctstate"))[0]
+            expressions.append("ct state " + states.lower())
+        elif module == "limit":
+            rate = options.get("--limit", ["3/hour"])[0].split("/")
+            statement = "limit rate {}/{}".format(rate[0], RATE_UNITS[rate[1][0]])
+            if "--limit-burst" in options:
+                statement += " burst {} packets".format(options["--limit-burst"][0])
+            expressions.append(statement)
+        elif module == "recent":
+            recent = _recent(options, version, sets)
+            expressions.extend(recent[0])
+            statements.extend(recent[1])
+        elif module == "addrtype" and options.get("--dst-type") == ["LOCAL"]:
+            expressions.append("fib daddr type local")
+        elif module == "set":
+            name, direction = options["--match-set"][:2]
+            expressions.append("{} {}addr @{}".format("ip" if version == 4 else "ip6", direction[0], name))
+        else:
+            raise ValueError("Cannot translate '{}' to nftables".format(text))
+    return expressions, statements
+
+
+def _verdict(rule, table: str) -> str:
+    """
+    Translates the target of a rule
+
+    :param rule: the rule
+    :param table: the iptables table of the rule
+    :raise ValueError if the target has no known translation
+    :return: the verdict or statement
+    """
+    if rule.action is None:
+        return "counter"
+    if rule.action == "LOG":
+        tokens = shlex.split(rule.options or "")
+        statement = "log"
+        if "--log-prefix" in tokens:
+            statement += " prefix " + _quote(tokens[tokens.index("--log-prefix") + 1])
+        if "--log-level" in tokens:
+            level = tokens[tokens.index("--log-level") + 1]
+            statement += " level " + (LOG_LEVELS[int(level)] if level.isdigit() else level)
+        return statement
+    if (rule.action, rule.options) == ("CT", "--notrack"):
+        return "notrack"
+    if rule.options:
+        raise ValueError("Cannot translate the options '{}' of {} to nftables".format(rule.options, rule.action))
+    if rule.action == "REJECT":
+        return "reject"
+    return VERDICTS.get(rule.action) or "jump " + chain_name(table, rule.action)
+
+
+def _set_statement(options: str, version: int) -> str:
+    """
+    Translates the SET target, adding the address of a packet to a set or removing it
+
+    :param options: the options of the target
+    :param version: the ip version of the rule
+    :raise ValueError if the options have no known translation
+    :return: the statement
+    """
+    tokens = shlex.split(options or "")
+    for option, statement in [("--add-set", "update"), ("--del-set", "delete")]:
+        if option in tokens and len(tokens) > tokens.index(option) + 2:
+            name, direction = tokens[tokens.index(option) + 1:tokens.index(option) + 3]
+            return "{} @{} {{ {} {}addr }}".format(statement, name, "ip" if version == 4 else "ip6", direction[0])
+    raise ValueError("Cannot translate the options '{}' of SET to nftables".format(options))
+
+
+def translate(rule, table: str, version: int, sets: dict) -> str:
+    """
+    Translates an iptables rule to a nftables rule
+
+    :param rule: the rule
+    :param table: the iptables table of the rule
+    :param version: the ip version of the rule
+    :param sets: dictionary of name -> timeout of the dynamic sets the rule uses, updated by the translation
+    :raise ValueError if the rule has no known translation
+    :return: the rule, in nft format
+    """
+    parts = []
+    for field in SELECTORS:
+        values = _values(rule, field)
+        implied = field == "protocol" and rule.protocol in PORT_PROTOCOLS and (rule.sport or rule.dport)
+        if values is not None and not implied:
+            parts.append("{} {}".format(_selector(field, rule.protocol, version), _element(values)))
+        if field == "destination":
+            for name, address in [(rule.source_set, "saddr"), (rule.destination_set, "daddr")]:
+                if name is not None:
+                    parts.append("{} {} @{}".format("ip" if version == 4 else "ip6", address, name))
+
+    expressions, statements = _matches(rule.matches, version, sets) if rule.matches else ([], [])
+    verdict = _set_statement(rule.options, version) if rule.action == "SET" else _verdict(rule, table)
+    parts.extend(expressions + statements + [verdict, _comment([rule.comment])])
+    return " ".join(part for part in parts if part)
+
+
+def _groupable(rule) -> bool:
+    """
+    Checks whether a rule can be merged with other rules matching the same fields, into a single rule matching a set
+
+    :param rule: the rule
+    :return: True if the rule only matches fields that can be put in a set, with a verdict
+    """
+    return rule.matches is None and rule.options is None and rule.source_set is None and \
+        rule.destination_set is None and rule.action not in [None, "LOG"] and \
+        not (rule.interface or "").endswith("+") and any(getattr(rule, field) for field in SELECTORS)
+
+
+def _shape(rule) -> tuple:
+    """ Gets the fields a rule matches, rules with the same fields being mergeable """
+    return tuple(field for field in SELECTORS if getattr(rule, field) is not None)
+
+
+def _disjoint(elements: list) -> bool:
+    """
+    Checks whether no packet can match two of the elements of a verdict map
+
+    :param elements: list of (element, verdict)
+    :return: True if the elements are exact values that are all different, or port ranges that do not overlap
+    """
+    keys = [element for element, _ in elements]
+    if len(set(keys)) != len(keys):
+        return False
+    if not any("/" in key or "-" in key.strip('"') for key in keys):
+        return True
+    if all(re.match(r"^\d+(-\d+)?$", key) for key in keys):
+        ranges = sorted(tuple(int(port) for port in (key + "-" + key).split("-")[:2]) for key in keys)
+        return all(previous[1] < following[0] for previous, following in zip(ranges, ranges[1:]))
+    return False
+
+
+def _group(rules: list, table: str, version: int, vmap: bool) -> list:
+    """
+    Merges rules matching the same fields into rules matching sets
+
+    :param rules: the rules, which must have the same shape and commute
+    :param table: the iptables table of the rules
+    :param version: the ip version of the rules
+    :param vmap: whether the rules have different verdicts, and must be merged into a verdict map
+    :return: the merged rules, in nft format, or None if they cannot be merged
+    """
+    fields = _shape(rules[0])
+    protocols = {rule.protocol for rule in rules}
+    protocol = protocols.pop() if len(protocols) == 1 else None
+
+    fixed, keys = [], []
+    for field in fields:
+        values = {tuple(_values(rule, field)) for rule in rules}
+        if len(values) == 1:
+            if not (field == "protocol" and protocol in PORT_PROTOCOLS and {"sport", "dport"} & set(fields)):
+                fixed.append("{} {}".format(_selector(field, protocol, version), _element(list(values.pop()))))
+        else:
+            keys.append(field)
+
+    if not keys:
+        return None
+
+    elements = []
+    for rule in rules:
+        combinations = [[]]
+        for field in keys:
+            combinations = [prefix + [value] for prefix in combinations for value in _values(rule, field)]
+        elements.extend((" . ".join(combination), _verdict(rule, table)) for combination in combinations)
+
+    selector = " . ".join(_selector(field, protocol, version) for field in keys)
+    comment = _comment([rule.comment for rule in rules])
+    if vmap:
+        if not _disjoint(elements) or any(verdict == "reject" for _, verdict in elements):
+            return None
+        entries = ", ".join("{} : {}".format(element, verdict) for element, verdict in elements)
+        return [" ".join(fixed + ["{} vmap {{ {} }}".format(selector, entries), comment]).strip()]
+
+    unique = list(OrderedDict.fromkeys(element for element, _ in elements))
+    if len(keys) == 1:
+        unique = _collapse(keys[0], unique)
+    return [" ".join(fixed + ["{} {{ {} }}".format(selector, ", ".join(unique)), elements[0][1], comment]).strip()]
+
+
+def translate_chain(rules: list, table: str, version: int, sets: dict) -> list:
+    """
+    Translates the rules of a chain, merging the rules that commute and match the same fields into set lookups
+
+    Within a run of movable rules, all the rules matching the same fields become a single rule matching an anonymous
+    set. Elsewhere, consecutive rules matching the same fields are merged when they have the same verdict, or into a
+    verdict map when no packet can match two of them. A packet then needs a single lookup instead of one per rule.
+
+    :param rules: the rules of the chain
+    :param table: the iptables table of the chain
+    :param version: the ip version of the rules
+    :param sets: dictionary of name -> timeout of the dynamic sets the rules use, updated by the translation
+    :return: the rules, in nft format
+    """
+    lines = []
+    position = 0
+    while position < len(rules):
+        rule = rules[position]
+        end = position + 1
+
+        if rule.movable():
+            while end < len(rules) and rules[end].movable():
+                end += 1
+            groups = OrderedDict()
+            for index, member in enumerate(rules[position:end]):
+                groups.setdefault(_shape(member) if _groupable(member) else index, []).append(member)
+            for members in groups.values():
+                merged = _group(members, table, version, False) if len(members) > 1 else None
+                lines.extend(merged or [translate(member, table, version, sets) for member in members])
+
+        elif _groupable(rule):
+            while end < len(rules) and _groupable(rules[end]) and not rules[end].movable() and \
+                    _shape(rules[end]) == _shape(rule):
+                end += 1
+            members = rules[position:end]
+            merged = _group(members, table, version, True) if len({member.action for member in members}) > 1 else None
+            if merged is None:
+                merged = []
+                for _, same in groupby(members, key=lambda member: member.action):
+                    same = list(same)
+                    merged.extend((_group(same, table, version, False) if len(same) > 1 else None) or [
+                        translate(member, table, version, sets) for member in same
+                    ])
+            lines.extend(merged)
+
+        else:
+            lines.append(translate(rule, table, version, sets))
+
+        position = end
+    return lines
+
+
+def _merge(lines4: list, lines6: list) -> list:
+    """
+    Merges the rules of a chain for ipv4 and ipv6 into a single chain of the inet table
+
+    Rules common to both versions are kept once, the others only match packets of their version. The order of the
+    rules of each version is kept.
+
+    :param lines4: the ipv4 rules, in nft format
+    :param lines6: the ipv6 rules, in nft format
+    :return: the rules of the chain
+    """
+    lines = []
+    matcher = SequenceMatcher(None, lines4, lines6, autojunk=False)
+    for tag, start4, end4, start6, end6 in matcher.get_opcodes():
+        if tag == "equal":
+            lines.extend(lines4[start4:end4])
+            continue
+        lines.extend("meta nfproto ipv4 " + line for line in lines4[start4:end4])
+        lines.extend("meta nfproto ipv6 " + line for line in lines6[start6:end6])
+    return lines
+
+
+def _nft(arguments: list, script: str=None) -> str:
+    """
+    Runs nft
+
+    :param arguments: the arguments to give to nft
+    :param script: the commands to give on the standard input
+    :raise subprocess.CalledProcessError if nft fails
+    :return: the output of nft
+    """
+    try:
+        process = subprocess.Popen(["nft"] + arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except FileNotFoundError:
+        raise subprocess.CalledProcessError(127, "nft")
+
+    with stats.call("nft"):
+        output = process.communicate(script.encode() if script is not None else None)[0]
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, "nft " + " ".join(arguments))
+    return output.decode()
+
+
+class NftablesTransaction:
+    """
+    The inet table shared by the proxies of both ip versions
+
+    The rulesets of the proxies are collected on commit, and loaded together once no proxy has pending rules anymore.
+    Chains are flushed and filled again in the same transaction, so that packets never see a partial ruleset, and the
+    named sets, updated separately, are kept.
+    """
+    def __init__(self):
+        self.handlers = []
+        self.staged = {}
+        self.saved = None
+
+    def dump(self, terse: bool=False) -> str:
+        """
+        Lists the inet table in the kernel
+
+        :param terse: whether to leave the elements of the sets out
+        :raise subprocess.CalledProcessError if nft fails
+        :return: the table, in nft format, or an empty string if it does not exist
+        """
+        if TABLE not in _nft(["list", "tables", "inet"]).split():
+            return ""
+        return _nft((["--terse"] if terse else []) + ["list", "table", "inet", TABLE])
+
+    def load(self, script: str) -> None:
+        """
+        Runs nft commands, in a single transaction
+
+        :param script: the commands
+        :raise subprocess.CalledProcessError if nft fails
+        """
+        _nft(["-f", "-"], script)
+
+    def chains(self) -> list:
+        """
+        Lists the chains of the inet table in the kernel
+
+        :raise subprocess.CalledProcessError if nft fails
+        :return: the names of the chains
+        """
+        return re.findall(r"^\s*chain (\S+) {", self.dump(terse=True), re.MULTILINE)
+
+    def script(self) -> str:
+        """
+        Formats the staged rulesets as nft commands replacing the rules of the inet table
+
+        :return: the commands
+        """
+        prefix = "inet " + TABLE
+        declarations, flushes, rules = ["add table " + prefix], [], []
+        sets = OrderedDict()
+        tables = OrderedDict(
+            (name, None) for ruleset in self.staged.values() for name in ruleset.tables
+        )
+
+        for name in tables:
+            family_tables = {
+                version: self.staged[version].tables.get(name) if version in self.staged else None
+                for version in [4, 6]
+            }
+            chains = OrderedDict(
+                (chain, None) for table in family_tables.values() if table is not None for chain in table.rules
+            )
+            chain_type, hooks = BASE_CHAINS.get(name, ("filter", {}))
+
+            for chain in chains:
+                lines = {
+                    version: translate_chain(table.rules.get(chain, []), name, version, sets)
+                    if table is not None else []
+                    for version, table in family_tables.items()
+                }
+                lines = _merge(lines[4], lines[6])
+
+                policies = {
+                    version: table.policies.get(chain, "ACCEPT") if table is not None else "ACCEPT"
+                    for version, table in family_tables.items()
+                }
+                policy = "ACCEPT"
+                if len(set(policies.values())) == 1:
+                    policy = policies.popitem()[1]
+                else:
+                    lines.extend(
+                        "meta nfproto ipv{} {} comment {}".format(
+                            version, VERDICTS[verdict], _quote("Policy of ipv{}".format(version))
+                        ) for version, verdict in sorted(policies.items()) if verdict != "ACCEPT"
+                    )
+
+                if chain in hooks and (lines or policy != "ACCEPT" or name == "filter"):
+                    declarations.append("add chain {} {} {{ type {} hook {} priority {}; policy {}; }}".format(
+                        prefix, chain_name(name, chain), chain_type, chain.lower(), hooks[chain], policy.lower()
+                    ))
+                elif chain in hooks:
+                    continue
+                else:
+                    declarations.append("add chain {} {}".format(prefix, chain_name(name, chain)))
+                flushes.append("flush chain {} {}".format(prefix, chain_name(name, chain)))
+                rules.extend("add rule {} {} {}".format(prefix, chain_name(name, chain), line) for line in lines)
+
+        # xt_recent evicts the oldest entries of a full list, a full set would refuse new ones instead. Lists without
+        # --seconds, like the first steps of ssh knocking, expire after the longest timeout of the others
+        default = max((timeout for timeout in sets.values() if timeout), default=RECENT_TIMEOUT)
+        for name, timeout in sets.items():
+            declarations.append("add set {} {} {{ type {}; size 65535; flags dynamic, timeout; timeout {}s; }}".format(
+                prefix, name, "ipv4_addr" if name.endswith("4") else "ipv6_addr", timeout or default
+            ))
+
+        kept = {line.split()[4] for line in flushes}
+        stale = [chain for chain in self.chains() if chain not in kept]
+        flushes.extend("flush chain {} {}".format(prefix, chain) for chain in stale)
+        flushes.extend("delete chain {} {}".format(prefix, chain) for chain in stale)
+        return "\n".join(declarations + flushes + rules) + "\n"
+
+    def commit(self) -> None:
+        """
+        Loads the staged rulesets, if no proxy has pending rules anymore
+
+        :raise subprocess.CalledProcessError if nft fails
+        """
+        if not self.staged or any(handler.pending for handler in self.handlers):
+            return
+
+        script = self.script()
+        self.staged = {}
+        self.load(script)
+
+    def snapshot(self) -> None:
+        """
+        Saves the inet table currently in the kernel, to be able to rollback to it
+
+        :raise subprocess.CalledProcessError if nft fails
+        """
+        self.saved = self.dump()
+
+    def rollback(self) -> None:
+        """ Restores the inet table saved by the last snapshot, if any """
+        if self.saved is not None:
+            saved, self.saved = self.saved, None
+            self.load("add table inet {0}\ndelete table inet {0}\n{1}".format(TABLE, saved))
+
+
+class Nftables(Iptables):
+    """
+    An nftables proxy for ipv4
+
+    Rules are recorded like for iptables, and translated on commit to rules of the inet table shared with the ipv6
+    proxy. Both are loaded together by the transaction, once every proxy committed its rules.
+
+    :param transaction: the transaction shared with the proxy of the other ip version
+    """
+    VERSION = 4
+
+    def __init__(self, transaction: NftablesTransaction=None):
+        super().__init__()
+        self.transaction = transaction or NftablesTransaction()
+        self.transaction.handlers.append(self)
+
+    @property
+    def command(self) -> str:
+        """ The name of the command line to call """
+        return "nft"
+
+    @property
+    def save_command(self) -> str:
+        """ The name of the command line used to dump the current ruleset """
+        return "nft"
+
+    @property
+    def restore_command(self) -> str:
+        """ The name of the command line used to load a ruleset """
+        return "nft"
+
+    def save(self, counters: bool=False) -> str:
+        """
+        Dumps the inet table currently in the kernel
+
+        :param counters: unused, nftables rules only have counters when they ask for them
+        :raise subprocess.CalledProcessError if nft fails
+        :return: the table in nft format
+        """
+        return self.transaction.dump()
+
+    def snapshot(self) -> None:
+        """
+        Saves the inet table currently in the kernel, to be able to rollback to it
+
+        :raise subprocess.CalledProcessError if nft fails
+        """
+        self.transaction.snapshot()
+
+    def rollback(self) -> None:
+        """ Restores the inet table saved by the last snapshot, if any """
+        self.transaction.rollback()
+
+    def commit(self) -> None:
+        """
+        Hands the recorded ruleset to the transaction, which loads it with the rules of the other ip version
+
+        :raise subprocess.CalledProcessError if nft fails
+        """
+        if not self.pending:
+            return
+
+        self.transaction.staged[self.VERSION] = self.ruleset
+        self.ruleset = Ruleset()
+        self.transaction.commit()
+
+
+class Nft6tables(Nftables, Ip6tables):
+    """
+    An nftables proxy for ipv6
+    """
+    VERSION = 6
+
+
+class NftSets(Ipset):
+    """
+    Named sets of the inet table, replacing ipsets when rules are loaded with nftables
+
+    Sets are flushed and filled again in a single transaction, so that rules using them always match against a
+    complete set.
+
+    :param transaction: the transaction of the inet table
+    """
+    def __init__(self, transaction: NftablesTransaction):
+        super().__init__()
+        self.transaction = transaction
+
+    @property
+    def command(self) -> str:
+        """ The name of the command line to call """
+        return "nft"
+
+    def list(self) -> list:
+        """
+        Lists the sets currently in the inet table
+
+        :raise subprocess.CalledProcessError if nft fails
+        :return: the names of the sets
+        """
+        return re.findall(r"^\s*set (\S+) {", self.transaction.dump(terse=True), re.MULTILINE)
+
+    def members(self) -> dict:
+        """
+        Reads the members of the sets currently in the inet table
+
+        :raise subprocess.CalledProcessError if nft fails
+        :return: dictionary of set name -> members
+        """
+        sets = {}
+        for name, body in re.findall(r"^\s*set (\S+) {(.*?)^\s*}", self.transaction.dump(), re.MULTILINE | re.DOTALL):
+            elements = re.search(r"elements = {(.*?)}", body, re.DOTALL)
+            sets[name] = [element.split()[0] for element in elements.group(1).split(",")] if elements else []
+        return sets
+
+    def dump(self, existing: list) -> str:
+        """
+        Formats the sets as nft commands
+
+        :param existing: unused, sets are created if needed and flushed in the same transaction
+        :return: the commands to give to nft
+        """
+        prefix = "inet " + TABLE
+        lines = ["add table " + prefix]
+        for name, (_, family, members, timeout) in self.sets.items():
+            address = "ipv4_addr" if family == "inet" else "ipv6_addr"
+            if timeout is not None:
+                lines.append("add set {} {} {{ type {}; size {}; flags dynamic, timeout; timeout {}s; }}".format(
+                    prefix, name, address, self.DYNAMIC_SIZE, timeout
+                ))
+                continue
+
+            lines.append("add set {} {} {{ type {}; flags interval; }}".format(prefix, name, address))
+            lines.append("flush set {} {}".format(prefix, name))
+            if members:
+                networks = collapse_addresses(ip_network(member, strict=False) for member in members)
+                lines.append("add element {} {} {{ {} }}".format(
+                    prefix, name, ", ".join(str(network) for network in networks)
+                ))
+        return "\n".join(lines) + "\n"
+
+    def restore(self, commands: str) -> None:
+        """
+        Runs the commands with nft
+
+        :param commands: the commands to run
+        :raise subprocess.CalledProcessError if nft fails
+        """
+        self.transaction.load(commands)
+
+    def cleanup(self) -> None:
+        """
+        Deletes the sets left by previous runs that are not used anymore, even when this run defines none. Sets still
+        referenced by rules are kept
+        """
+        stale = [name for name in self.list() if name.startswith(self.PREFIX) and name not in self.defined]
+        for name in stale:
+            with suppress(subprocess.CalledProcessError):
+                self.transaction.load("delete set inet {} {}\n".format(TABLE, name))
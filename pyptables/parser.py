@@ -6,7 +6,12 @@ Adds some improved parser specifically for Pyptables
 """
 
 # noinspection PyProtectedMember
+from collections import OrderedDict
 from configparser import ConfigParser, _UNSET, NoSectionError, NoOptionError, SectionProxy
+from threading import Lock
+import glob
+import hashlib
+import json
 import os
 import re
 
@@ -29,12 +34,160 @@ def getlist(self, option: str, fallback: list=None, *, raw: bool=False, vars: di
 SectionProxy.getlist = getlist
 
 
+# parsed fragments of the process : path -> (modification time, size, digest, sections)
+_fragments = {}
+_fragments_lock = Lock()
+
+
+def fragments(path: str, encoding: str=None) -> list:
+    """
+    Lists the files included by a configuration, with the include option of its global section
+
+    :param path: the configuration
+    :param encoding: the encoding of the configuration
+    :return: the included files
+    """
+    parser = ConfigParser(interpolation=None)
+    parser.read(path, encoding)
+    return _expand(path, parser.get("global", "include", fallback=""))
+
+
+def _expand(path: str, patterns: str) -> list:
+    """
+    Lists the files matching the patterns of an include option
+
+    The option is a comma-separated list of glob patterns, relative to the directory of the configuration. Files are
+    included in the order of the patterns, and in alphabetical order for a pattern. A file is only included once.
+
+    :param path: the configuration
+    :param patterns: the value of the include option
+    :return: the included files
+    """
+    included = OrderedDict()
+    for pattern in TypedConfigParser._convert_to_list(patterns):
+        pattern = os.path.join(os.path.dirname(os.path.abspath(path)), TypedConfigParser._convert_to_dir(pattern))
+        included.update((fragment, None) for fragment in sorted(glob.glob(pattern)) if os.path.isfile(fragment))
+    return list(included)
+
+
+def _parse(content: str, path: str) -> OrderedDict:
+    """
+    Parses a fragment of configuration
+
+    :param content: the content of the fragment
+    :param path: the file of the fragment
+    :return: dictionary of section -> {option: raw value}, in the order of the file
+    """
+    parser = ConfigParser(interpolation=None)
+    parser.read_string(content, path)
+
+    sections = OrderedDict()
+    if parser.defaults():
+        sections[parser.default_section] = OrderedDict(parser.defaults())
+    for section in parser.sections():
+        # noinspection PyProtectedMember
+        sections[section] = OrderedDict(parser._sections[section])
+    return sections
+
+
+def parse_fragment(path: str, cache: str=None, encoding: str=None) -> OrderedDict:
+    """
+    Gets the sections of a fragment of configuration, only parsing it again if it changed
+
+    Parsed fragments are kept in memory, and in the cache directory if any. A fragment whose modification time and size
+    did not change is not read at all, and one whose content did not change is not parsed.
+
+    :param path: the file of the fragment
+    :param cache: the directory in which to keep the parsed fragments between runs, None to only keep them in memory
+    :param encoding: the encoding of the fragment
+    :raise OSError if the fragment cannot be read
+    :return: dictionary of section -> {option: raw value}, in the order of the file
+    """
+    stat = os.stat(path)
+    with _fragments_lock:
+        entry = _fragments.get(path)
+
+    cached = os.path.join(cache, hashlib.sha1(path.encode()).hexdigest() + ".json") if cache else None
+    if entry is None and cached is not None:
+        try:
+            with open(cached) as _file:
+                data = json.load(_file, object_pairs_hook=OrderedDict)
+            entry = (data["mtime"], data["size"], data["digest"], data["sections"])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as exc:
+            print("[WARNING] Could not load the parsed fragment {} : {}".format(path, exc))
+
+    if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+        sections = entry[3]
+    else:
+        with open(path, "rb") as _file:
+            content = _file.read()
+        digest = hashlib.sha256(content).hexdigest()
+        sections = entry[3] if entry is not None and entry[2] == digest else \
+            _parse(content.decode(encoding or "utf-8"), path)
+
+        entry = (stat.st_mtime, stat.st_size, digest, sections)
+        if cached is not None:
+            data = OrderedDict([("mtime", entry[0]), ("size", entry[1]), ("digest", digest), ("sections", sections)])
+            try:
+                os.makedirs(cache, exist_ok=True)
+                with open(cached + ".tmp", "w") as _file:
+                    json.dump(data, _file)
+                os.replace(cached + ".tmp", cached)
+            except OSError as exc:
+                print("[WARNING] Could not save the parsed fragment {} : {}".format(path, exc))
+
+    with _fragments_lock:
+        _fragments[path] = entry
+    return sections
+
+
 class TypedConfigParser(ConfigParser):
     """
     A list-aware Configuration parser
+
+    Files listed by the include option of the global section are read after the configuration, each of them parsed
+    separately and only when it changed. See parse_fragment.
     """
     LIST_SEPARATOR = ","
 
+    # directory in which to keep the parsed fragments between runs
+    fragment_cache = None
+
+    def read(self, filenames, encoding: str=None) -> list:
+        """
+        Reads configuration files, and the files they include
+
+        :param filenames: a file or a list of files
+        :param encoding: the encoding of the files
+        :return: the list of files successfully read, then the included ones
+        """
+        read = super().read(filenames, encoding)
+
+        included = OrderedDict()
+        for path in read:
+            included.update(dict.fromkeys(_expand(path, self.get("global", "include", raw=True, fallback=""))))
+
+        for fragment in included:
+            self._merge(parse_fragment(fragment, self.fragment_cache, encoding))
+        return read + list(included)
+
+    def _merge(self, sections: dict) -> None:
+        """
+        Adds parsed sections, like read_dict but without checking again every option of a fragment already parsed
+
+        :param sections: dictionary of section -> {option: raw value}, as given by parse_fragment
+        """
+        for section, options in sections.items():
+            if section == self.default_section:
+                self._defaults.update(options)
+            elif section in self._sections:
+                self._sections[section].update(options)
+            else:
+                self._sections[section] = self._dict(options)
+                self._proxies[section] = SectionProxy(self, section)
+
     @staticmethod
     def _convert_to_list(value: str) -> list:
         """
@@ -0,0 +1,758 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+In-memory representation of an iptables ruleset, as understood by iptables-save and iptables-restore
+
+This is the compiled form of a configuration : the handlers record every rule here, and backends only read it to apply
+it to the kernel.
+"""
+
+from collections import namedtuple, OrderedDict
+from difflib import SequenceMatcher
+from functools import lru_cache
+from ipaddress import collapse_addresses, ip_network
+import hashlib
+import shlex
+import sys
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+BUILTIN_CHAINS = {
+    "filter": ["INPUT", "FORWARD", "OUTPUT"],
+    "nat": ["PREROUTING", "INPUT", "OUTPUT", "POSTROUTING"],
+    "mangle": ["PREROUTING", "INPUT", "FORWARD", "OUTPUT", "POSTROUTING"],
+    "raw": ["PREROUTING", "OUTPUT"],
+    "security": ["INPUT", "FORWARD", "OUTPUT"],
+}
+
+
+OPTION_ALIASES = {
+    "--source": "-s", "--src": "-s",
+    "--destination": "-d", "--dst": "-d",
+    "--protocol": "-p",
+    "--in-interface": "-i",
+    "--out-interface": "-o",
+    "--match": "-m",
+    "--jump": "-j",
+    "--goto": "-g",
+}
+
+# options iptables-save does not print, because they have their default value
+DEFAULT_OPTIONS = {
+    ("--log-level", "4"), ("--limit-burst", "5"), ("--mask", "255.255.255.255"),
+    ("--mask", "ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff"), ("--rsource",)
+}
+
+
+# matches keeping a state : their rules see a different traffic if other rules are moved before them
+STATEFUL_MATCHES = {"recent", "limit", "hashlimit", "connlimit", "quota", "statistic"}
+
+# protocols for which --sport and --dport can be matched
+PORT_PROTOCOLS = {"tcp", "udp", "udplite", "sctp", "dccp"}
+
+# iptables refuses longer chain names
+MAX_CHAIN_LENGTH = 28
+
+# targets after which a packet goes through no other rule of the chain
+TERMINAL_TARGETS = {"ACCEPT", "DROP", "REJECT", "RETURN"}
+
+
+def rule_key(rule: str) -> tuple:
+    """
+    Computes a key identifying a rule, whatever the way it was written
+
+    This allows to compare the rules we generate with the ones given by iptables-save, which uses short option names,
+    prints addresses with their prefix and changes the order of some options.
+
+    :param rule: the rule specification, without the "-A CHAIN" part
+    :return: a hashable key, equal for equivalent rules
+    """
+    options = []
+    for token in shlex.split(rule):
+        if not options or (token.startswith("-") and len(token) > 1 and not token[1].isdigit()):
+            options.append([OPTION_ALIASES.get(token, token)])
+        else:
+            options[-1].append(token)
+
+    for option in options:
+        if option[0] in ["-s", "-d"] and len(option) == 2:
+            try:
+                option[1] = str(ip_network(option[1], strict=False))
+            except ValueError:
+                pass
+
+    return tuple(sorted(tuple(option) for option in options if tuple(option) not in DEFAULT_OPTIONS))
+
+
+def _comment(rule: str):
+    """
+    Gets the comment of a rule
+
+    :param rule: the rule specification
+    :return: the comment, or None if the rule has none
+    """
+    try:
+        tokens = shlex.split(rule)
+    except ValueError:
+        return None
+    return tokens[tokens.index("--comment") + 1] if "--comment" in tokens[:-1] else None
+
+
+def hit_counters(dump: str) -> dict:
+    """
+    Reads the packet counters of the rules of a ruleset
+
+    :param dump: the output of iptables-save -c
+    :return: dictionary of (table, comment) -> list of packet counts, in the order of the rules. Chains are left out,
+             as rules may have been moved to generated chains
+    """
+    counters = {}
+    table = None
+    for line in dump.splitlines():
+        if line.startswith("*"):
+            table = line[1:].strip()
+        elif line.startswith("[") and "] -A " in line:
+            packets = line[1:line.index(":")]
+            rule = (line.split("] ", 1)[1] + " ").split(" ", 2)[2]
+            counters.setdefault((table, _comment(rule)), []).append(int(packets))
+    return counters
+
+
+def _port_ranges(ports: str) -> list:
+    """
+    Reads the ports matched by a rule
+
+    :param ports: a port, a range "first:last", or a comma-separated list of them
+    :return: list of (first port, last port)
+    """
+    return [(int(part.split(":")[0]), int(part.split(":")[-1])) for part in ports.split(",")]
+
+
+@lru_cache(maxsize=65536)
+def _network(address: str):
+    """
+    Reads an address or network of a rule. Rules of the same service share their addresses, so they are kept
+
+    :param address: the address or network
+    :raise ValueError if it is not an address
+    :return: the network
+    """
+    return ip_network(address, strict=False)
+
+
+def _address_within(inner: str, outer: str) -> bool:
+    """
+    Checks whether every address matched by a source or destination is matched by another one
+
+    :param inner: the address or network that has to be included, None for any address
+    :param outer: the address or network that has to include it, None for any address
+    :return: True if outer matches every address inner matches
+    """
+    if outer is None:
+        return True
+    if inner is None:
+        return False
+    try:
+        inner, outer = _network(inner), _network(outer)
+    except ValueError:
+        return inner == outer
+    return inner.version == outer.version and inner.prefixlen >= outer.prefixlen and \
+        inner.network_address in outer
+
+
+def _ports_within(inner: str, outer: str) -> bool:
+    """
+    Checks whether every port matched by a rule is matched by another one
+
+    :param inner: the ports that have to be included, None for any port
+    :param outer: the ports that have to include them, None for any port
+    :return: True if outer matches every port inner matches
+    """
+    if outer is None:
+        return True
+    if inner is None:
+        return False
+    ranges = _port_ranges(outer)
+    return all(any(first <= start and end <= last for first, last in ranges) for start, end in _port_ranges(inner))
+
+
+def _intern(value):
+    """
+    Interns a string, so that the many rules using the same chain, action or interface share a single copy of it
+
+    :param value: the string to intern, or None
+    :return: the interned string, or None
+    """
+    return value if value is None else sys.intern(value)
+
+
+class Rule(namedtuple("Rule", ["table", "chain", "action", "protocol", "interface", "source", "destination", "sport",
+                               "dport", "source_set", "destination_set", "matches", "comment", "options"])):
+    """
+    An immutable iptables rule
+
+    Fields used by many rules are interned. Matches that have no dedicated field are kept as text in matches, and the
+    options of the target in options.
+    """
+    __slots__ = ()
+
+    # noinspection PyInitNewSignature
+    def __new__(cls, chain: str, action: str=None, protocol: str=None, interface: str=None, source: str=None,
+                destination: str=None, sport: str=None, dport: str=None, source_set: str=None,
+                destination_set: str=None, matches: str=None, comment: str=None, options: str=None,
+                table: str="filter"):
+        return super().__new__(
+            cls, _intern(table), _intern(chain), _intern(action), _intern(protocol), _intern(interface), source,
+            destination, sport, dport, source_set, destination_set, matches, comment, options
+        )
+
+    def movable(self) -> bool:
+        """
+        Checks whether the rule can be swapped with its neighbours that are movable too, without changing any verdict
+
+        This is the case of ACCEPT rules without stateful matches : a packet matching two of them is accepted whichever
+        comes first.
+
+        :return: True if the rule can be moved
+        """
+        return self.action == "ACCEPT" and not STATEFUL_MATCHES.intersection(shlex.split(self.matches or ""))
+
+    def ports(self):
+        """
+        Gets the destination ports matched by the rule, when they form a single range
+
+        :return: (first port, last port), or None if the rule matches no port or a list of ports
+        """
+        if self.protocol not in PORT_PROTOCOLS or self.dport is None or "," in self.dport:
+            return None
+        return int(self.dport.split(":")[0]), int(self.dport.split(":")[-1])
+
+    def covers(self, other: "Rule") -> bool:
+        """
+        Checks whether the rule matches every packet the other rule matches
+
+        Matches without a dedicated field are only understood when both rules have the same ones, and never when they
+        keep a state.
+
+        :param other: the rule that may be covered
+        :return: True if every packet matching other matches this rule
+        """
+        if self.matches is not None and (
+            self.matches != other.matches or STATEFUL_MATCHES.intersection(shlex.split(self.matches))
+        ):
+            return False
+        if any(getattr(self, field) not in [None, getattr(other, field)]
+               for field in ["protocol", "source_set", "destination_set"]):
+            return False
+        if self.interface is not None and self.interface != other.interface and not (
+            self.interface.endswith("+") and (other.interface or "").startswith(self.interface[:-1])
+        ):
+            return False
+        return _address_within(other.source, self.source) and \
+            _address_within(other.destination, self.destination) and \
+            _ports_within(other.sport, self.sport) and _ports_within(other.dport, self.dport)
+
+    def spec(self) -> str:
+        """ Formats the rule specification, as given to iptables after "-A CHAIN" """
+        parts = []
+        if self.protocol:
+            parts.append("-m {proto} -p {proto}".format(proto=self.protocol))
+        if self.interface:
+            parts.append("-i " + self.interface)
+        if self.destination:
+            parts.append("--dst " + self.destination)
+        if self.source:
+            parts.append("--src " + self.source)
+        if self.destination_set:
+            parts.append("-m set --match-set {} dst".format(self.destination_set))
+        if self.source_set:
+            parts.append("-m set --match-set {} src".format(self.source_set))
+        if self.sport:
+            parts.append(("-m multiport --sports " if "," in self.sport else "--sport ") + self.sport)
+        if self.dport:
+            parts.append(("-m multiport --dports " if "," in self.dport else "--dport ") + self.dport)
+        if self.matches:
+            parts.append(self.matches)
+        if self.comment:
+            parts.append('-m comment --comment "{}"'.format(self.comment))
+        if self.action:
+            parts.append("-j " + self.action)
+        if self.options:
+            parts.append(self.options)
+        return " ".join(parts)
+
+
+class Table:
+    """
+    A single iptables table : its chain policies, user-defined chains and rules
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.policies = OrderedDict()
+        self.chains = []
+        self.rules = OrderedDict((chain, []) for chain in BUILTIN_CHAINS.get(name, []))
+
+    def __len__(self) -> int:
+        return sum(len(rules) for rules in self.rules.values())
+
+    def add_chain(self, chain: str) -> None:
+        """
+        Declares a new user-defined chain
+
+        :param chain: the name of the chain
+        """
+        if chain not in self.chains:
+            self.chains.append(_intern(chain))
+        self.rules.setdefault(chain, [])
+
+    def add_rule(self, rule: Rule) -> None:
+        """
+        Appends a rule to its chain
+
+        :param rule: the rule to add
+        """
+        self.rules.setdefault(rule.chain, []).append(rule)
+
+    def commands(self) -> list:
+        """ Lists the iptables commands replacing the table in the kernel by this one """
+        prefix = "" if self.name == "filter" else "-t {} ".format(self.name)
+        commands = [prefix + "-F", prefix + "-X"]
+        commands.extend("{}-P {} {}".format(prefix, chain, policy) for chain, policy in self.policies.items())
+        commands.extend("{}-N {}".format(prefix, chain) for chain in self.chains)
+        for chain, rules in self.rules.items():
+            commands.extend("{}-A {} {}".format(prefix, chain, rule.spec()) for rule in rules)
+        return commands
+
+    def reorder(self, hits: dict) -> tuple:
+        """
+        Moves the most matched rules first, within each run of consecutive ACCEPT rules of a chain
+
+        Two ACCEPT rules always commute, even when they overlap : a packet matching both is accepted whichever comes
+        first. Rules with other targets, or with a stateful match, are never moved nor moved over.
+
+        :param hits: the packet counters of the live rules, as given by hit_counters. Rules are matched by their
+                     comment, and the counters used are removed
+        :return: (matched packets, sum of their rule depths before, sum of their rule depths after)
+        """
+        packets = before = after = 0
+        for chain, rules in self.rules.items():
+            counted = [(rule, (hits.get((self.name, rule.comment)) or [0]).pop(0)) for rule in rules]
+
+            ordered = []
+            run = []
+            for rule, count in counted:
+                if rule.movable():
+                    run.append((rule, count))
+                    continue
+                ordered.extend(sorted(run, key=lambda entry: -entry[1]))
+                ordered.append((rule, count))
+                run = []
+            ordered.extend(sorted(run, key=lambda entry: -entry[1]))
+
+            self.rules[chain] = [rule for rule, _ in ordered]
+            packets += sum(count for _, count in counted)
+            before += sum(depth * count for depth, (_, count) in enumerate(counted, 1))
+            after += sum(depth * count for depth, (_, count) in enumerate(ordered, 1))
+
+        return packets, before, after
+
+    @staticmethod
+    def _index_keys(rule: Rule) -> list:
+        """
+        Gets the keys under which to index a rule, to find it again when looking for the rules covering another one
+
+        :param rule: the rule to index
+        :return: list of (protocol, interface, destination port), or None if the rule has to be tried for every rule
+        """
+        if (rule.interface or "").endswith("+") or (rule.dport is not None and ":" in rule.dport):
+            return None
+        ports = rule.dport.split(",") if rule.dport is not None else [None]
+        return [(rule.protocol, rule.interface, port) for port in ports]
+
+    @staticmethod
+    def _lookup_keys(rule: Rule) -> list:
+        """
+        Gets the keys under which the rules that may cover a rule are indexed
+
+        :param rule: the rule that may be covered
+        :return: list of (protocol, interface, destination port)
+        """
+        port = rule.dport.split(",")[0].split(":")[0] if rule.dport is not None else None
+        return [
+            (protocol, interface, dport)
+            for protocol in {None, rule.protocol} for interface in {None, rule.interface} for dport in {None, port}
+        ]
+
+    def _covering(self, rule: Rule, rules: list, index: dict, wide: list):
+        """
+        Finds the first of the indexed rules covering a rule
+
+        :param rule: the rule that may be covered
+        :param rules: the rules of the chain
+        :param index: dictionary of key -> positions of the rules, as given by _index_keys
+        :param wide: the positions of the rules that could not be indexed
+        :return: the position of the covering rule, or None
+        """
+        candidates = set(wide)
+        for key in self._lookup_keys(rule):
+            candidates.update(index.get(key, ()))
+        return next((position for position in sorted(candidates) if rules[position].covers(rule)), None)
+
+    @staticmethod
+    def _index(rules: list, position: int, index: dict, wide: list) -> None:
+        """
+        Indexes a rule, for _covering
+
+        :param rules: the rules of the chain
+        :param position: the position of the rule to index
+        :param index: dictionary of key -> positions of the rules
+        :param wide: the positions of the rules that cannot be indexed
+        """
+        keys = Table._index_keys(rules[position])
+        if keys is None:
+            wide.append(position)
+        for key in keys or []:
+            index.setdefault(key, []).append(position)
+
+    def _mergeable(self, chain: str, run: list) -> list:
+        """
+        Finds the rules of a run of movable rules that only differ by an address, which could be a single network
+
+        :param chain: the chain of the rules
+        :param run: the rules
+        :return: list of ("mergeable", chain, rules, number of rules once merged)
+        """
+        findings = []
+        for field in ["source", "destination"]:
+            groups = OrderedDict()
+            for rule in run:
+                if getattr(rule, field) is not None:
+                    groups.setdefault(rule._replace(comment=None, **{field: None}), []).append(rule)
+
+            for group in groups.values():
+                try:
+                    merged = len(list(collapse_addresses(
+                        _network(getattr(rule, field)) for rule in group
+                    )))
+                except (TypeError, ValueError):
+                    continue
+                if merged < len(group):
+                    findings.append(("mergeable", chain, group, merged))
+        return findings
+
+    def analyze(self, prune: bool=False) -> list:
+        """
+        Finds the rules that never match a packet, or that could be merged
+
+        A rule is shadowed when an earlier rule with a terminal target matches all of its packets, and redundant
+        (or a duplicate) when that earlier rule has the same target. Within a run of movable rules, a rule is
+        redundant too when a later rule of the run accepts all of its packets. Rules are compared by their protocol,
+        interface, addresses, ipsets and port ranges.
+
+        :param prune: whether to remove the shadowed, redundant and duplicate rules, which cannot change any verdict
+        :return: list of (kind, chain, rules, cause) : "shadowed", "redundant" or "duplicate" with [rule] and the rule
+                 covering it, or "mergeable" with the rules and the number of rules they could be merged into
+        """
+        findings = []
+        for chain, rules in self.rules.items():
+            dead = {}
+            index, wide = {}, []
+            for position, rule in enumerate(rules):
+                cause = self._covering(rule, rules, index, wide)
+                if cause is not None:
+                    dead[position] = cause
+                elif rule.action in TERMINAL_TARGETS:
+                    self._index(rules, position, index, wide)
+
+            runs = [[]]
+            for position, rule in enumerate(rules):
+                if not rule.movable():
+                    runs.append([])
+                elif position not in dead:
+                    runs[-1].append(position)
+
+            for run in runs:
+                index, wide = {}, []
+                for position in reversed(run):
+                    cause = self._covering(rules[position], rules, index, wide)
+                    if cause is not None:
+                        dead[position] = cause
+                    else:
+                        self._index(rules, position, index, wide)
+                findings.extend(self._mergeable(chain, [rules[position] for position in run if position not in dead]))
+
+            for position, cause in sorted(dead.items()):
+                rule, other = rules[position], rules[cause]
+                if rule._replace(comment=None) == other._replace(comment=None):
+                    kind = "duplicate"
+                elif (rule.action, rule.options) == (other.action, other.options):
+                    kind = "redundant"
+                else:
+                    kind = "shadowed"
+                findings.append((kind, chain, [rule], other))
+
+            if prune and dead:
+                self.rules[chain] = [rule for position, rule in enumerate(rules) if position not in dead]
+
+        return findings
+
+    def _subchain(self, parent: str, suffix: str) -> str:
+        """
+        Declares a chain for a group of the rules of another chain
+
+        :param parent: the chain the group comes from
+        :param suffix: what identifies the group
+        :return: the name of the new chain
+        """
+        name = "{}-{}".format(parent, suffix)
+        if len(name) > MAX_CHAIN_LENGTH or name in self.rules:
+            digest = hashlib.sha1("{}-{}".format(name, len(self.chains)).encode()).hexdigest()[:8]
+            name = "{}-{}".format(parent[:MAX_CHAIN_LENGTH - 9], digest)
+        self.add_chain(name)
+        return name
+
+    def _dispatch_ports(self, chain: str, protocol: str, rules: list, min_rules: int) -> list:
+        """
+        Splits rules in two chains by destination port range, until the chains have less than 2 * min_rules rules
+
+        :param chain: the chain of the rules
+        :param protocol: the protocol of the rules
+        :param rules: the rules, each matching a single range of destination ports
+        :param min_rules: the minimum number of rules in a generated chain
+        :return: the rules to put in the chain
+        """
+        if len(rules) < 2 * min_rules:
+            return rules
+
+        rules = sorted(rules, key=Rule.ports)
+        result = []
+        for half in [rules[:len(rules) // 2], rules[len(rules) // 2:]]:
+            first, last = half[0].ports()[0], max(rule.ports()[1] for rule in half)
+            subchain = self._subchain(chain, "{}-{}".format(first, last))
+            ports = str(first) if first == last else "{}:{}".format(first, last)
+            result.append(Rule(chain, subchain, protocol=protocol, dport=ports, table=self.name))
+            self.rules[subchain] = self._dispatch_ports(
+                subchain, protocol, [rule._replace(chain=subchain) for rule in half], min_rules
+            )
+        return result
+
+    def _dispatch(self, chain: str, rules: list, min_rules: int, level: int=0) -> list:
+        """
+        Groups rules in generated chains by interface, then by protocol, then by destination port range
+
+        :param chain: the chain of the rules
+        :param rules: the rules, which must all be movable
+        :param min_rules: the minimum number of rules in a generated chain
+        :param level: 0 to group by interface, 1 by protocol
+        :return: the rules to put in the chain, including the jumps to the generated chains
+        """
+        field = ["interface", "protocol"][level]
+        groups = OrderedDict()
+        for rule in rules:
+            groups.setdefault(getattr(rule, field), []).append(rule)
+
+        result = []
+        for value, members in groups.items():
+            if value is None or len(members) < min_rules:
+                result.extend(self._dispatch(chain, members, min_rules, 1) if level == 0 else members)
+                continue
+
+            subchain = self._subchain(chain, value)
+            result.append(Rule(chain, subchain, table=self.name, **{field: value}))
+            if level == 0:
+                members = [rule._replace(chain=subchain, interface=None) for rule in members]
+                self.rules[subchain] = self._dispatch(subchain, members, min_rules, 1)
+            else:
+                members = [rule._replace(chain=subchain) for rule in members]
+                ranges = [rule for rule in members if rule.ports() is not None]
+                self.rules[subchain] = [rule for rule in members if rule.ports() is None] + \
+                    self._dispatch_ports(subchain, value, ranges, min_rules)
+        return result
+
+    def dispatch(self, min_rules: int=4) -> None:
+        """
+        Replaces each run of consecutive movable rules of a chain by a tree of chains, where rules are grouped by
+        interface, then protocol, then destination port range
+
+        A packet then only goes through the rules of its own interface and protocol, and through a number of port
+        chains logarithmic in the number of rules. Rules matching no packet in a generated chain return to the
+        chain they come from, where the other groups of the run are tried.
+
+        :param min_rules: the minimum number of rules needed to create a chain for a group
+        """
+        for chain in list(self.rules):
+            result = []
+            run = []
+            for rule in self.rules[chain]:
+                if rule.movable():
+                    run.append(rule)
+                    continue
+                result.extend(self._dispatch(chain, run, min_rules))
+                result.append(rule)
+                run = []
+            result.extend(self._dispatch(chain, run, min_rules))
+            self.rules[chain] = result
+
+    def lines(self):
+        """ Generates the lines of the table in iptables-restore format, with their line feed """
+        yield "*{}\n".format(self.name)
+        for chain in BUILTIN_CHAINS.get(self.name, []):
+            if chain in self.policies:
+                yield ":{} {} [0:0]\n".format(chain, self.policies[chain])
+        for chain in self.chains:
+            yield ":{} - [0:0]\n".format(chain)
+        for chain, rules in self.rules.items():
+            for rule in rules:
+                yield "-A {} {}\n".format(chain, rule.spec())
+        yield "COMMIT\n"
+
+    def dump(self) -> str:
+        """ Formats the table in iptables-restore format """
+        return "".join(self.lines())[:-1]
+
+    def diff(self, current: "Table") -> list:
+        """
+        Computes the commands transforming the current table into this one, touching only the rules that changed
+
+        :param current: the table as it currently is in the kernel
+        :return: the commands to give to iptables-restore --noflush, in order
+        """
+        declarations = [":{} - [0:0]".format(chain) for chain in self.chains if chain not in current.chains]
+        commands = [
+            "-P {} {}".format(chain, policy) for chain, policy in self.policies.items()
+            if current.policies.get(chain) != policy
+        ]
+
+        for chain, rules in self.rules.items():
+            matcher = SequenceMatcher(
+                None,
+                [rule_key(rule.spec()) for rule in current.rules.get(chain, [])],
+                [rule_key(rule.spec()) for rule in rules],
+                autojunk=False
+            )
+
+            deleted = []
+            inserted = []
+            for tag, current_start, current_end, start, end in matcher.get_opcodes():
+                if tag in ["delete", "replace"]:
+                    deleted.extend(range(current_start, current_end))
+                if tag in ["insert", "replace"]:
+                    inserted.extend(range(start, end))
+
+            commands.extend("-D {} {}".format(chain, index + 1) for index in reversed(deleted))
+            commands.extend("-I {} {} {}".format(chain, index + 1, rules[index].spec()) for index in inserted)
+
+        removed = [chain for chain in current.chains if chain not in self.chains]
+        commands.extend("-F " + chain for chain in removed)
+        commands.extend("-X " + chain for chain in removed)
+
+        if not commands and not declarations:
+            return []
+        return ["*" + self.name] + declarations + commands + ["COMMIT"]
+
+
+class Ruleset:
+    """
+    A full ruleset for one address family
+    """
+    def __init__(self):
+        self.tables = OrderedDict()
+
+    def table(self, name: str) -> Table:
+        """
+        Gets the table with the given name, creating it if needed
+
+        :param name: the name of the table
+        :return: the corresponding table
+        """
+        if name not in self.tables:
+            self.tables[name] = Table(name)
+        return self.tables[name]
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in self.tables.values())
+
+    def commands(self) -> list:
+        """ Lists the iptables commands replacing the tables in the kernel by the ones of this ruleset """
+        return [command for table in self.tables.values() for command in table.commands()]
+
+    def reorder(self, hits: dict) -> tuple:
+        """
+        Moves the most matched rules first in every table, where this cannot change any verdict
+
+        :param hits: the packet counters of the live rules, as given by hit_counters
+        :return: (matched packets, sum of their rule depths before, sum of their rule depths after)
+        """
+        totals = [table.reorder(hits) for table in self.tables.values()]
+        return tuple(sum(values) for values in zip(*totals)) if totals else (0, 0, 0)
+
+    def analyze(self, prune: bool=False) -> list:
+        """
+        Finds the rules of every table that never match a packet, or that could be merged
+
+        :param prune: whether to remove the rules that never match a packet
+        :return: list of (table, kind, chain, rules, cause), as given by Table.analyze
+        """
+        return [(name,) + finding for name, table in self.tables.items() for finding in table.analyze(prune)]
+
+    def dispatch(self, min_rules: int=4) -> None:
+        """
+        Groups the rules of every table in generated chains, by interface, protocol and destination port range
+
+        :param min_rules: the minimum number of rules needed to create a chain for a group
+        """
+        for table in self.tables.values():
+            table.dispatch(min_rules)
+
+    def lines(self):
+        """ Generates the lines of the ruleset in iptables-restore format, with their line feed """
+        for table in self.tables.values():
+            yield from table.lines()
+
+    def dump(self) -> str:
+        """ Formats the ruleset in iptables-restore format """
+        return "".join(self.lines())
+
+    def diff(self, current: "Ruleset") -> str:
+        """
+        Computes the changes to apply to the current ruleset to get this one. Tables not in this ruleset are left alone
+
+        :param current: the ruleset currently in the kernel
+        :return: the changes, in iptables-restore --noflush format, or an empty string if there are none
+        """
+        lines = []
+        for name, table in self.tables.items():
+            lines.extend(table.diff(current.tables.get(name, Table(name))))
+        return "\n".join(lines) + "\n" if lines else ""
+
+    @classmethod
+    def parse(cls, dump: str) -> "Ruleset":
+        """
+        Reads a ruleset in iptables-save format
+
+        :param dump: the output of iptables-save
+        :return: the corresponding ruleset
+        """
+        ruleset = cls()
+        table = None
+        for line in dump.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#") or line == "COMMIT":
+                continue
+            elif line.startswith("*"):
+                table = ruleset.table(line[1:])
+            elif line.startswith(":"):
+                chain, policy = line[1:].split()[:2]
+                if policy == "-":
+                    table.add_chain(chain)
+                else:
+                    table.policies[chain] = policy
+            elif line.startswith("-A "):
+                _, chain, rule = line.split(" ", 2)
+                table.add_rule(Rule(chain, matches=rule, table=table.name))
+            else:
+                raise ValueError("Unexpected line in iptables-save output: '{}'".format(line))
+        return ruleset
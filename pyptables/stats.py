@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation of a run : time spent in each phase, dns cache efficiency, external calls and rule counts
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
+import json
+import time
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class Stats:
+    """
+    Collects measures during a run. Nothing is recorded until it is enabled
+
+    Measures can be recorded from several threads at once.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = Lock()
+        self.phases = OrderedDict()
+        self.dns = OrderedDict()
+        self.calls = OrderedDict()
+        self.rules = OrderedDict()
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Measures the time spent in a phase of the run. Phases entered several times are added up
+
+        :param name: the name of the phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                with self.lock:
+                    self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+
+    @contextmanager
+    def call(self, command: str):
+        """
+        Measures a call to an external command
+
+        :param command: the name of the command
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    entry = self.calls.setdefault(command, OrderedDict([("count", 0), ("time", 0), ("max", 0)]))
+                    entry["count"] += 1
+                    entry["time"] += elapsed
+                    entry["max"] = max(entry["max"], elapsed)
+
+    def lookups(self, kind: str, hits: int, misses: int, elapsed: float=0) -> None:
+        """
+        Records dns queries
+
+        :param kind: "forward" or "reverse"
+        :param hits: the number of queries answered by the cache
+        :param misses: the number of queries that had to be looked up
+        :param elapsed: the time spent looking them up
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            entry = self.dns.setdefault(kind, OrderedDict([("hits", 0), ("misses", 0), ("time", 0)]))
+            entry["hits"] += hits
+            entry["misses"] += misses
+            entry["time"] += elapsed
+
+    def count_rules(self, version: int, ruleset) -> None:
+        """
+        Records the number of rules of each chain of a ruleset
+
+        :param version: the ip version of the ruleset
+        :param ruleset: the ruleset about to be applied
+        """
+        if not self.enabled:
+            return
+
+        counts = OrderedDict()
+        for table in ruleset.tables.values():
+            for chain, rules in table.rules.items():
+                counts["{}/{}".format(table.name, chain)] = len(rules)
+
+        with self.lock:
+            self.rules["ipv{}".format(version)] = counts
+
+    def reset(self) -> None:
+        """ Forgets all the measures """
+        with self.lock:
+            for measures in [self.phases, self.dns, self.calls, self.rules]:
+                measures.clear()
+
+    def merge(self, measures: dict) -> None:
+        """
+        Adds up measures recorded by an other process
+
+        :param measures: the measures, as given by as_dict
+        """
+        if not self.enabled:
+            return
+
+        with self.lock:
+            for name, elapsed in measures["phases"].items():
+                self.phases[name] = self.phases.get(name, 0) + elapsed
+            for kind, entry in measures["dns"].items():
+                total = self.dns.setdefault(kind, OrderedDict([("hits", 0), ("misses", 0), ("time", 0)]))
+                for key in total:
+                    total[key] += entry[key]
+            for command, entry in measures["calls"].items():
+                total = self.calls.setdefault(command, OrderedDict([("count", 0), ("time", 0), ("max", 0)]))
+                total["count"] += entry["count"]
+                total["time"] += entry["time"]
+                total["max"] = max(total["max"], entry["max"])
+            for family, counts in measures["rules"].items():
+                total = self.rules.setdefault(family, OrderedDict())
+                for chain, count in counts.items():
+                    total[chain] = total.get(chain, 0) + count
+
+    def as_dict(self) -> OrderedDict:
+        """ Gets all the measures """
+        return OrderedDict([("phases", self.phases), ("dns", self.dns), ("calls", self.calls), ("rules", self.rules)])
+
+    def json(self) -> str:
+        """ Formats the measures as json """
+        return json.dumps(self.as_dict(), indent=2)
+
+    def report(self) -> str:
+        """ Formats the measures for a human """
+        lines = ["Phases :"]
+        lines.extend("  {:<20} {:>9.3f}s".format(name, elapsed) for name, elapsed in self.phases.items())
+
+        lines.append("Dns :")
+        for kind, entry in self.dns.items():
+            lines.append("  {:<20} {:>6} hits {:>6} misses {:>9.3f}s".format(
+                kind, entry["hits"], entry["misses"], entry["time"]
+            ))
+
+        lines.append("Calls :")
+        for command, entry in self.calls.items():
+            lines.append("  {:<20} {:>6} calls {:>9.3f}s (slowest {:.3f}s)".format(
+                command, entry["count"], entry["time"], entry["max"]
+            ))
+
+        lines.append("Rules :")
+        for family, counts in self.rules.items():
+            lines.append("  {:<20} {:>6}".format(family, sum(counts.values())))
+            lines.extend("    {:<30} {:>6}".format(chain, count) for chain, count in counts.items() if count)
+
+        return "\n".join(lines)
+
+
+stats = Stats()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the cache of compiled rulesets
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pyptables.cache import RulesetCache
+from pyptables.dns import Resolver
+from pyptables.ruleset import Ruleset
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+DUMP = """*filter
+:INPUT DROP [0:0]
+-A INPUT -m tcp -p tcp --dport 80 -m comment --comment "Allow Anyone to connect to web" -j ACCEPT
+COMMIT
+"""
+
+
+class TestRulesetCache(unittest.TestCase):
+    """ Entries of the cache, and when they are used """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.conf = self.write("pyptables.conf", "[web]\ndport = 80\n")
+        self.cache = RulesetCache(os.path.join(self.directory, "cache"))
+
+        self.resolver = Resolver(offline=True)
+        self.resolver.addresses["example.com"] = ("10.0.0.1", time.time() + 3600)
+        self.resolver.used["addresses"].add("example.com")
+
+    def write(self, name: str, content: str) -> str:
+        """
+        Writes a file of the test
+
+        :param name: the name of the file
+        :param content: the content of the file
+        :return: the path of the file
+        """
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as _file:
+            _file.write(content)
+        return path
+
+    def store(self) -> str:
+        """
+        Stores a ruleset compiled from the configuration
+
+        :return: the key of the entry
+        """
+        key = RulesetCache.key(self.conf)
+        self.cache.store(key, self.conf, {4: Ruleset.parse(DUMP)}, {}, {}, self.resolver.answers())
+        return key
+
+    def test_key(self):
+        key = RulesetCache.key(self.conf)
+        self.assertEqual(RulesetCache.key(self.conf), key)
+        self.assertNotEqual(RulesetCache.key(self.conf, ["prune"]), key)
+        self.write("pyptables.conf", "[web]\ndport = 443\n")
+        self.assertNotEqual(RulesetCache.key(self.conf), key)
+
+    def test_included(self):
+        included = self.write("web.conf", "[web]\ndport = 80\n")
+        key = RulesetCache.key(self.conf, (), [included])
+        self.assertNotEqual(RulesetCache.key(self.conf), key)
+        self.write("web.conf", "[web]\ndport = 443\n")
+        self.assertNotEqual(RulesetCache.key(self.conf, (), [included]), key)
+
+    def test_load(self):
+        key = self.store()
+        self.assertEqual(self.cache.load(key, self.resolver)["rulesets"], {4: DUMP})
+        self.assertIsNone(self.cache.load(RulesetCache.key(self.conf, ["prune"]), self.resolver))
+
+    def test_dns_answer_changed(self):
+        key = self.store()
+        self.resolver.addresses["example.com"] = ("10.0.0.2", time.time() + 3600)
+        self.assertIsNone(self.cache.load(key, self.resolver))
+
+    def test_previous_entries_removed(self):
+        key = self.store()
+        self.write("pyptables.conf", "[web]\ndport = 443\n")
+        self.store()
+        self.assertIsNone(self.cache.load(key, self.resolver))
+        self.assertEqual(len(os.listdir(os.path.join(self.directory, "cache"))), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the compilation of many configurations
+"""
+
+from contextlib import redirect_stdout
+from functools import partial
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from pyptables import build_iptables
+from pyptables.compiler import compile_all
+from pyptables.stats import stats
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+CONFIGURATION = """[DEFAULT]
+chain = INPUT
+action = ACCEPT
+ipv4 = True
+ipv6 = True
+
+[global]
+closed_chains = INPUT
+
+[web]
+protocol = tcp
+dport = {}
+"""
+
+
+class TestCompileAll(unittest.TestCase):
+    """ Compilation of the configurations of a directory """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.hosts = os.path.join(self.directory, "hosts")
+        self.output = os.path.join(self.directory, "rulesets")
+        os.mkdir(self.hosts)
+        self.write("hosts/web.conf", CONFIGURATION.format(80))
+        self.write("hosts/mail.conf", CONFIGURATION.format(25))
+
+    def write(self, name: str, content: str) -> str:
+        """
+        Writes a file of the test
+
+        :param name: the name of the file, relative to the directory of the test
+        :param content: the content of the file
+        :return: the path of the file
+        """
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as _file:
+            _file.write(content)
+        return path
+
+    def compile(self, patterns: list) -> tuple:
+        """
+        Compiles configurations with a single worker
+
+        :param patterns: the configurations to compile
+        :return: (error code, output)
+        """
+        output = io.StringIO()
+        with redirect_stdout(output):
+            error = compile_all(patterns, self.output, partial(build_iptables, dispatch=None, prune=False), jobs=1)
+        return error, output.getvalue()
+
+    def test_compile(self):
+        error, output = self.compile([self.hosts])
+        self.assertEqual(error, 0)
+        self.assertIn("[INFO] Compiled 2 of 2 configurations to {}".format(self.output), output)
+        self.assertEqual(sorted(os.listdir(self.output)), ["mail.ipv4", "mail.ipv6", "web.ipv4", "web.ipv6"])
+        with open(os.path.join(self.output, "web.ipv4")) as _file:
+            ruleset = _file.read()
+        self.assertIn(":INPUT DROP [0:0]", ruleset)
+        self.assertIn("--dport 80 ", ruleset)
+
+    def test_stats(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+        with mock.patch.object(stats, "enabled", True):
+            self.compile([self.hosts])
+        self.assertEqual(stats.rules["ipv4"]["filter/INPUT"], 2)
+        self.assertEqual(stats.rules["ipv6"]["filter/INPUT"], 2)
+        self.assertIn("compile", stats.phases)
+
+    def test_errors(self):
+        self.write("hosts/broken.conf", "[DEFAULT]\nipv4 = True\n\n[nothing]\nchain = INPUT\naction = ACCEPT\n")
+        duplicate = self.write("web.conf", CONFIGURATION.format(443))
+
+        error, output = self.compile([self.hosts, duplicate])
+        self.assertEqual(error, -1)
+        self.assertIn("[INFO] Compiled 1 of 4 configurations to {}".format(self.output), output)
+        self.assertIn("{} : another configuration has the same name, skipping".format(duplicate), output)
+        self.assertEqual(sorted(os.listdir(self.output)), ["mail.ipv4", "mail.ipv6"])
+
+
+if __name__ == "__main__":
+    unittest.main()
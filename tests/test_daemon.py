@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the long-running mode
+"""
+
+from contextlib import redirect_stderr, redirect_stdout
+import io
+import tempfile
+import unittest
+from unittest import mock
+
+from pyptables import parse_args
+from pyptables.daemon import Daemon
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class TestArguments(unittest.TestCase):
+    """ Backend used by the daemon """
+    def setUp(self):
+        self.conf = tempfile.NamedTemporaryFile(suffix=".conf")
+        self.addCleanup(self.conf.close)
+
+    def test_diff_by_default(self):
+        self.assertEqual(parse_args(["--conf", self.conf.name, "--daemon"]).backend, "diff")
+        self.assertEqual(parse_args(["--conf", self.conf.name, "--daemon", "--atomic"]).backend, "diff")
+
+    def test_other_backend(self):
+        with redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            parse_args(["--conf", self.conf.name, "--daemon", "--backend", "nftables"])
+
+
+class TestRun(unittest.TestCase):
+    """ Errors during the reloads """
+    def test_reload_error(self):
+        daemon = Daemon("pyptables.conf", None)
+        watcher = mock.Mock()
+        watcher.wait.side_effect = [True, KeyboardInterrupt]
+        output = io.StringIO()
+        with mock.patch("pyptables.daemon.signal.signal"), \
+                mock.patch.object(daemon, "reload", side_effect=[ValueError("invalid port"), 0]) as reload, \
+                mock.patch.object(daemon, "_discard") as discard, \
+                redirect_stdout(output), self.assertRaises(KeyboardInterrupt):
+            daemon.run(watcher)
+
+        self.assertEqual(reload.call_count, 2)
+        discard.assert_called_once_with()
+        self.assertIn("ERROR : invalid port\n[ERROR] Reload failed, keeping the previous rules", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
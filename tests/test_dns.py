@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the caching resolver
+"""
+
+import unittest
+
+from pyptables.dns import Resolver
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class TestOffline(unittest.TestCase):
+    """ Resolution without any lookup, from an empty cache """
+    def setUp(self):
+        self.resolver = Resolver(offline=True)
+
+    def test_misses_are_negative_answers(self):
+        self.assertIsNone(self.resolver.resolve("example.invalid"))
+        self.assertIsNone(self.resolver.reverse("::1"))
+        self.assertEqual(
+            self.resolver.answers(), {"addresses": {"example.invalid": None}, "hostnames": {"::1": None}}
+        )
+
+    def test_answers_match_offline_only(self):
+        self.resolver.resolve("example.invalid")
+        answers = self.resolver.answers()
+        self.assertTrue(self.resolver.matches(answers))
+
+        # the negative answer is expired, a run that is not offline looks it up again
+        self.resolver.offline = False
+        self.assertFalse(self.resolver.matches(answers))
+
+
+if __name__ == "__main__":
+    unittest.main()
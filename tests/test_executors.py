@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the computation of the rules of the services
+"""
+
+from ipaddress import ip_address, ip_network
+import unittest
+
+from pyptables.executors import collapse, merge_ports
+from pyptables.iptables import IptablesRule
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class TestCollapse(unittest.TestCase):
+    """ Merging of the addresses of a service """
+    def test_networks(self):
+        self.assertEqual(
+            collapse(["10.0.0.1", "10.0.0.0/31", "10.0.0.2", "10.0.0.3", "10.0.0.1"]), [ip_network("10.0.0.0/30")]
+        )
+
+    def test_hosts(self):
+        self.assertEqual(
+            collapse(["10.0.0.5", "10.0.0.1", "10.0.0.5"]), [ip_address("10.0.0.1"), ip_address("10.0.0.5")]
+        )
+
+    def test_ipv6(self):
+        self.assertEqual(collapse(["2001:db8::1", "2001:db8::/127"]), [ip_network("2001:db8::/127")])
+
+
+class TestMergePorts(unittest.TestCase):
+    """ Rules merged into multiport rules """
+    @staticmethod
+    def rule(name: str, dport: str=None, action: str="ACCEPT", **fields) -> tuple:
+        """
+        Creates an ipv4 rule of the INPUT chain
+
+        :param name: the name of the service
+        :param dport: the destination ports
+        :param action: the action of the rule
+        :param fields: the other fields of the rule
+        :return: (ip version, rule)
+        """
+        return 4, IptablesRule(name, "INPUT", action, protocol="tcp", dport=dport, **fields)
+
+    def test_merge(self):
+        merged = merge_ports([self.rule("ssh", "22"), self.rule("web", "80,443"), self.rule("alt", "8000:8100")])
+        self.assertEqual([(rule.name, rule.dport) for _, rule in merged], [("ssh, web, alt", "22,80,443,8000:8100")])
+
+    def test_different_fields(self):
+        merged = merge_ports([self.rule("ssh", "22"), self.rule("web", "80", source="10.0.0.1")])
+        self.assertEqual([rule.dport for _, rule in merged], ["22", "80"])
+
+    def test_other_action_in_between(self):
+        merged = merge_ports([self.rule("ssh", "22"), self.rule("drop", "23", "DROP"), self.rule("web", "80")])
+        self.assertEqual([rule.dport for _, rule in merged], ["22", "23", "80"])
+
+    def test_slots(self):
+        merged = merge_ports([self.rule("many", ",".join(str(port) for port in range(1, 18)))])
+        self.assertEqual([rule.dport.count(",") + 1 for _, rule in merged], [15, 2])
+
+    def test_ranges_take_two_slots(self):
+        ranges = ",".join("{}:{}".format(port, port + 1) for port in range(0, 20, 2))
+        merged = merge_ports([self.rule("ranges", ranges)])
+        self.assertEqual([rule.dport.count(",") + 1 for _, rule in merged], [7, 3])
+
+    def test_source_ports(self):
+        merged = merge_ports([self.rule("many", sport=",".join(str(port) for port in range(1, 18)))])
+        self.assertEqual([rule.sport.count(",") + 1 for _, rule in merged], [15, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the ipset proxy
+"""
+
+import subprocess
+import unittest
+from unittest import mock
+
+from pyptables import executors
+from pyptables.ipset import Ipset
+from pyptables.nftables import NftSets
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class TestCleanup(unittest.TestCase):
+    """ Removal of the sets of previous runs """
+    def setUp(self):
+        self.handler = Ipset()
+        patcher = mock.patch("pyptables.ipset.subprocess.call")
+        self.call = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_set_defined(self):
+        with mock.patch.object(self.handler, "list", return_value=["pyptables-0a1b2c3d-sn4", "other"]):
+            self.handler.cleanup()
+        self.call.assert_called_once_with(["ipset", "destroy", "pyptables-0a1b2c3d-sn4"], stderr=subprocess.DEVNULL)
+
+    def test_used_sets_kept(self):
+        self.handler.defined = {"pyptables-0a1b2c3d-sn4"}
+        with mock.patch.object(self.handler, "list", return_value=["pyptables-0a1b2c3d-sn4", "pyptables-4e5f6a7b-dn6"]):
+            self.handler.cleanup()
+        self.call.assert_called_once_with(["ipset", "destroy", "pyptables-4e5f6a7b-dn6"], stderr=subprocess.DEVNULL)
+
+    def test_without_ipset(self):
+        with mock.patch.object(self.handler, "list", side_effect=subprocess.CalledProcessError(127, "ipset")):
+            self.handler.cleanup()
+        self.call.assert_not_called()
+
+
+class TestMembers(unittest.TestCase):
+    """ Reading the members of the sets in the kernel """
+    def test_ipset(self):
+        output = (
+            "create pyptables-0a1b2c3d-sn4 hash:net family inet hashsize 1024 maxelem 65536\n"
+            "add pyptables-0a1b2c3d-sn4 10.0.0.0/24\n"
+            "add pyptables-0a1b2c3d-sn4 10.0.1.1\n"
+            "create pyptables-4e5f6a7b-sn6 hash:net family inet6 hashsize 1024 maxelem 65536\n"
+        )
+        with mock.patch("pyptables.ipset.subprocess.check_output", return_value=output.encode()):
+            self.assertEqual(
+                Ipset().members(),
+                {"pyptables-0a1b2c3d-sn4": ["10.0.0.0/24", "10.0.1.1"], "pyptables-4e5f6a7b-sn6": []}
+            )
+
+    def test_nftables(self):
+        transaction = mock.Mock()
+        transaction.dump.return_value = """table inet pyptables {
+\tset pyptables-0a1b2c3d-sn4 {
+\t\ttype ipv4_addr
+\t\tflags interval
+\t\telements = { 10.0.0.0/24, 10.0.1.1,
+\t\t\t     10.0.2.0/23 }
+\t}
+
+\tset pyptables-4e5f6a7b-sn6 {
+\t\ttype ipv6_addr
+\t\tflags interval
+\t}
+}
+"""
+        self.assertEqual(
+            NftSets(transaction).members(),
+            {"pyptables-0a1b2c3d-sn4": ["10.0.0.0/24", "10.0.1.1", "10.0.2.0/23"], "pyptables-4e5f6a7b-sn6": []}
+        )
+
+
+class TestRefreshTracked(unittest.TestCase):
+    """ Updates of the sets of tracked hostnames """
+    NAME = "pyptables-0a1b2c3d-sn4"
+
+    def refresh(self, live: list) -> list:
+        """
+        Refreshes a tracked set of two networks
+
+        :param live: the members of the set in the kernel
+        :return: the sets that changed
+        """
+        handler = Ipset()
+        handler.loaded = {self.NAME: live}
+        tracked = {self.NAME: ("cloud", "src", 4, ["10.0.0.0/24", "10.0.1.1"])}
+        with mock.patch.object(executors, "ipset_handler", handler), \
+                mock.patch.dict(executors.tracked, tracked, clear=True), mock.patch.object(handler, "commit"):
+            return executors.refresh_tracked()
+
+    def test_unchanged(self):
+        self.assertEqual(self.refresh(["10.0.1.1", "10.0.0.0/24"]), [])
+
+    def test_changed(self):
+        self.assertEqual(self.refresh(["10.0.0.0/24"]), [self.NAME])
+
+
+if __name__ == "__main__":
+    unittest.main()
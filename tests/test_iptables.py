@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the rules recorded by the iptables proxy
+"""
+
+import unittest
+
+from pyptables.iptables import Iptables
+from pyptables.parser import TypedConfigParser
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class TestSshKnocking(unittest.TestCase):
+    """ Rules of the ssh knocking """
+    def setUp(self):
+        parser = TypedConfigParser()
+        parser.read_string("[ssh_knocking]\nports = 777, 888\nssh_port = 22\ntimeout = 30\n")
+        self.config = parser["ssh_knocking"]
+        self.handler = Iptables()
+
+    def rules(self, chain: str) -> list:
+        """
+        Gets the (target, source set, dport) of the rules of a chain
+
+        :param chain: the chain of which to get the rules
+        :return: the summary of the rules
+        """
+        return [
+            (rule.action, rule.source_set, rule.dport)
+            for rule in self.handler.ruleset.table("filter").rules[chain]
+        ]
+
+    def test_recent(self):
+        self.handler.enable_ssh_knocking(self.config)
+        self.assertEqual(
+            self.rules("INPUT"),
+            [("ACCEPT", None, "22"), ("DROP", None, None), ("SSH-KNOCKING-1", None, "888"), ("DROP", None, None),
+             ("DROP", None, "777")]
+        )
+        self.assertEqual(self.rules("SSH-KNOCKING-1"), [("DROP", None, None)])
+
+    def test_sets(self):
+        self.handler.enable_ssh_knocking(self.config, ["step0", "step1"])
+        self.assertEqual(
+            self.rules("INPUT"),
+            [("ACCEPT", "step1", "22"), ("SSH-REMOVE-1", "step1", None), ("SSH-KNOCKING-1", "step0", "888"),
+             ("SSH-REMOVE-0", "step0", None), ("SSH-KNOCKING-0", None, "777")]
+        )
+        for step in range(2):
+            self.assertEqual(self.rules("SSH-KNOCKING-{}".format(step)), [("SET", None, None), ("DROP", None, None)])
+            self.assertEqual(self.rules("SSH-REMOVE-{}".format(step)), [("SET", None, None), ("DROP", None, None)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the translation of rulesets to nftables
+"""
+
+import unittest
+
+from pyptables.nftables import NftablesTransaction, RECENT_TIMEOUT
+from pyptables.ruleset import Rule, Ruleset
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+KNOCKING = [
+    Rule(
+        "INPUT", "ACCEPT", "tcp", dport="22", matches="-m state --state NEW -m recent --rcheck --seconds 30 --name SSH1"
+    ),
+    Rule("INPUT", "SSH-KNOCKING-1", "tcp", dport="888", matches="-m state --state NEW -m recent --rcheck --name SSH0"),
+    Rule("INPUT", "DROP", "tcp", dport="777", matches="-m state --state NEW -m recent --name SSH0 --set"),
+    Rule("SSH-KNOCKING-1", "DROP", matches="-m recent --name SSH1 --set"),
+]
+
+
+class TestRecentSets(unittest.TestCase):
+    """ Sets replacing the recent lists """
+    @staticmethod
+    def declarations(rules: list) -> list:
+        """
+        Formats ipv4 rules for the inet table
+
+        :param rules: the rules of the filter table
+        :return: the declarations of the sets
+        """
+        ruleset = Ruleset()
+        table = ruleset.table("filter")
+        table.add_chain("SSH-KNOCKING-1")
+        for rule in rules:
+            table.add_rule(rule)
+
+        transaction = NftablesTransaction()
+        transaction.chains = lambda: []
+        transaction.staged = {4: ruleset}
+        return [line for line in transaction.script().splitlines() if line.startswith("add set")]
+
+    def test_every_set_has_a_timeout(self):
+        self.assertEqual(self.declarations(KNOCKING), [
+            "add set inet pyptables SSH1-ipv4 { type ipv4_addr; size 65535; flags dynamic, timeout; timeout 30s; }",
+            "add set inet pyptables SSH0-ipv4 { type ipv4_addr; size 65535; flags dynamic, timeout; timeout 30s; }",
+        ])
+
+    def test_default_timeout(self):
+        self.assertEqual(self.declarations([Rule("INPUT", "DROP", matches="-m recent --name SEEN --set")]), [
+            "add set inet pyptables SEEN-ipv4 {{ type ipv4_addr; size 65535; flags dynamic, timeout; timeout {}s; }}"
+            .format(RECENT_TIMEOUT),
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
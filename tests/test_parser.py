@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the configuration parser and of the included files
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from pyptables import parser
+from pyptables.parser import fragments, parse_fragment, TypedConfigParser
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class TestInclude(unittest.TestCase):
+    """ Files included by the global section, and the cache of their parsed sections """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = os.path.join(self.directory, "cache")
+        self.conf = self.write(
+            "pyptables.conf", "[global]\ninclude = pyptables.d/*.conf, extra.conf\n\n[ssh]\ndport = 22\n"
+        )
+        os.mkdir(os.path.join(self.directory, "pyptables.d"))
+        self.web = self.write("pyptables.d/web.conf", "[web]\ndport = 80\n")
+        self.dns = self.write("pyptables.d/dns.conf", "[dns]\ndport = 53\n\n[ssh]\ninterface = eth0\n")
+        self.extra = self.write("extra.conf", "[extra]\ndport = 8080\n")
+
+        patcher = mock.patch.dict(parser._fragments, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name: str, content: str) -> str:
+        """
+        Writes a file of the test
+
+        :param name: the name of the file, relative to the directory of the test
+        :param content: the content of the file
+        :return: the path of the file
+        """
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as _file:
+            _file.write(content)
+        return path
+
+    def test_fragments(self):
+        self.assertEqual(fragments(self.conf), [self.dns, self.web, self.extra])
+
+    def test_read(self):
+        config = TypedConfigParser()
+        self.assertEqual(config.read(self.conf), [self.conf, self.dns, self.web, self.extra])
+        self.assertEqual(config.sections(), ["global", "ssh", "dns", "web", "extra"])
+        self.assertEqual(dict(config["ssh"]), {"dport": "22", "interface": "eth0"})
+
+    def test_memory_cache(self):
+        with mock.patch("pyptables.parser._parse", wraps=parser._parse) as parse:
+            parse_fragment(self.web)
+            self.assertEqual(parse_fragment(self.web), {"web": {"dport": "80"}})
+            self.assertEqual(parse.call_count, 1)
+
+    def test_disk_cache(self):
+        with mock.patch("pyptables.parser._parse", wraps=parser._parse) as parse:
+            parse_fragment(self.web, self.cache)
+            parser._fragments.clear()
+            self.assertEqual(parse_fragment(self.web, self.cache), {"web": {"dport": "80"}})
+            self.assertEqual(parse.call_count, 1)
+
+    def test_changed(self):
+        parse_fragment(self.web, self.cache)
+        self.write("pyptables.d/web.conf", "[web]\ndport = 443\n")
+        os.utime(self.web, (0, 0))
+        parser._fragments.clear()
+        self.assertEqual(parse_fragment(self.web, self.cache), {"web": {"dport": "443"}})
+
+    def test_touched(self):
+        with mock.patch("pyptables.parser._parse", wraps=parser._parse) as parse:
+            parse_fragment(self.web, self.cache)
+            os.utime(self.web, (0, 0))
+            self.assertEqual(parse_fragment(self.web, self.cache), {"web": {"dport": "80"}})
+            self.assertEqual(parse.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the in-memory rulesets
+"""
+
+import unittest
+
+from pyptables.ruleset import rule_key, Rule, Ruleset, Table
+
+
+__author__ = 'Benjamin Schubert, ben.c.schubert@gmail.com'
+
+
+class TestRuleKey(unittest.TestCase):
+    """ Rules generated by pyptables against their form in iptables-save """
+    def test_saved_form(self):
+        self.assertEqual(
+            rule_key('-m tcp -p tcp --src 10.0.0.1 --dport 22 -m comment --comment "Allow ssh" -j ACCEPT'),
+            rule_key('-s 10.0.0.1/32 -p tcp -m tcp --dport 22 -m comment --comment "Allow ssh" -j ACCEPT'),
+        )
+
+    def test_default_options(self):
+        self.assertEqual(
+            rule_key("-m recent --rcheck --seconds 30 --name SSH2 -j ACCEPT"),
+            rule_key("-m recent --rcheck --seconds 30 --name SSH2 --mask 255.255.255.255 --rsource -j ACCEPT"),
+        )
+        self.assertEqual(
+            rule_key("-m recent --rcheck --seconds 30 --name SSH2 -j ACCEPT"),
+            rule_key("-m recent --rcheck --seconds 30 --name SSH2 --mask ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff "
+                     "--rsource -j ACCEPT"),
+        )
+
+    def test_different_rules(self):
+        self.assertNotEqual(
+            rule_key("-m tcp -p tcp --dport 22 -j ACCEPT"), rule_key("-m tcp -p tcp --dport 23 -j ACCEPT")
+        )
+
+
+class TestDiff(unittest.TestCase):
+    """ Changes applied by the diff backend """
+    CURRENT = Ruleset.parse("""*filter
+:INPUT DROP [0:0]
+:OLD - [0:0]
+-A INPUT -s 10.0.0.1/32 -p tcp -m tcp --dport 22 -j ACCEPT
+-A INPUT -p tcp -m tcp --dport 80 -j ACCEPT
+-A INPUT -p tcp -m tcp --dport 443 -j ACCEPT
+COMMIT
+""")
+
+    NEW = """*filter
+:INPUT DROP [0:0]
+-A INPUT -m tcp -p tcp --src 10.0.0.1 --dport 22 -j ACCEPT
+-A INPUT -m tcp -p tcp --dport 8080 -j ACCEPT
+-A INPUT -m tcp -p tcp --dport 443 -j ACCEPT
+COMMIT
+"""
+
+    def test_only_changed_rules(self):
+        self.assertEqual(Ruleset.parse(self.NEW).diff(self.CURRENT), "\n".join([
+            "*filter",
+            "-D INPUT 2",
+            "-I INPUT 2 -m tcp -p tcp --dport 8080 -j ACCEPT",
+            "-F OLD",
+            "-X OLD",
+            "COMMIT",
+        ]) + "\n")
+
+    def test_unchanged(self):
+        self.assertEqual(Ruleset.parse(self.NEW).diff(Ruleset.parse(self.NEW)), "")
+
+    def test_policy(self):
+        ruleset = Ruleset.parse(self.NEW.replace("INPUT DROP", "INPUT ACCEPT"))
+        self.assertEqual(ruleset.diff(Ruleset.parse(self.NEW)), "*filter\n-P INPUT ACCEPT\nCOMMIT\n")
+
+
+class TestDispatch(unittest.TestCase):
+    """ Generated chains grouping the rules by interface, protocol and ports """
+    def setUp(self):
+        self.table = Table("filter")
+        for port in range(1, 9):
+            self.table.add_rule(Rule("INPUT", "ACCEPT", "tcp", "eth0", dport=str(port)))
+        self.table.add_rule(Rule("INPUT", "DROP", "udp"))
+        self.table.add_rule(Rule("INPUT", "ACCEPT", "udp", "eth1", dport="53"))
+
+    def test_groups(self):
+        self.table.dispatch(4)
+        self.assertEqual(
+            self.table.chains, ["INPUT-eth0", "INPUT-eth0-tcp", "INPUT-eth0-tcp-1-4", "INPUT-eth0-tcp-5-8"]
+        )
+        self.assertEqual([rule.spec() for rule in self.table.rules["INPUT"]], [
+            "-i eth0 -j INPUT-eth0", "-m udp -p udp -j DROP", "-m udp -p udp -i eth1 --dport 53 -j ACCEPT"
+        ])
+        self.assertEqual([rule.spec() for rule in self.table.rules["INPUT-eth0-tcp"]], [
+            "-m tcp -p tcp --dport 1:4 -j INPUT-eth0-tcp-1-4", "-m tcp -p tcp --dport 5:8 -j INPUT-eth0-tcp-5-8"
+        ])
+        self.assertEqual([rule.dport for rule in self.table.rules["INPUT-eth0-tcp-5-8"]], ["5", "6", "7", "8"])
+
+    def test_small_groups_stay(self):
+        self.table.dispatch(9)
+        self.assertEqual(self.table.chains, [])
+        self.assertEqual(len(self.table.rules["INPUT"]), 10)
+
+
+class TestCovers(unittest.TestCase):
+    """ Rules matching every packet of another one """
+    def test_addresses_and_ports(self):
+        wide = Rule("INPUT", "ACCEPT", "tcp", source="10.0.0.0/8", dport="20:30")
+        narrow = Rule("INPUT", "ACCEPT", "tcp", source="10.1.0.1", dport="22")
+        self.assertTrue(wide.covers(narrow))
+        self.assertFalse(narrow.covers(wide))
+        self.assertFalse(wide.covers(narrow._replace(dport="31")))
+        self.assertFalse(wide.covers(narrow._replace(protocol="udp")))
+
+    def test_interface_wildcard(self):
+        self.assertTrue(Rule("INPUT", "DROP", interface="eth+").covers(Rule("INPUT", "DROP", "tcp", "eth0")))
+        self.assertFalse(Rule("INPUT", "DROP", interface="eth+").covers(Rule("INPUT", "DROP", "tcp", "wlan0")))
+
+    def test_stateful_matches(self):
+        limited = Rule("INPUT", "ACCEPT", "tcp", matches="-m limit --limit 2/sec")
+        self.assertFalse(limited.covers(limited))
+
+
+class TestAnalyze(unittest.TestCase):
+    """ Rules that never match a packet """
+    def setUp(self):
+        self.table = Table("filter")
+        self.rules = [
+            Rule("INPUT", "ACCEPT", "tcp", source="10.0.0.0/8", comment="network"),
+            Rule("INPUT", "ACCEPT", "tcp", source="10.0.0.1", dport="22", comment="host"),
+            Rule("INPUT", "DROP", "tcp", source="10.0.0.2", comment="blocked"),
+            Rule("INPUT", "ACCEPT", "tcp", source="10.0.0.0/8", comment="again"),
+            Rule("INPUT", "ACCEPT", "udp", source="192.168.0.0", comment="first half"),
+            Rule("INPUT", "ACCEPT", "udp", source="192.168.0.1", comment="second half"),
+        ]
+        for rule in self.rules:
+            self.table.add_rule(rule)
+
+    def test_findings(self):
+        findings = self.table.analyze()
+        self.assertIn(("redundant", "INPUT", [self.rules[1]], self.rules[0]), findings)
+        self.assertIn(("shadowed", "INPUT", [self.rules[2]], self.rules[0]), findings)
+        self.assertIn(("duplicate", "INPUT", [self.rules[3]], self.rules[0]), findings)
+        self.assertIn(("mergeable", "INPUT", self.rules[4:], 1), findings)
+        self.assertEqual(len(self.table.rules["INPUT"]), 6)
+
+    def test_prune(self):
+        self.table.analyze(prune=True)
+        self.assertEqual(self.table.rules["INPUT"], [self.rules[0]] + self.rules[4:])
+
+
+if __name__ == "__main__":
+    unittest.main()